@@ -72,6 +72,9 @@ void spits_free_metric_list(struct buffer_infos* buffers);
 struct buffer_metrics* spits_get_metrics_history(void* metric_manager, \
     unsigned int n_metrics, const char** metrics_list, unsigned int* sizes);
 
+struct buffer_metrics* spits_get_metrics_since(void* metric_manager, \
+    unsigned int n_metrics, const char** metrics_list, const long long* after);
+
 void spits_free_metrics_history(struct buffer_metrics* metrics, \
     unsigned int n_metrics);
 
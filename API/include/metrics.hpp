@@ -8,8 +8,12 @@
 #include <string>
 #include <cstring>
 #include <tuple>
-#include <deque>
-#include <map>
+#include <unordered_map>
+#include <algorithm>
+#include <atomic>
+#include <memory>
+#include <thread>
+#include <type_traits>
 #include <chrono>
 #include <stdexcept>
 #include <mutex>
@@ -33,7 +37,7 @@ template <typename T>
 struct MetricElement : public MetricElementBase {
   T value;
 
-  MetricElement() {};
+  MetricElement() : MetricElementBase(0, high_resolution_clock::time_point()) {};
   MetricElement(const T& val, unsigned long sequence, \
       high_resolution_clock::time_point tstamp) : \
       MetricElementBase(sequence, tstamp), value(val) {}
@@ -51,25 +55,121 @@ struct MetricElement : public MetricElementBase {
   }
 };
 
-// Simple ring buffer
+// Storage of a ring slot value. Trivially copyable values are kept in an
+// atomic, the others are kept behind a shared_ptr so a reader copying a
+// value never sees it being destroyed by a writer
+template <typename T, bool = std::is_trivially_copyable<T>::value>
+struct RingValue {
+  std::atomic<T> value;
+
+  void store(const T& v) {
+    value.store(v, std::memory_order_relaxed);
+  }
+
+  T load(void) const {
+    return value.load(std::memory_order_relaxed);
+  }
+};
+
+template <typename T>
+struct RingValue<T, false> {
+  std::shared_ptr<const T> value;
+
+  void store(const T& v) {
+    std::atomic_store_explicit(&value, std::make_shared<const T>(v), \
+      std::memory_order_release);
+  }
+
+  T load(void) const {
+    auto v = std::atomic_load_explicit(&value, std::memory_order_acquire);
+    return v ? *v : T();
+  }
+};
+
+// Fixed capacity ring of metric elements, preallocated. The element with
+// sequence number s is stored in the slot s % capacity. A writer owns a
+// slot while its version is odd and readers copy the slot without locks,
+// retrying when the version changes during the copy
 template <typename T>
-class Ring : public std::deque<T> {
-  using container_type = std::deque<T>;
+class Ring {
 public:
-    Ring(unsigned int capacity = 1) : _capacity(capacity) {}
-    void push_back(const T& value) {
-        if (this->size() == this->_capacity) {
-          this->pop_front();
-        }
-        container_type::push_back(value);
+  using element_type = MetricElement<T>;
+
+  Ring(unsigned int capacity = 1) : _capacity(capacity), \
+    _slots(new Slot[capacity > 0 ? capacity : 1]) {}
+
+  Ring(const Ring&) = delete;
+  Ring& operator=(const Ring&) = delete;
+
+  ~Ring(void) {
+    delete[] _slots;
+  }
+
+  unsigned int capacity(void) const {
+    return _capacity;
+  }
+
+  // Store the element with the given sequence number. Slots are only
+  // shared by writers that are capacity elements apart
+  void put(unsigned long sequence, const T& value, \
+      high_resolution_clock::time_point tstamp) {
+    Slot& slot = _slots[sequence % _capacity];
+    unsigned long version = slot.version.load(std::memory_order_relaxed);
+    do {
+      while (version & 1) {
+        std::this_thread::yield();
+        version = slot.version.load(std::memory_order_relaxed);
+      }
+    } while (!slot.version.compare_exchange_weak(version, version + 1, \
+      std::memory_order_acquire, std::memory_order_relaxed));
+    std::atomic_thread_fence(std::memory_order_release);
+
+    // A newer element was stored by a faster writer, keep it
+    if (slot.sequence.load(std::memory_order_relaxed) <= sequence) {
+      slot.value.store(value);
+      slot.timestamp.store(tstamp.time_since_epoch().count(), \
+        std::memory_order_relaxed);
+      slot.sequence.store(sequence + 1, std::memory_order_relaxed);
     }
+    slot.version.store(version + 2, std::memory_order_release);
+  }
 
-    ~Ring(void){
-      this->clear();
+  // Copy the element with the given sequence number. Returns false if it
+  // was not stored yet or was already overwritten
+  bool get(unsigned long sequence, element_type& element) const {
+    const Slot& slot = _slots[sequence % _capacity];
+    while (true) {
+      unsigned long version = slot.version.load(std::memory_order_acquire);
+      if (version & 1) {
+        std::this_thread::yield();
+        continue;
+      }
+      bool found = slot.sequence.load(std::memory_order_relaxed) == sequence + 1;
+      T value = found ? slot.value.load() : T();
+      auto tstamp = slot.timestamp.load(std::memory_order_relaxed);
+      std::atomic_thread_fence(std::memory_order_acquire);
+      if (slot.version.load(std::memory_order_relaxed) != version) {
+        continue;
+      }
+      if (found) {
+        element = element_type(value, sequence, high_resolution_clock::time_point( \
+          high_resolution_clock::duration(tstamp)));
+      }
+      return found;
     }
+  }
 
 private:
+  struct alignas(64) Slot {
+    std::atomic<unsigned long> version{0};
+    // Sequence number + 1 of the element stored, 0 if empty
+    std::atomic<unsigned long> sequence{0};
+    std::atomic<high_resolution_clock::rep> timestamp{0};
+    RingValue<T> value;
+  };
+
   unsigned int _capacity;
+  Slot* _slots;
 };
 
 // Base class to allow polymorphism
@@ -85,7 +185,7 @@ public:
   }
 
   unsigned int get_sequence(void) const {
-    return _sequence;
+    return _sequence.load(std::memory_order_relaxed);
   }
 
   enum DataType get_dtype(void) const {
@@ -97,17 +197,17 @@ public:
 protected:
   enum DataType _dtype;
   unsigned int _capacity;
-  unsigned int _sequence;
+  std::atomic<unsigned long> _sequence;
 };
 
-// Buffer of metric elements
+// Buffer of metric elements. Adding and retrieving elements take no locks
 template <typename T, enum DataType U>
 class MetricBuffer : public MetricBufferBase {
 public:
   using element_type = MetricElement<T>;
 
   MetricBuffer(unsigned int capacity=1, unsigned int seq = 0) : \
-    MetricBufferBase(U, capacity, seq), _buffer(capacity) {
+    MetricBufferBase(U, capacity, seq), _first(seq), _buffer(capacity) {
       if (capacity == 0) {
         throw std::length_error("Buffer was initialized with 0 capacity");
       }
@@ -115,32 +215,36 @@ public:
 
   void add(const T& value) {
     high_resolution_clock::time_point time_now = high_resolution_clock::now();
-    std::unique_lock lock(_mutex);
-    _buffer.push_back(element_type(value, _sequence++, time_now));
+    unsigned long sequence = _sequence.fetch_add(1, std::memory_order_acq_rel);
+    _buffer.put(sequence, value, time_now);
   }
 
   std::vector<element_type> retrieve_multiple(const unsigned int n_elements) {
-    std::vector<element_type> elements;
     if (n_elements > size()) {
       throw std::out_of_range("Requested element range is higher than queue size");
     }
+    unsigned long end = _sequence.load(std::memory_order_acquire);
+    return retrieve(begin(end), end, n_elements);
+  }
 
-    std::shared_lock lock(_mutex);
-    for (unsigned int i = 0; i<n_elements; ++i) {
-      elements.push_back(_buffer[i]);
+  // Elements with a sequence number greater than after (all if negative)
+  std::vector<element_type> retrieve_since(const long long after) {
+    unsigned long end = _sequence.load(std::memory_order_acquire);
+    unsigned long first = begin(end);
+    if (after >= 0 && (unsigned long) after + 1 > first) {
+      first = after + 1;
     }
-
-    return elements;
+    return retrieve(first, end, _capacity);
   }
 
   unsigned int size(void) const {
-    std::shared_lock lock(_mutex);
-    return _buffer.size();
+    unsigned long end = _sequence.load(std::memory_order_acquire);
+    return end - begin(end);
   }
 
   void reset(void) {
-    std::unique_lock lock(_mutex);
-    _buffer.clear();
+    _first.store(_sequence.load(std::memory_order_acquire), \
+      std::memory_order_release);
   }
 
   ~MetricBuffer(void) {
@@ -148,8 +252,34 @@ public:
   }
 
 private:
-  Ring<element_type> _buffer;
-  mutable std::shared_mutex _mutex;
+  // First sequence number that may still be in the ring
+  unsigned long begin(unsigned long end) const {
+    unsigned long first = _first.load(std::memory_order_acquire);
+    if (end > first + _capacity) {
+      first = end - _capacity;
+    }
+    return first;
+  }
+
+  // Elements are returned up to the first sequence number reserved by add
+  // but not stored yet, so a reader watermark never skips it. Elements
+  // already overwritten are skipped
+  std::vector<element_type> retrieve(unsigned long first, unsigned long end, \
+      unsigned int n_elements) const {
+    std::vector<element_type> elements;
+    element_type element;
+    for (unsigned long s = first; s < end && elements.size() < n_elements; ++s) {
+      if (_buffer.get(s, element)) {
+        elements.push_back(element);
+      } else if (s >= begin(_sequence.load(std::memory_order_acquire))) {
+        break;
+      }
+    }
+    return elements;
+  }
+
+  std::atomic<unsigned long> _first;
+  Ring<T> _buffer;
 };
 
 
@@ -178,25 +308,30 @@ public:
   }
 
   unsigned int get_num_buffers(void) const {
+    std::shared_lock lock(_map_mutex);
     return _metric_map.size();
   }
 
   unsigned int get_buffer_capacity(const std::string name) {
-    return _metric_map.at(name)->get_capacity();
+    return get_buffer(name)->get_capacity();
   }
 
   enum DataType get_buffer_dtype(const std::string name) {
-    return _metric_map.at(name)->get_dtype();
+    return get_buffer(name)->get_dtype();
   }
 
   std::vector<std::string> get_buffer_names(void) {
     std::vector<std::string> names;
-    for (auto const& it : _metric_map) { names.push_back(it.first); }
+    {
+      std::shared_lock lock(_map_mutex);
+      for (auto const& it : _metric_map) { names.push_back(it.first); }
+    }
+    std::sort(names.begin(), names.end());
     return names;
   }
 
   unsigned int get_buffer_size(const std::string name) {
-    MetricBufferBase* buffer = _metric_map.at(name);
+    MetricBufferBase* buffer = get_buffer(name);
     return buffer->size();
   }
 
@@ -226,37 +361,67 @@ public:
   GET_ELEMENT(string_buffer,std::string,string);
   GET_ELEMENT(byte_buffer,std::vector<std::byte>,bytes);
 
+  #define GET_ELEMENT_SINCE(BUFFER_TYPE,TYPE,NAME) \
+    std::vector<MetricElement<TYPE>> get_element_##NAME##_since ( \
+        const std::string name, const long long after)  { \
+      BUFFER_TYPE* buffer = (BUFFER_TYPE*) get_buffer(name); \
+      return buffer->retrieve_since(after); \
+  }
+  GET_ELEMENT_SINCE(int_buffer,int,int);
+  GET_ELEMENT_SINCE(float_buffer,float,float);
+  GET_ELEMENT_SINCE(string_buffer,std::string,string);
+  GET_ELEMENT_SINCE(byte_buffer,std::vector<std::byte>,bytes);
+
 private:
   unsigned int _default_capacity;
-  std::map<std::string, MetricBufferBase*> _metric_map;
+  std::unordered_map<std::string, MetricBufferBase*> _metric_map;
+  // Buffers are only removed by reset, so the pointers returned by
+  // get_buffer stay valid without holding the lock
+  mutable std::shared_mutex _map_mutex;
+
+  MetricBufferBase* get_buffer(const std::string& name) const {
+    std::shared_lock lock(_map_mutex);
+    return _metric_map.at(name);
+  }
 
   // Add metric template
   template<typename BufferType, typename MetricElementType, enum DataType U>
   void _add_metric(const std::string name, const MetricElementType& value) {
     if (name.empty()) { throw std::invalid_argument("Invalid buffer name"); }
-    auto it = _metric_map.find(name);
-    BufferType* buffer;
-    if (it == _metric_map.end()) {
-      buffer = new BufferType(_default_capacity);
-      _metric_map[name] = buffer;
+    MetricBufferBase* buffer = nullptr;
+    {
+      std::shared_lock lock(_map_mutex);
+      auto it = _metric_map.find(name);
+      if (it != _metric_map.end()) {
+        buffer = it->second;
+      }
     }
-    else {
-      buffer = (BufferType*) it->second;
-      if(buffer->get_dtype() != U) {
-        throw std::invalid_argument("Invalid type for metric buffer");
+    if (buffer == nullptr) {
+      std::unique_lock lock(_map_mutex);
+      auto it = _metric_map.find(name);
+      if (it == _metric_map.end()) {
+        buffer = new BufferType(_default_capacity);
+        _metric_map[name] = buffer;
       }
+      else {
+        buffer = it->second;
+      }
+    }
+    if(buffer->get_dtype() != U) {
+      throw std::invalid_argument("Invalid type for metric buffer");
     }
-    buffer->add(value);
+    ((BufferType*) buffer)->add(value);
   }
 
   template<typename BufferType, typename MetricElementType>
   std::vector<MetricElementType> get_elements(const std::string name, \
       unsigned int n_elements) {
-    BufferType* buffer = (BufferType*) _metric_map.at(name);
+    BufferType* buffer = (BufferType*) get_buffer(name);
     return buffer->retrieve_multiple(n_elements);
   }
 
   void reset(void) {
+    std::unique_lock lock(_map_mutex);
     for (auto it = _metric_map.begin(); it != _metric_map.end(); it++) {
       delete it->second;
     }
@@ -416,6 +581,78 @@ extern "C" struct buffer_metrics* spits_get_metrics_history(void* metric_manager
   return buffers;
 }
 
+// Fill the sample list of a buffer_metrics
+static void _spits_set_value(struct metric_info& info, const int& value) {
+  info.i_data = value;
+  info.data_size = sizeof(int);
+}
+
+static void _spits_set_value(struct metric_info& info, const float& value) {
+  info.f_data = value;
+  info.data_size = sizeof(float);
+}
+
+static void _spits_set_value(struct metric_info& info, const std::string& value) {
+  info.data_size = value.length()+1;
+  info.c_data = new unsigned char[info.data_size];
+  strcpy((char*)info.c_data, value.c_str());
+}
+
+static void _spits_set_value(struct metric_info& info, \
+    const std::vector<std::byte>& value) {
+  info.data_size = value.size();
+  info.c_data = new unsigned char[info.data_size];
+  memcpy(info.c_data, value.data(), info.data_size);
+}
+
+template <typename T>
+static void _spits_fill_metrics(struct buffer_metrics& buffer, \
+    const std::vector<MetricElement<T>>& values) {
+  buffer.num_metrics = values.size();
+  struct metric_info* metrics = new metric_info[values.size()];
+  for(unsigned int j = 0; j<values.size(); ++j) {
+    _spits_set_value(metrics[j], values[j].value);
+    metrics[j].sequence_no = values[j].sequence;
+    auto secs = time_point_cast<std::chrono::seconds>(values[j].timestamp);
+    auto ns = time_point_cast<std::chrono::nanoseconds>(values[j].timestamp) - time_point_cast<std::chrono::nanoseconds>(secs);
+    metrics[j].seconds = secs.time_since_epoch().count();
+    metrics[j].nano_seconds = ns.count();
+  }
+  buffer.metrics = metrics;
+}
+
+// Same as spits_get_metrics_history, but returns only the elements of each
+// buffer with a sequence number greater than after[i] (all if negative)
+extern "C" struct buffer_metrics* spits_get_metrics_since(void* metric_manager, \
+    unsigned int n_metrics, const char** metrics_list, const long long* after) {
+  MetricManager* m = static_cast<MetricManager*>(metric_manager);
+  struct buffer_metrics* buffers = new buffer_metrics[n_metrics];
+  for(unsigned int i = 0; i<n_metrics; ++i) {
+    unsigned int s = strlen(metrics_list[i]);
+    buffers[i].name = new char[s+1];
+    strcpy(buffers[i].name, metrics_list[i]);
+    int dtype = m->get_buffer_dtype(metrics_list[i]);
+    buffers[i].type = dtype;
+    if (dtype == TYPE_INT) {
+      _spits_fill_metrics(buffers[i], m->get_element_int_since(metrics_list[i], after[i]));
+    }
+    else if (dtype == TYPE_FLOAT) {
+      _spits_fill_metrics(buffers[i], m->get_element_float_since(metrics_list[i], after[i]));
+    }
+    else if (dtype == TYPE_STRING) {
+      _spits_fill_metrics(buffers[i], m->get_element_string_since(metrics_list[i], after[i]));
+    }
+    else if (dtype == TYPE_BYTES) {
+      _spits_fill_metrics(buffers[i], m->get_element_bytes_since(metrics_list[i], after[i]));
+    }
+    else {
+      buffers[i].num_metrics = 0;
+      buffers[i].metrics = NULL;
+    }
+  }
+  return buffers;
+}
+
 extern "C" void spits_free_metrics_history(struct buffer_metrics* metrics, \
     unsigned int n_metrics) {
   for(unsigned int i = 0; i<n_metrics; ++i) {
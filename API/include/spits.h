@@ -64,6 +64,13 @@ int spits_job_manager_next_task(void *user_data,
 
 void spits_job_manager_finalize(void *user_data);
 
+/* Optional batch version of spits_job_manager_next_task. Generates up to
+   count tasks, pushing task i with context jmctxs[i], and returns the
+   number of tasks generated (less than count when there are no more) */
+
+spitssize_t spits_job_manager_next_tasks(void *user_data,
+    spitspush_t push_task, const spitsctx_t* jmctxs, spitssize_t count);
+
 /* Worker */
 
 void* spits_worker_new(int argc, const char *argv[], const void*);
@@ -74,6 +81,14 @@ int spits_worker_run(void *user_data, const void* task,
 
 void spits_worker_finalize(void *user_data);
 
+/* Optional batch version of spits_worker_run. Runs count tasks, pushing
+   the result of task i with context taskctxs[i] and storing its return
+   code in results[i] */
+
+int spits_worker_run_batch(void *user_data, const void* const* tasks,
+    const spitssize_t* taskszs, spitssize_t count, spitspush_t push_result,
+    const spitsctx_t* taskctxs, int* results);
+
 /* Committer */
 
 void* spits_committer_new(int argc, const char *argv[],
@@ -82,6 +97,13 @@ void* spits_committer_new(int argc, const char *argv[],
 int spits_committer_commit_pit(void *user_data,
     const void* result, spitssize_t resultsz);
 
+/* Optional batch version of spits_committer_commit_pit. Commits count
+   results, storing the return code of result i in rets[i] */
+
+int spits_committer_commit_pits(void *user_data,
+    const void* const* results, const spitssize_t* resultszs,
+    spitssize_t count, int* rets);
+
 int spits_committer_commit_job(void *user_data,
     spitspush_t push_final_result, spitsctx_t jobctx);
 
@@ -32,6 +32,7 @@
 #include "stream.hpp"
 #include "metrics.hpp"
 #include <iostream>
+#include <vector>
 
 namespace spits
 {
@@ -131,6 +132,19 @@ namespace spits
     {
     public:
         virtual bool next_task(const pusher& task) = 0;
+
+        /**
+         * Generate up to count tasks, one per pusher. Override to generate
+         * many small tasks in a single call from the runtime
+         * @return The number of tasks generated
+         */
+        virtual spitssize_t next_tasks(const pusher* tasks, spitssize_t count)
+        {
+            spitssize_t i = 0;
+            while (i < count && next_task(tasks[i]))
+                i++;
+            return i;
+        }
         virtual ~job_manager() { }
     };
 
@@ -138,6 +152,17 @@ namespace spits
     {
     public:
         virtual int run(istream& task, const pusher& result) = 0;
+
+        /**
+         * Run count tasks, storing the return code of each one in rets.
+         * Override to run many small tasks in a single call from the runtime
+         */
+        virtual void run_batch(istream* tasks, const pusher* results,
+            int* rets, spitssize_t count)
+        {
+            for (spitssize_t i = 0; i < count; i++)
+                rets[i] = run(tasks[i], results[i]);
+        }
         virtual ~worker() { }
     };
 
@@ -145,6 +170,18 @@ namespace spits
     {
     public:
         virtual int commit_task(istream& result) = 0;
+
+        /**
+         * Commit count results, storing the return code of each one in rets.
+         * Override to commit many small results in a single call from the
+         * runtime
+         */
+        virtual void commit_tasks(istream* results, int* rets,
+            spitssize_t count)
+        {
+            for (spitssize_t i = 0; i < count; i++)
+                rets[i] = commit_task(results[i]);
+        }
         virtual int commit_job(const pusher& final_result) {
             final_result.push(NULL, 0);
             return 0;
@@ -199,6 +236,19 @@ extern "C" int spits_job_manager_next_task(void *user_data,
     return jm->next_task(task) ? 1 : 0;
 }
 
+extern "C" spitssize_t spits_job_manager_next_tasks(void *user_data,
+    spitspush_t push_task, const spitsctx_t* jmctxs, spitssize_t count)
+{
+    class spits::job_manager *jm = reinterpret_cast
+        <spits::job_manager*>(user_data);
+
+    std::vector<spits::pusher> tasks;
+    tasks.reserve(count);
+    for (spitssize_t i = 0; i < count; i++)
+        tasks.push_back(spits::pusher(push_task, jmctxs[i]));
+    return jm->next_tasks(tasks.data(), count);
+}
+
 extern "C" void spits_job_manager_finalize(void *user_data)
 {
     class spits::job_manager *jm = reinterpret_cast
@@ -227,6 +277,25 @@ extern "C" int spits_worker_run(void *user_data, const void* task,
     return w->run(stask, result);
 }
 
+extern "C" int spits_worker_run_batch(void *user_data,
+    const void* const* tasks, const spitssize_t* taskszs, spitssize_t count,
+    spitspush_t push_result, const spitsctx_t* taskctxs, int* results)
+{
+    spits::worker *w = reinterpret_cast
+        <spits::worker*>(user_data);
+
+    std::vector<spits::istream> stasks;
+    std::vector<spits::pusher> presults;
+    stasks.reserve(count);
+    presults.reserve(count);
+    for (spitssize_t i = 0; i < count; i++) {
+        stasks.push_back(spits::istream(tasks[i], taskszs[i]));
+        presults.push_back(spits::pusher(push_result, taskctxs[i]));
+    }
+    w->run_batch(stasks.data(), presults.data(), results, count);
+    return 0;
+}
+
 extern "C" void spits_worker_finalize(void *user_data)
 {
     spits::worker *w = reinterpret_cast
@@ -254,6 +323,21 @@ extern "C" int spits_committer_commit_pit(void *user_data,
     return co->commit_task(sresult);
 }
 
+extern "C" int spits_committer_commit_pits(void *user_data,
+    const void* const* results, const spitssize_t* resultszs,
+    spitssize_t count, int* rets)
+{
+    spits::committer *co = reinterpret_cast
+        <spits::committer*>(user_data);
+
+    std::vector<spits::istream> sresults;
+    sresults.reserve(count);
+    for (spitssize_t i = 0; i < count; i++)
+        sresults.push_back(spits::istream(results[i], resultszs[i]));
+    co->commit_tasks(sresults.data(), rets, count);
+    return 0;
+}
+
 extern "C" int spits_committer_commit_job(void *user_data,
     spitspush_t push_final_result, spitsctx_t jobctx)
 {
@@ -272,14 +356,19 @@ extern "C" void spits_committer_finalize(void *user_data)
     delete co;
 }
 
-#ifdef SPITS_SERIAL_DEBUG
+#if defined(SPITS_SERIAL_DEBUG) || defined(SPITS_LOCAL_RUNNER)
 #include <vector>
 #include <algorithm>
 #include <iostream>
 #include <cstdlib>
+#include <cstring>
 #include <fstream>
 #include <sstream>
 #include <stdint.h>
+#include <atomic>
+#include <memory>
+#include <thread>
+#include <chrono>
 
 static void spits_debug_pusher(const void* pdata,
     spitssize_t size, spitsctx_t ctx)
@@ -432,10 +521,309 @@ dump_task_and_exit:
     exit(1);
 }
 
+namespace spits
+{
+    namespace detail
+    {
+        /**
+         * Bounded lock-free queue for many producers and consumers
+         * (D. Vyukov). The sequence number of each cell tells whether it
+         * can be written or read in the current lap
+         */
+        template<typename T> class bounded_queue
+        {
+        private:
+            struct cell
+            {
+                std::atomic<size_t> sequence;
+                T data;
+            };
+
+            std::unique_ptr<cell[]> cells;
+            size_t mask;
+            alignas(64) std::atomic<size_t> head;
+            alignas(64) std::atomic<size_t> tail;
+
+            static void backoff(unsigned& tries)
+            {
+                if (++tries < 64)
+                    return;
+                if (tries < 1024)
+                    std::this_thread::yield();
+                else
+                    std::this_thread::sleep_for(std::chrono::microseconds(50));
+            }
+
+        public:
+            bounded_queue(size_t capacity) : head(0), tail(0)
+            {
+                size_t size = 2;
+                while (size < capacity)
+                    size <<= 1;
+                cells.reset(new cell[size]);
+                mask = size - 1;
+                for (size_t i = 0; i < size; i++)
+                    cells[i].sequence.store(i, std::memory_order_relaxed);
+            }
+
+            bool try_push(T& data)
+            {
+                size_t pos = tail.load(std::memory_order_relaxed);
+                cell* c;
+                while (true) {
+                    c = &cells[pos & mask];
+                    size_t seq = c->sequence.load(std::memory_order_acquire);
+                    intptr_t dif = (intptr_t)seq - (intptr_t)pos;
+                    if (dif == 0) {
+                        if (tail.compare_exchange_weak(pos, pos + 1,
+                            std::memory_order_relaxed))
+                            break;
+                    }
+                    else if (dif < 0)
+                        return false;
+                    else
+                        pos = tail.load(std::memory_order_relaxed);
+                }
+                c->data = std::move(data);
+                c->sequence.store(pos + 1, std::memory_order_release);
+                return true;
+            }
+
+            bool try_pop(T& data)
+            {
+                size_t pos = head.load(std::memory_order_relaxed);
+                cell* c;
+                while (true) {
+                    c = &cells[pos & mask];
+                    size_t seq = c->sequence.load(std::memory_order_acquire);
+                    intptr_t dif = (intptr_t)seq - (intptr_t)(pos + 1);
+                    if (dif == 0) {
+                        if (head.compare_exchange_weak(pos, pos + 1,
+                            std::memory_order_relaxed))
+                            break;
+                    }
+                    else if (dif < 0)
+                        return false;
+                    else
+                        pos = head.load(std::memory_order_relaxed);
+                }
+                data = std::move(c->data);
+                c->sequence.store(pos + mask + 1, std::memory_order_release);
+                return true;
+            }
+
+            void push(T& data)
+            {
+                unsigned tries = 0;
+                while (!try_push(data))
+                    backoff(tries);
+            }
+
+            void pop(T& data)
+            {
+                unsigned tries = 0;
+                while (!try_pop(data))
+                    backoff(tries);
+            }
+        };
+    };
+};
+
+static void spits_debug_dump(const char* kind, int64_t tid,
+    const std::vector<int8_t>& data)
+{
+    std::cerr << "[SPITS] Generating " << kind << " dump for task "
+        << tid << "..." << std::endl;
+    std::stringstream ss;
+    ss << kind << "-" << tid << ".dump";
+    std::ofstream file(ss.str().c_str(), std::ofstream::binary);
+    file.write(reinterpret_cast<const char*>(data.data()+1),
+        data.size()-1);
+    file.close();
+    std::cerr << "[SPITS] " << kind << " dump generated as " << ss.str() <<
+        " [" << (data.size()-1) << " bytes]. " << std::endl;
+}
+
+// Number of worker threads used by the local runner
+static unsigned int spits_local_workers = 1;
+
+struct spits_local_item
+{
+    int64_t tid;
+    std::vector<int8_t> data;
+};
+
+/**
+ * Run the job in this process with a generator thread, spits_local_workers
+ * worker threads, each one with its own worker instance, and the calling
+ * thread as committer, connected by bounded queues
+ */
+static int spits_local_runner(int argc, const char** argv,
+    const void* pjobinfo, spitssize_t jobinfosz,
+    const void** pfinal_result, spitssize_t* pfinal_resultsz)
+{
+    void* metrics = spits_metrics_new(10);
+    void* jm = spits_job_manager_new(argc, argv, pjobinfo, jobinfosz, metrics);
+    void* co = spits_committer_new(argc, argv, pjobinfo, jobinfosz, metrics);
+
+    static int64_t jid = 0;
+    const unsigned int nw = spits_local_workers;
+
+    spits::detail::bounded_queue<spits_local_item> tasks(4 * nw);
+    spits::detail::bounded_queue<spits_local_item> results(4 * nw);
+    std::vector<std::thread> threads;
+
+    std::cerr << "[SPITS] Running job " << jid << " with " << nw
+        << " workers..." << std::endl;
+
+    threads.emplace_back([&]() {
+        int64_t tid = 0;
+        while (true) {
+            spits_local_item task;
+            task.tid = tid;
+            if (!spits_job_manager_next_task(jm, spits_debug_pusher,
+                &task.data))
+                break;
+
+            if (task.data.size() == 0) {
+                std::cerr << "[SPITS] Task manager didn't push a task!"
+                    << std::endl;
+                exit(1);
+            }
+
+            spits_set_metric_int(metrics, "Generated Tasks", tid);
+            tasks.push(task);
+            tid++;
+        }
+        // One end marker per worker
+        for (unsigned int i = 0; i < nw; i++) {
+            spits_local_item end;
+            end.tid = -1;
+            tasks.push(end);
+        }
+    });
+
+    for (unsigned int i = 0; i < nw; i++) {
+        threads.emplace_back([&]() {
+            void* wk = spits_worker_new(argc, argv, metrics);
+            spits_local_item task;
+            while (true) {
+                tasks.pop(task);
+                if (task.tid < 0)
+                    break;
+
+                spits_local_item result;
+                result.tid = task.tid;
+                int r = spits_worker_run(wk, task.data.data()+1,
+                    task.data.size()-1, spits_debug_pusher, &result.data);
+
+                if (r != 0) {
+                    std::cerr << "[SPITS] Task " << task.tid
+                        << " failed to execute!" << std::endl;
+                    spits_debug_dump("task", task.tid, task.data);
+                    exit(1);
+                }
+
+                if (result.data.size() == 0) {
+                    std::cerr << "[SPITS] Worker didn't push a result!"
+                        << std::endl;
+                    spits_debug_dump("task", task.tid, task.data);
+                    exit(1);
+                }
+
+                spits_set_metric_int(metrics, "Executed Tasks", task.tid);
+                results.push(result);
+            }
+            spits_worker_finalize(wk);
+            spits_local_item end;
+            end.tid = -1;
+            results.push(end);
+        });
+    }
+
+    // Commit the results as they arrive until every worker has finished
+    spits_local_item result;
+    int64_t committed = 0;
+    for (unsigned int done = 0; done < nw; ) {
+        results.pop(result);
+        if (result.tid < 0) {
+            done++;
+            continue;
+        }
+
+        int r = spits_committer_commit_pit(co, result.data.data()+1,
+            result.data.size()-1);
+
+        if (r != 0) {
+            std::cerr << "[SPITS] Task " << result.tid
+                << " failed to commit!" << std::endl;
+            spits_debug_dump("result", result.tid, result.data);
+            exit(1);
+        }
+
+        spits_set_metric_int(metrics, "Commited Tasks", committed++);
+    }
+
+    for (auto& t : threads)
+        t.join();
+    std::cerr << "[SPITS] Finished processing " << committed << " tasks."
+        << std::endl;
+
+    std::vector<int8_t>* final_result = new std::vector<int8_t>();
+    std::cerr << "[SPITS] Committing job " << jid << "..." << std::endl;
+    int r = spits_committer_commit_job(co, spits_debug_pusher, final_result);
+
+    if (r != 0) {
+        std::cerr << "[SPITS] Job " << jid << " failed to commit!"
+            << std::endl;
+        exit(1);
+    }
+
+    if (final_result->size() <= 1) {
+        *pfinal_result = NULL;
+        *pfinal_resultsz = 0;
+    } else {
+        *pfinal_result = final_result->data()+1;
+        *pfinal_resultsz = final_result->size()-1;
+    }
+
+    spits_job_manager_finalize(jm);
+    spits_committer_finalize(co);
+    spits_metrics_delete(metrics);
+
+    std::cerr << "[SPITS] Job " << jid << " completed." << std::endl;
+    jid++;
+
+    // The final result stays alive until the next job, as in the debug
+    // runner
+    static std::unique_ptr<std::vector<int8_t>> last_result;
+    last_result.reset(final_result);
+
+    return 0;
+}
+
 int main(int argc, const char** argv)
 {
-    std::cerr << "[SPITS] Entering debug mode..." << std::endl;
-    spits_main(argc, argv, spits_debug_runner);
+#ifdef SPITS_LOCAL_RUNNER
+    spits_local_workers = std::thread::hardware_concurrency();
+#endif
+    // --spits-workers=N before the job arguments sets the number of
+    // worker threads, it is not passed to the job
+    if (argc > 1 && strncmp(argv[1], "--spits-workers=", 16) == 0) {
+        spits_local_workers = atoi(argv[1] + 16);
+        argv[1] = argv[0];
+        argv++;
+        argc--;
+    }
+
+    if (spits_local_workers > 1) {
+        std::cerr << "[SPITS] Entering local mode..." << std::endl;
+        spits_main(argc, argv, spits_local_runner);
+    }
+    else {
+        std::cerr << "[SPITS] Entering debug mode..." << std::endl;
+        spits_main(argc, argv, spits_debug_runner);
+    }
     std::cerr << "[SPITS] Spits finished." << std::endl;
 
     delete spits_factory;
@@ -29,6 +29,7 @@
 #define __SPITS_CPP_STREAM_HPP__
 
 #include <stdint.h>
+#include <string.h>
 #include <arpa/inet.h>
 
 #include <vector>
@@ -37,9 +38,65 @@
 #include <iterator>
 #include <exception>
 #include <algorithm>
+#include <type_traits>
 
 namespace spits
 {
+    // Byte order of arrays written with write_array. Scalars are always
+    // written in network (big endian) order
+    enum class byte_order
+    {
+        big,
+        little,
+        network = big,
+#if defined(__BYTE_ORDER__) && __BYTE_ORDER__ == __ORDER_BIG_ENDIAN__
+        host = big
+#else
+        host = little
+#endif
+    };
+
+    namespace detail
+    {
+        inline uint8_t bswap(uint8_t x) { return x; }
+        inline uint16_t bswap(uint16_t x) { return __builtin_bswap16(x); }
+        inline uint32_t bswap(uint32_t x) { return __builtin_bswap32(x); }
+        inline uint64_t bswap(uint64_t x) { return __builtin_bswap64(x); }
+
+        template<size_t N> struct uint_of_size;
+        template<> struct uint_of_size<1> { typedef uint8_t type; };
+        template<> struct uint_of_size<2> { typedef uint16_t type; };
+        template<> struct uint_of_size<4> { typedef uint32_t type; };
+        template<> struct uint_of_size<8> { typedef uint64_t type; };
+
+        // Copy n elements of size sizeof(T) reversing their bytes. The
+        // memcpy calls are only there to avoid aliasing problems, the
+        // compiler turns the loop into vector shuffles
+        template<typename T> void swap_copy(char* dst, const char* src,
+            size_t n)
+        {
+            typedef typename uint_of_size<sizeof(T)>::type U;
+            for (size_t i = 0; i < n; i++) {
+                U u;
+                memcpy(&u, src + i * sizeof(U), sizeof(U));
+                u = bswap(u);
+                memcpy(dst + i * sizeof(U), &u, sizeof(U));
+            }
+        }
+
+        // Copy n elements from or to the wire in the given byte order
+        template<typename T> void order_copy(char* dst, const char* src,
+            size_t n, byte_order order)
+        {
+            static_assert(std::is_arithmetic<T>::value,
+                "Only arrays of numbers can be serialized");
+            if (sizeof(T) == 1 || order == byte_order::host)
+                memcpy(dst, src, n * sizeof(T));
+            else
+                swap_copy<T>(dst, src, n);
+        }
+    };
+
 
     class ostream
     {
@@ -82,6 +139,15 @@ namespace spits
             return spits_htonll(*reinterpret_cast<const uint64_t*>(p));
         }
 
+        // Grow the capacity geometrically before appending size bytes
+        void grow(size_t size)
+        {
+            size_t needed = this->pdata.size() + size;
+            if (needed > this->pdata.capacity())
+                this->pdata.reserve(std::max(needed,
+                    2 * this->pdata.capacity()));
+        }
+
     public:
         ostream() : pdata() { }
 
@@ -104,9 +170,36 @@ namespace spits
         }
         void write_data(const void* pdata, size_t size)
         {
-            std::copy(reinterpret_cast<const char*>(pdata),
-                reinterpret_cast<const char*>(pdata) + size,
-                std::back_inserter(this->pdata));
+            grow(size);
+            this->pdata.insert(this->pdata.end(),
+                reinterpret_cast<const char*>(pdata),
+                reinterpret_cast<const char*>(pdata) + size);
+        }
+
+        // Write n numbers at once. Arrays written in the host byte order
+        // are copied with a single memcpy, use byte_order::host when the
+        // task is read by a machine with the same byte order. The reader
+        // must use the same byte order
+        template<typename T> void write_array(const T* v, size_t n,
+            byte_order order = byte_order::network)
+        {
+            static_assert(std::is_arithmetic<T>::value,
+                "Only arrays of numbers can be serialized");
+            const char* p = reinterpret_cast<const char*>(v);
+            size_t s = this->pdata.size();
+            grow(n * sizeof(T));
+            if (sizeof(T) == 1 || order == byte_order::host) {
+                this->pdata.insert(this->pdata.end(), p, p + n * sizeof(T));
+                return;
+            }
+            this->pdata.resize(s + n * sizeof(T));
+            detail::order_copy<T>(this->pdata.data() + s, p, n, order);
+        }
+
+        template<typename T> void write_array(const std::vector<T>& v,
+            byte_order order = byte_order::network)
+        {
+            write_array(v.data(), v.size(), order);
         }
 
         ostream& operator<<(const float& v)       { write_float(v); return *this; }
@@ -127,6 +220,12 @@ namespace spits
             return this->pdata.size();
         }
 
+        // Preallocate space for size bytes more
+        void reserve(size_t size)
+        {
+            this->pdata.reserve(this->pdata.size() + size);
+        }
+
         const void* data() const
         {
             return this->pdata.data();
@@ -245,6 +344,52 @@ namespace spits
             this->pos += size;
         }
 
+        // Read n numbers written with write_array in the same byte order
+        template<typename T> void read_array(T* v, size_t n,
+            byte_order order = byte_order::network)
+        {
+            ensure_size(n * sizeof(T));
+            detail::order_copy<T>(reinterpret_cast<char*>(v),
+                this->pdata + this->pos, n, order);
+            this->pos += n * sizeof(T);
+        }
+
+        template<typename T> void read_array(std::vector<T>& v, size_t n,
+            byte_order order = byte_order::network)
+        {
+            v.resize(n);
+            read_array(v.data(), n, order);
+        }
+
+        // Borrow the next size bytes of the buffer instead of copying
+        // them. The pointer is valid while the buffer given to the
+        // istream is
+        const void* read_view(size_t size)
+        {
+            ensure_size(size);
+            const void* p = this->pdata + this->pos;
+            this->pos += size;
+            return p;
+        }
+
+        // Borrow the next n numbers of an array written in the host byte
+        // order. Returns NULL without consuming them if the array is in
+        // another byte order or is not aligned for T, read_array must be
+        // used then
+        template<typename T> const T* view_array(size_t n,
+            byte_order order = byte_order::host)
+        {
+            static_assert(std::is_arithmetic<T>::value,
+                "Only arrays of numbers can be viewed");
+            ensure_size(n * sizeof(T));
+            const char* p = this->pdata + this->pos;
+            if ((sizeof(T) > 1 && order != byte_order::host) ||
+                reinterpret_cast<uintptr_t>(p) % alignof(T) != 0)
+                return NULL;
+            this->pos += n * sizeof(T);
+            return reinterpret_cast<const T*>(p);
+        }
+
         istream& operator>>(float& v)       { v = read_float(); return *this; }
         istream& operator>>(double& v)      { v = read_double(); return *this; }
         istream& operator>>(int8_t& v)      { v = read_char(); return *this; }
@@ -267,6 +412,11 @@ namespace spits
         {
             return this->pos < this->sz;
         }
+
+        size_t remaining() const
+        {
+            return this->sz - this->pos;
+        }
     };
 };
 
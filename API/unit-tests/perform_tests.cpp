@@ -3,6 +3,8 @@
 #include "test_buffers.hpp"
 #include "test_metrics.hpp"
 #include "test_c_interface.hpp"
+#include "test_metric_ring.hpp"
+#include "test_streams.hpp"
 
 int main(int argc, char** argv){
     std::cout << "Testing integer rings... ";
@@ -29,5 +31,21 @@ int main(int argc, char** argv){
     test_c_interface();
     std::cout << "OK" << std::endl;
     
+    std::cout << "Testing metric ring... ";
+    test_metric_ring();
+    test_metric_ring_concurrent();
+    std::cout << "OK" << std::endl;
+    
+    std::cout << "Testing metric ring throughput... ";
+    test_metric_ring_throughput();
+    
+    std::cout << "Testing stream arrays... ";
+    test_stream_arrays();
+    test_stream_views();
+    std::cout << "OK" << std::endl;
+    
+    std::cout << "Testing stream throughput... ";
+    test_stream_throughput();
+    
     return 0;
 }
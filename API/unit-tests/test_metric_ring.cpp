@@ -0,0 +1,194 @@
+#include <cassert>
+#include <chrono>
+#include <deque>
+#include <iostream>
+#include <mutex>
+#include <shared_mutex>
+#include <string>
+#include <thread>
+#include <vector>
+#include <metrics.hpp>
+#include "test_metric_ring.hpp"
+
+// Deque under a shared_mutex, as the metric buffers used to be, to compare
+// the throughput of the ring
+class locked_int_buffer {
+public:
+    locked_int_buffer(unsigned int capacity) : _capacity(capacity), _sequence(0) {}
+
+    void add(const int& value) {
+        high_resolution_clock::time_point time_now = high_resolution_clock::now();
+        std::unique_lock lock(_mutex);
+        if (_buffer.size() == _capacity)
+            _buffer.pop_front();
+        _buffer.push_back(MetricElement<int>(value, _sequence++, time_now));
+    }
+
+private:
+    unsigned int _capacity;
+    unsigned long _sequence;
+    std::deque<MetricElement<int>> _buffer;
+    std::shared_mutex _mutex;
+};
+
+// Buffer that reserves sequence numbers without storing them, as a writer
+// preempted inside add
+class pending_int_buffer : public int_buffer {
+public:
+    pending_int_buffer(unsigned int capacity) : int_buffer(capacity) {}
+
+    void reserve(void) {
+        _sequence.fetch_add(1, std::memory_order_acq_rel);
+    }
+};
+
+template <typename Buffer>
+static double adds_per_second(Buffer& buffer, unsigned int n_threads, unsigned int n_adds) {
+    std::vector<std::thread> threads;
+    auto start = std::chrono::steady_clock::now();
+    for (unsigned int t = 0; t<n_threads; ++t)
+        threads.emplace_back([&buffer, n_adds]() {
+            for (unsigned int i = 0; i<n_adds; ++i)
+                buffer.add(i);
+        });
+    for (auto& t : threads)
+        t.join();
+    std::chrono::duration<double> elapsed = std::chrono::steady_clock::now() - start;
+    return n_threads * n_adds / elapsed.count();
+}
+
+void test_metric_ring(void) {
+    const unsigned int n_elements = 5;
+
+    int_buffer ints(n_elements);
+    assert(ints.size() == 0);
+    assert(ints.retrieve_since(-1).empty());
+
+    for (unsigned int i = 0; i<n_elements-1; ++i)
+        ints.add(i);
+    assert(ints.size() == n_elements-1);
+
+    // Wrap around, only the last n_elements are kept
+    for (unsigned int i = n_elements-1; i<n_elements*3; ++i)
+        ints.add(i);
+    assert(ints.size() == n_elements);
+    assert(ints.get_sequence() == n_elements*3);
+
+    auto all = ints.retrieve_since(-1);
+    assert(all.size() == n_elements);
+    for (unsigned int i = 0; i<n_elements; ++i) {
+        assert(all[i].sequence == n_elements*2+i);
+        assert(all[i].value == (int)(n_elements*2+i));
+    }
+
+    // Only the elements after the watermark
+    auto last = ints.retrieve_since(n_elements*3-3);
+    assert(last.size() == 2);
+    assert(last[0].value == (int)(n_elements*3-2));
+    assert(ints.retrieve_since(n_elements*3-1).empty());
+
+    // Oldest elements first
+    auto oldest = ints.retrieve_multiple(2);
+    assert(oldest.size() == 2);
+    assert(oldest[0].value == (int)(n_elements*2));
+
+    bool thrown = false;
+    try {
+        ints.retrieve_multiple(n_elements+1);
+    } catch (std::out_of_range&) {
+        thrown = true;
+    }
+    assert(thrown);
+
+    ints.reset();
+    assert(ints.size() == 0);
+    ints.add(42);
+    assert(ints.retrieve_since(-1).size() == 1);
+
+    string_buffer strings(2);
+    strings.add("test001");
+    strings.add("test000000000002");
+    strings.add("test03");
+    auto s = strings.retrieve_since(-1);
+    assert(s.size() == 2);
+    assert(s[0].value == "test000000000002");
+    assert(s[1].value == "test03");
+
+    // Elements after a sequence not stored yet are not returned, so the
+    // watermark does not skip it
+    pending_int_buffer pending(n_elements);
+    pending.add(0);
+    pending.reserve();
+    pending.add(2);
+    auto before = pending.retrieve_since(-1);
+    assert(before.size() == 1);
+    assert(before[0].sequence == 0);
+    assert(pending.retrieve_since(0).empty());
+
+    // Once overwritten, the missing sequence is skipped
+    for (unsigned int i = 3; i<n_elements+2; ++i)
+        pending.add(i);
+    auto after = pending.retrieve_since(0);
+    assert(after.size() == n_elements);
+    assert(after[0].sequence == 2);
+    assert(after[n_elements-1].sequence == n_elements+1);
+}
+
+void test_metric_ring_concurrent(void) {
+    const unsigned int n_writers = 4;
+    const unsigned int n_adds = 100000;
+    const unsigned int n_names = 8;
+
+    // Writers add (sequence, thread) pairs encoded in the value while
+    // readers check that every element they see is consistent
+    string_buffer strings(16);
+    MetricManager manager(16);
+    std::atomic<bool> done(false);
+    std::vector<std::thread> threads;
+
+    for (unsigned int t = 0; t<n_writers; ++t)
+        threads.emplace_back([&strings, &manager, t]() {
+            for (unsigned int i = 0; i<n_adds; ++i) {
+                strings.add(std::to_string(i));
+                manager.add_metric("metric_" + std::to_string(i % n_names), (int) i);
+            }
+        });
+
+    std::thread reader([&strings, &done]() {
+        long long watermark = -1;
+        while (!done.load()) {
+            for (auto const& e : strings.retrieve_since(watermark)) {
+                assert((long long) e.sequence > watermark);
+                assert(std::stoul(e.value) < n_adds);
+                watermark = e.sequence;
+            }
+        }
+    });
+
+    for (auto& t : threads)
+        t.join();
+    done.store(true);
+    reader.join();
+
+    assert(strings.get_sequence() == n_writers*n_adds);
+    assert(strings.size() == 16);
+    assert(strings.retrieve_since(-1).size() == 16);
+    assert(manager.get_num_buffers() == n_names);
+    for (unsigned int i = 0; i<n_names; ++i)
+        assert(manager.get_buffer_size("metric_" + std::to_string(i)) == 16);
+}
+
+void test_metric_ring_throughput(void) {
+    const unsigned int n_adds = 1000000;
+
+    for (unsigned int n_threads : {1, 4}) {
+        int_buffer ring(10);
+        locked_int_buffer locked(10);
+        double ring_rate = adds_per_second(ring, n_threads, n_adds);
+        double locked_rate = adds_per_second(locked, n_threads, n_adds);
+        std::cout << std::endl << "  " << n_threads << " thread(s): ring "
+                  << ring_rate / 1e6 << " M adds/s, locked deque "
+                  << locked_rate / 1e6 << " M adds/s";
+    }
+    std::cout << std::endl;
+}
@@ -0,0 +1,16 @@
+#ifndef __TEST_METRIC_RING_HPP__
+#define __TEST_METRIC_RING_HPP__
+
+#include <iostream>
+#include <cassert>
+#include <exception>
+#include <cstring>
+#include "metrics.hpp"
+
+void test_metric_ring(void);
+
+void test_metric_ring_concurrent(void);
+
+void test_metric_ring_throughput(void);
+
+#endif /* __TEST_METRIC_RING_HPP__ */
@@ -0,0 +1,111 @@
+#include <cassert>
+#include <chrono>
+#include <cstring>
+#include <exception>
+#include <iostream>
+#include <vector>
+#include <stream.hpp>
+#include "test_streams.hpp"
+
+void test_stream_arrays(void) {
+    const unsigned int n_elements = 1001;
+
+    std::vector<double> doubles(n_elements);
+    std::vector<float> floats(n_elements);
+    std::vector<int16_t> shorts(n_elements);
+    for (unsigned int i = 0; i<n_elements; ++i) {
+        doubles[i] = i * 0.5 - 3.25;
+        floats[i] = i * 0.25f;
+        shorts[i] = (int16_t)(i - 500);
+    }
+
+    // Arrays in network order must match the scalar serialization
+    spits::ostream scalars, arrays;
+    for (unsigned int i = 0; i<n_elements; ++i)
+        scalars << doubles[i];
+    arrays.write_array(doubles);
+    assert(scalars.pos() == arrays.pos());
+    assert(!memcmp(scalars.data(), arrays.data(), scalars.pos()));
+
+    arrays.write_array(floats.data(), n_elements, spits::byte_order::host);
+    arrays.write_array(shorts, spits::byte_order::little);
+    arrays << std::string("end");
+
+    spits::istream in(arrays.data(), arrays.pos());
+    std::vector<double> d;
+    in.read_array(d, n_elements);
+    assert(d == doubles);
+    std::vector<float> f(n_elements);
+    in.read_array(f.data(), n_elements, spits::byte_order::host);
+    assert(f == floats);
+    std::vector<int16_t> s;
+    in.read_array(s, n_elements, spits::byte_order::little);
+    assert(s == shorts);
+    assert(in.read_string() == "end");
+    assert(!in.has_data());
+
+    // Reading past the end throws
+    bool thrown = false;
+    try {
+        spits::istream small(arrays.data(), 4);
+        small.read_array(d, 1);
+    } catch (std::exception&) {
+        thrown = true;
+    }
+    assert(thrown);
+}
+
+void test_stream_views(void) {
+    const unsigned int n_elements = 64;
+
+    std::vector<float> floats(n_elements);
+    for (unsigned int i = 0; i<n_elements; ++i)
+        floats[i] = i * 1.5f;
+
+    spits::ostream out;
+    out << (int32_t) n_elements;
+    out.write_array(floats, spits::byte_order::host);
+    out.write_data("raw", 4);
+
+    spits::istream in(out.data(), out.pos());
+    assert(in.read_int() == (int) n_elements);
+
+    // Arrays in another byte order can not be used in place
+    assert(in.view_array<float>(n_elements, spits::byte_order::network) == NULL);
+    const float* view = in.view_array<float>(n_elements);
+    assert(view != NULL);
+    assert((const char*) view == (const char*) out.data() + 4);
+    assert(!memcmp(view, floats.data(), n_elements * sizeof(float)));
+
+    const char* raw = (const char*) in.read_view(4);
+    assert(!strcmp(raw, "raw"));
+    assert(in.remaining() == 0);
+}
+
+void test_stream_throughput(void) {
+    const unsigned int n_elements = 1 << 22;
+    std::vector<double> doubles(n_elements, 3.14159);
+
+    auto start = std::chrono::steady_clock::now();
+    spits::ostream scalars;
+    for (unsigned int i = 0; i<n_elements; ++i)
+        scalars << doubles[i];
+    std::chrono::duration<double> t_scalar = std::chrono::steady_clock::now() - start;
+
+    start = std::chrono::steady_clock::now();
+    spits::ostream network;
+    network.write_array(doubles);
+    std::chrono::duration<double> t_network = std::chrono::steady_clock::now() - start;
+
+    start = std::chrono::steady_clock::now();
+    spits::ostream host;
+    host.write_array(doubles, spits::byte_order::host);
+    std::chrono::duration<double> t_host = std::chrono::steady_clock::now() - start;
+
+    assert(!memcmp(scalars.data(), network.data(), scalars.pos()));
+    double mb = n_elements * sizeof(double) / 1e6;
+    std::cout << std::endl << "  scalars " << mb / t_scalar.count()
+              << " MB/s, write_array " << mb / t_network.count()
+              << " MB/s, write_array (host order) " << mb / t_host.count()
+              << " MB/s" << std::endl;
+}
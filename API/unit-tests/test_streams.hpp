@@ -0,0 +1,16 @@
+#ifndef __TEST_STREAMS_HPP__
+#define __TEST_STREAMS_HPP__
+
+#include <iostream>
+#include <cassert>
+#include <exception>
+#include <cstring>
+#include "stream.hpp"
+
+void test_stream_arrays(void);
+
+void test_stream_views(void);
+
+void test_stream_throughput(void);
+
+#endif /* __TEST_STREAMS_HPP__ */
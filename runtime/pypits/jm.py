@@ -36,6 +36,7 @@ import traceback
 import argparse
 import uuid
 import random
+import zlib
 
 from libspits import JobBinary, SimpleEndpoint, get_logger, setup_log
 from libspits import Listener
@@ -45,9 +46,20 @@ from libspits import log_lines
 from libspits import make_uid
 from libspits import memstat
 from libspits import messaging, config
+from libspits import Journal
+from libspits import MemoStore
+from libspits import MetricAggregator
+from libspits import Tracer, sync_clock
+from libspits import EventLog
+from libspits import metrics_handler
+from libspits import query_histograms
 
 # Global configuration parameters
 from libspits.JobBinary import MetricManager
+from libspits.MetricCodec import serve_metrics_since
+from libspits.Histogram import serve_histograms
+from libspits.MetricAggregator import Timer
+from libspits.Journal import JournalRun
 
 jm_killtms = None       # Kill task managers after execution
 jm_log_file = None      # Output file for logging
@@ -66,6 +78,22 @@ jm_jobid = None
 jm_name = None
 jm_port = 0
 jm_working_dir = None
+jm_journal_file = None  # Checkpoint journal file
+jm_resume = False       # Resume the job from the journal
+jm_journal_results = False  # Keep the committed results in the journal
+jm_committer_persists = False  # The committer saves its own state
+jm_journal = None
+jm_memo_dir = None      # Result memoization directory
+jm_memo_size = None     # Maximum size of the memoization store (MiB)
+jm_memo = None
+jm_gen_batch = 1        # Maximum tasks generated in a single call
+jm_max_crashes = 3      # Crashes of a task before it is discarded
+jm_gen_done = False     # The binary has no more tasks to generate
+jm_trace_dir = None     # Directory of the task lifecycle trace
+jm_tracer = None
+jm_event_dir = None     # Directory of the binary event log
+jm_events = None
+jm_metrics_port = None  # Port of the OpenMetrics HTTP endpoint
 spits_binary = ''
 spits_binary_args = []
 
@@ -81,6 +109,19 @@ co_counter_tasks_commited = 0
 co_counter_results_received = 0
 co_counter_results_discarded = 0
 co_counter_tasks_error = 0
+co_counter_tasks_replayed = 0
+co_task_crashes = {}  # Number of times each task crashed its worker
+
+# Metric handles, registered in main
+jm_metric_tasks_generated = None
+jm_metric_tasks_sent = None
+jm_metric_tasks_pending = None
+jm_metric_push_time = None
+co_metric_commit_time = None
+co_metric_results_error = None
+co_metric_results_discarded = None
+co_metric_tasks_commited = None
+co_metric_tasks_replayed = None
 
 spits_running = True
 metrics_file = None
@@ -99,7 +140,10 @@ def parse_global_config(arguments):
         jm_recv_backoff, jm_memstat, jm_profiling, jm_perf_rinterv, \
         jm_perf_subsamp, jm_jobid, \
         jm_spits_profile_buffer_size, jm_name, jm_port, jm_working_dir, \
-        spits_binary, spits_binary_args, metrics_file
+        spits_binary, spits_binary_args, metrics_file, jm_journal_file, \
+        jm_journal_results, jm_committer_persists, \
+        jm_resume, jm_memo_dir, jm_memo_size, jm_gen_batch, jm_trace_dir, \
+        jm_metrics_port, jm_event_dir, jm_max_crashes
 
     parser = argparse.ArgumentParser(description="SPITS Job Manager runtime")
     parser.add_argument('binary', metavar='PATH', type=str,
@@ -163,6 +207,55 @@ def parse_global_config(arguments):
                              "(default: %(default)s)")
     parser.add_argument('--metrics-file', action='store', type=str,
                         help="Dump metrics to file when process ends")
+    parser.add_argument('--journal', action='store', type=str, metavar='PATH',
+                        help="Record generated tasks and committed results "
+                             "to a checkpoint journal")
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help="Resume the job from the checkpoint journal, "
+                             "skipping the tasks already committed "
+                             "(default: %(default)s)")
+    parser.add_argument('--journal-results', action='store_true',
+                        default=False,
+                        help="Keep the committed results in the journal, so "
+                             "the committer state is rebuilt on resume. "
+                             "Otherwise, only their size and checksum are "
+                             "recorded and the committed tasks are skipped "
+                             "(default: %(default)s)")
+    parser.add_argument('--committer-persists', action='store_true',
+                        default=False,
+                        help="The committer saves its own state, so the job "
+                             "can be resumed from a journal without the "
+                             "committed results (default: %(default)s)")
+    parser.add_argument('--memo', action='store', type=str, metavar='PATH',
+                        help="Directory used to memoize task results across "
+                             "runs of the same binary and arguments")
+    parser.add_argument('--max-crashes', action='store', type=int,
+                        metavar='N', default=3,
+                        help="Number of times a task may crash the worker "
+                             "process before it is discarded with an error "
+                             "(default: %(default)s)")
+    parser.add_argument('--gen-batch', action='store', type=int, metavar='N',
+                        default=1,
+                        help="Maximum number of tasks generated in a single "
+                             "call to the binary, limited by the capacity "
+                             "advertised by the task manager (default: "
+                             "%(default)s)")
+    parser.add_argument('--memo-size', action='store', type=int, metavar='MB',
+                        default=1024,
+                        help="Maximum size of the memoized results, in MiB "
+                             "(default: %(default)s)")
+    parser.add_argument('--trace', action='store', type=str, metavar='PATH',
+                        help="Trace the lifecycle of the tasks to a file in "
+                             "this directory, see spits-trace.py")
+    parser.add_argument('--event-log', action='store', type=str,
+                        metavar='PATH',
+                        help="Record task and connection events in a binary "
+                             "log in this directory, read by perf-pits.py")
+    parser.add_argument('--metrics-port', action='store', type=int,
+                        metavar='PORT',
+                        help="Serve the metrics in the OpenMetrics text "
+                             "format over HTTP at this port (0 for any) "
+                             "under /metrics")
 
     args = parser.parse_args(arguments)
     spits_binary = args.binary
@@ -190,6 +283,19 @@ def parse_global_config(arguments):
     jm_spits_profile_buffer_size = args.metric_buffer
     jm_port = args.port
     metrics_file = args.metrics_file
+    jm_journal_file = args.journal
+    jm_resume = args.resume
+    jm_journal_results = args.journal_results
+    jm_committer_persists = args.committer_persists
+    if jm_resume and jm_journal_file is None:
+        raise ValueError("--resume requires a journal file (--journal)")
+    jm_memo_dir = args.memo
+    jm_memo_size = args.memo_size
+    jm_gen_batch = max(1, args.gen_batch)
+    jm_max_crashes = max(1, args.max_crashes)
+    jm_trace_dir = args.trace
+    jm_event_dir = args.event_log
+    jm_metrics_port = args.metrics_port
 
 
 ###############################################################################
@@ -466,6 +572,11 @@ def setup_endpoint_for_pushing(e: SimpleEndpoint) -> bool:
 
         e.WriteInt64(messaging.msg_send_task)
 
+        # The task manager advertises how many tasks it can queue
+        e.capacity = e.ReadInt64(jm_recv_timeout)
+        logger.debug(f'Task manager at {e.address}:{e.port} can queue '
+                     f'{e.capacity} tasks')
+
         # Wait for a response
         response = e.ReadInt64(jm_recv_timeout)
 
@@ -475,6 +586,8 @@ def setup_endpoint_for_pushing(e: SimpleEndpoint) -> bool:
 
         # Task Manager is not full, continue to push tasks to the TM
         elif response == messaging.msg_send_more:
+            # Largest task the task manager accepts, -1 if any
+            e.budget = e.ReadInt64(jm_recv_timeout)
             logger.debug(f"Task manager at {e.address}:{e.port} is asking more")
             return True
 
@@ -545,11 +658,22 @@ def setup_endpoint_for_pulling(e: SimpleEndpoint) -> bool:
     return False
 
 
+###############################################################################
+# Record the stages of the tasks in the trace and in the event log
+###############################################################################
+def record_task(stage, taskid, tm=None):
+    if jm_tracer is not None:
+        jm_tracer.record(stage, taskid,
+                         None if tm is None else f'{tm.address}:{tm.port}')
+    if jm_events is not None:
+        jm_events.record(stage, taskid, 0 if tm is None else tm.port)
+
+
 ###############################################################################
 # Push tasks while the task manager is not full
 ###############################################################################
 def push_tasks(job: JobBinary, metrics: MetricManager, runid: int, jm: Pointer, tm: SimpleEndpoint, taskid: int, task: Pointer, tasklist: dict,
-               completed: list) -> tuple:
+               completed: list, backlog: list, memo_hits: list) -> tuple:
     """ Push tasks to a task manager while the it is not full
 
     :param job: The SPITS job binary object to interact with the binary application via C code
@@ -569,6 +693,10 @@ def push_tasks(job: JobBinary, metrics: MetricManager, runid: int, jm: Pointer,
     * [1]: The task
     :param completed: Variable indicating that all tasks were generated
     :type completed: list of bool
+    :param backlog: List of (taskid, task) already generated that must be sent before generating new tasks
+    :type backlog: list
+    :param memo_hits: List that receives the (taskid, result) of generated tasks found in the memoization store
+    :type memo_hits: list
     :rtype: tuple
     :return: A tuple with 4 field:
     * [0]: True if there is no more task to generate or false otherwise
@@ -576,79 +704,117 @@ def push_tasks(job: JobBinary, metrics: MetricManager, runid: int, jm: Pointer,
     * [2]: The task or None
     * [3]: The successfully sent task list
     """
-    global jm_counter_tasks_generated, jm_counter_tasks_sent, jm_counter_tasks_replicated, jm_recv_timeout
+    global jm_counter_tasks_generated, jm_counter_tasks_sent, jm_counter_tasks_replicated, jm_recv_timeout, \
+        jm_gen_done
 
     # Keep pushing until finished or the task manager is full
     sent = []
 
     while True:
-        if task is None:
+        from_backlog = False
+        sendid = taskid
+        if task is None and len(backlog) > 0:
+            # Send the tasks recovered from the journal first
+            sendid, task = backlog.pop(0)
+            from_backlog = True
+            if sendid not in tasklist:
+                task = None
+                continue
+
+        elif task is None:
             # Avoid calling next_task after it's finished
-            if completed:
+            if completed or jm_gen_done:
                 logger.debug('There are no new tasks to generate.')
                 return True, 0, None, sent
 
-            # Only get a task if the last one was already sent.
-            newtaskid = taskid + 1
-            # Create a new task with the newtaskid
-            return_code, newtask, ctx = job.spits_job_manager_next_task(jm, newtaskid)
+            # Generate as many tasks as the task manager can queue, with a
+            # single call when the binary supports it. The tasks go to the
+            # backlog and are sent from there
+            count = jm_gen_batch
+            if tm.capacity > 0:
+                count = min(count, tm.capacity)
+            newtasks = job.spits_job_manager_next_tasks(
+                jm, list(range(taskid + 1, taskid + 1 + count)))
 
             # Exit if done
-            if return_code == 0:
+            if len(newtasks) < count:
+                jm_gen_done = True
+            if len(newtasks) == 0:
                 return True, 0, None, sent
 
-            # Error generating task, return the context
-            if newtask is None:
-                logger.error(f'Task {newtaskid} was not pushed!')
-                return False, taskid, task, sent
-
-            if ctx != newtaskid:
-                logger.error(f'Context verification failed for task {newtaskid}!')
-                return False, taskid, task, sent
-
-            taskid = newtaskid
-            # Get the task
-            task = newtask[0]
-            # Add the generated task to the tasklist
-            tasklist[taskid] = (0, task)
-            # Increment the number of successfully generated tasks
-            jm_counter_tasks_generated += 1
-            metrics.set_metric("tasks_generated", jm_counter_tasks_generated)
-            logger.debug(
-                f'Generated task {taskid} with payload size of '
-                f'{len(task) if task is not None else 0} bytes.')
+            for newtaskid, newtask in newtasks:
+                taskid = newtaskid
+                # Error generating task, the generator has already moved past
+                # it, keep the remaining tasks of the batch
+                if newtask is None:
+                    logger.error(f'Task {taskid} was not pushed or failed '
+                                 f'the context verification!')
+                    continue
+
+                # Add the generated task to the tasklist
+                tasklist[taskid] = (0, newtask)
+                if jm_journal is not None:
+                    jm_journal.task_generated(runid, taskid, newtask)
+                record_task(Tracer.GENERATED, taskid)
+                # Increment the number of successfully generated tasks
+                jm_counter_tasks_generated += 1
+                jm_metric_tasks_generated.inc()
+                logger.debug(
+                    f'Generated task {taskid} with payload size of '
+                    f'{len(newtask)} bytes.')
+
+                # Tasks executed by a previous run are committed directly
+                if jm_memo is not None:
+                    res = jm_memo.get(jm_memo.key(newtask))
+                    if res is not None:
+                        logger.debug(f'Task {taskid} found in the memoization store.')
+                        memo_hits.append((taskid, res))
+                        continue
+
+                backlog.append((taskid, newtask))
+            continue
         # else:
         #    duplicated = True
 
+        # Keep tasks that do not fit in the task manager memory budget
+        # for other task managers
+        if task is not None and 0 <= tm.budget < len(task):
+            logger.debug(f'Task {sendid} does not fit in the {tm.budget} '
+                         f'bytes accepted by the task manager at '
+                         f'{tm.address}:{tm.port}')
+            break
+
         try:
-            logger.debug(f'Pushing task {taskid} to the Task Manager at '
+            logger.debug(f'Pushing task {sendid} to the Task Manager at '
                          f'{tm.address}:{tm.port}..')
 
             # Send the task to the active task manager. Send (taskid, runid, tasksize, task)
-            tm.WriteInt64(taskid)
-            tm.WriteInt64(runid)
+            push_start = time.monotonic()
             if task is None:
-                tm.WriteInt64(0)
+                tm.WriteInt64s(sendid, runid, 0)
             else:
-                tm.WriteInt64(len(task))
+                tm.WriteInt64s(sendid, runid, len(task))
                 tm.Write(task)
+            record_task(Tracer.SENT, sendid, tm)
 
             # Wait for a response (may be reject/full/send_more)
             response = tm.ReadInt64(jm_recv_timeout)
+            jm_metric_push_time.observe(time.monotonic() - push_start)
             # Increment the sent tasks
             jm_counter_tasks_sent += 1
-            metrics.set_metric("tasks_sent", jm_counter_tasks_sent)
+            jm_metric_tasks_sent.inc()
 
             # Task was sent, but the task manager is now full. Stop sending for a while...
             if response == messaging.msg_send_full:
-                sent.append((taskid, task))
+                sent.append((sendid, task))
                 task = None
                 break
 
             # Task manager is not full and more tasks can be sent!
             elif response == messaging.msg_send_more:
+                tm.budget = tm.ReadInt64(jm_recv_timeout)
                 # Continue pushing tasks
-                sent.append((taskid, task))
+                sent.append((sendid, task))
                 task = None
                 pass
 
@@ -657,7 +823,7 @@ def push_tasks(job: JobBinary, metrics: MetricManager, runid: int, jm: Pointer,
             # pushes tasks, exit the task loop
             elif response == messaging.msg_send_rjct:
                 logger.warning(f'Task manager at {tm.address}:{tm.port} rejected '
-                               f'task {taskid}')
+                               f'task {sendid}')
                 break
 
             # The task manager is not replying as expected
@@ -672,6 +838,11 @@ def push_tasks(job: JobBinary, metrics: MetricManager, runid: int, jm: Pointer,
             log_lines(traceback.format_exc(), logging.debug)
             break
 
+    # A task from the backlog that was not sent goes back to the backlog
+    if from_backlog and task is not None:
+        backlog.insert(0, (sendid, task))
+        task = None
+
     return False, taskid, task, sent
 
 
@@ -692,48 +863,55 @@ def commit_tasks(job: JobBinary, metrics: MetricManager, runid, co, tm, tasklist
                 # No more task to receive
                 return
 
-            # Read the run id
+            # Read the run id, the return code and the size of the result
             taskrunid = tm.ReadInt64(jm_recv_timeout)
-
-            # Read the rest of the task
             r = tm.ReadInt64(jm_recv_timeout)
             ressz = tm.ReadInt64(jm_recv_timeout)
-            res = tm.Read(ressz, jm_recv_timeout)
 
-            # Tell the task manager that the task was received
-            tm.WriteInt64(messaging.msg_read_result)
+            # Results from other runs or already committed are not
+            # transferred, the task manager drops them
+            c = completed.get(taskid, (None, None))
+            if taskrunid != runid or c[0] != None:
+                tm.WriteInt64(messaging.msg_read_skip)
+            else:
+                tm.WriteInt64(messaging.msg_read_accept)
+
+                # Read the result
+                res = tm.Read(ressz, jm_recv_timeout)
+
+                # Tell the task manager that the task was received
+                tm.WriteInt64(messaging.msg_read_result)
 
             # Warning, exceptions after this line may cause task loss
             # if not handled properly!!
 
-            if r != 0:
+            # Crashes are counted as errors only when the task is discarded
+            if r == messaging.res_module_error:
+                logger.error('The remote worker crashed while ' +
+                              'executing task %d!', taskid)
+            elif r != 0:
                 n_errors += 1
                 co_counter_tasks_error += 1
-                if r == messaging.res_module_error:
-                    logger.error('the remote worker crashed while ' +
-                                  'executing task %d!', r)
-                else:
-                    logger.error('The task %d was not successfully executed, ' +
-                                  'worker returned %d!', taskid, r)
-                metrics.set_metric("results_error", co_counter_tasks_error)
+                logger.error('The task %d was not successfully executed, ' +
+                              'worker returned %d!', taskid, r)
+                co_metric_results_error.inc()
 
             if taskrunid < runid:
                 logger.debug('The task %d is from the previous run %d ' +
                               'and will be ignored!', taskid, taskrunid)
                 co_counter_results_discarded += 1
-                metrics.set_metric("results_discarded", co_counter_results_discarded)
+                co_metric_results_discarded.inc()
                 continue
 
             if taskrunid > runid:
                 logger.error('Received task %d from a future run %d!',
                               taskid, taskrunid)
                 co_counter_results_discarded += 1
-                metrics.set_metric("results_discarded", co_counter_results_discarded)
+                co_metric_results_discarded.inc()
                 continue
 
             # Validated completed task
 
-            c = completed.get(taskid, (None, None))
             if c[0] != None:
                 # This may happen with the fault tolerance system. This may
                 # lead to tasks being put in the tasklist by the job manager
@@ -745,9 +923,24 @@ def commit_tasks(job: JobBinary, metrics: MetricManager, runid, co, tm, tasklist
                 # Removed the completed task from the tasklist
                 tasklist.pop(taskid, (None, None))
                 co_counter_results_discarded += 1
-                metrics.set_metric("results_discarded", co_counter_results_discarded)
+                co_metric_results_discarded.inc()
                 continue
 
+            if r == messaging.res_module_error:
+                crashes = co_task_crashes.get(taskid, 0) + 1
+                if crashes < jm_max_crashes:
+                    # The task stays in the tasklist and will be sent again
+                    co_task_crashes[taskid] = crashes
+                    logger.info('The task %d will be rescheduled', taskid)
+                    continue
+                # The task is poison, discard it
+                co_task_crashes.pop(taskid, None)
+                logger.error('The task %d crashed the worker %d times and '
+                             'will be discarded!', taskid, crashes)
+                n_errors += 1
+                co_counter_tasks_error += 1
+                co_metric_results_error.inc()
+
             # Remove it from the tasklist
 
             p = tasklist.pop(taskid, (None, None))
@@ -757,19 +950,31 @@ def commit_tasks(job: JobBinary, metrics: MetricManager, runid, co, tm, tasklist
                 logger.error('The task %d was not in the working list!',
                               taskid)
 
-            r2 = job.spits_committer_commit_pit(co, res)
-
-            if r2 != 0:
-                logger.error('The task %d was not successfully committed, ' +
-                              'committer returned %d', taskid, r2)
-                co_counter_tasks_error += 1
-                metrics.set_metric("results_error", co_counter_tasks_error)
+            if r == messaging.res_module_error:
+                # Discarded, the result of a crashed worker is not committed
+                r2 = r
             else:
-                co_counter_tasks_commited += 1
-                metrics.set_metric("tasks_commited", co_counter_tasks_commited)
+                commit_start = time.monotonic()
+                r2 = job.spits_committer_commit_pit(co, res)
+                co_metric_commit_time.observe(time.monotonic() - commit_start)
+
+                if r2 != 0:
+                    logger.error('The task %d was not successfully committed, ' +
+                                  'committer returned %d', taskid, r2)
+                    co_counter_tasks_error += 1
+                    co_metric_results_error.inc()
+                else:
+                    co_counter_tasks_commited += 1
+                    co_metric_tasks_commited.inc()
+                    record_task(Tracer.COMMITTED, taskid, tm)
+                    # Only results successfully executed are memoized
+                    if jm_memo is not None and r == 0 and p[0] != None:
+                        jm_memo.put(jm_memo.key(p[1]), res)
 
             # Add completed task to list
             completed[taskid] = (r, r2)
+            if jm_journal is not None:
+                jm_journal.task_committed(runid, taskid, r, r2, res)
 
         except:
             # Something went wrong with the connection,
@@ -810,7 +1015,7 @@ def infinite_tmlist_generator():
         #except:
         #   if len(tmlist) > 0:
         #        logger.warning('New list of task managers is empty and will not be updated!')
-        for name in random.sample(tmlist.keys(), k=len(tmlist)):
+        for name in random.sample(list(tmlist), k=len(tmlist)):
             yield False, name, tmlist[name]
         yield True, None, None
 
@@ -818,7 +1023,32 @@ def infinite_tmlist_generator():
 ###############################################################################
 # Heartbeat routine
 ###############################################################################
-def heartbeat(finished):
+def pull_histograms(tm, aggregator):
+    """ Merge the histograms of a task manager into the fleet-wide
+    histograms of the job manager (named fleet_<name>)
+    """
+    try:
+        tm.Open(jm_conn_timeout)
+        tm.WriteString(jm_jobid)
+        if tm.ReadString(jm_recv_timeout) != jm_jobid:
+            return
+        histograms = query_histograms(tm, jm_recv_timeout)
+    except:
+        logger.debug(f'Error pulling histograms from task manager at '
+                     f'{tm.address}:{tm.port}!')
+        log_lines(traceback.format_exc(), logging.debug)
+        return
+    finally:
+        tm.Close()
+    for name, histogram in histograms.items():
+        if histogram.unit == Timer.unit:
+            handle = aggregator.timer(f'fleet_{name}')
+        else:
+            handle = aggregator.histogram(f'fleet_{name}')
+        handle.update(f'{tm.address}:{tm.port}', histogram)
+
+
+def heartbeat(finished, aggregator):
     global jm_heart_timeout
     t_last = time.time()
     for isEnd, name, tm in infinite_tmlist_generator():
@@ -857,20 +1087,158 @@ def heartbeat(finished):
                     tm.Close()
                     continue
 
-                # Send the heartbeat
-                tm.WriteInt64(messaging.msg_send_heart)
+                # Send the heartbeat, when tracing the clock query
+                # also keeps the task manager alive
+                if jm_tracer is not None:
+                    sync_clock(tm, jm_tracer, jm_recv_timeout)
+                else:
+                    tm.WriteInt64(messaging.msg_send_heart)
             except:
                 logger.warning(f'Error connecting to task manager at '
                                f'{tm.address}:{tm.port}!')
                 log_lines(traceback.format_exc(), logging.debug)
             finally:
                 tm.Close()
+            pull_histograms(tm, aggregator)
+
+
+###############################################################################
+# Regenerate the tasks recorded in the journal
+###############################################################################
+def fast_forward(job: JobBinary, metrics: MetricManager, runid: int, jm: Pointer, resumed: JournalRun, tasklist: dict,
+                 backlog: list):
+    """ Bring the job manager back to the state recorded in the journal. The tasks generated before the restart are
+    generated again (tasks are cheap to generate compared to execute them) and checked against the journal. The ones
+    already committed are dropped and the outstanding ones are placed in the tasklist and in the backlog to be sent again.
+
+    :param job: The SPITS job binary object to interact with the binary application via C code
+    :type job: JobBinary
+    :param runid: Run identifier for the Job Manager
+    :type runid: int
+    :param jm: Pointer to a Job Manager instance, generated with 'spits_job_manager_new'
+    :type jm: Pointer
+    :param resumed: Progress of the run recovered from the journal
+    :type resumed: JournalRun
+    :param tasklist: The dict of generated tasks (see push_tasks)
+    :type tasklist: dict
+    :param backlog: List that receives the outstanding (taskid, task)
+    :type backlog: list
+    :return: The last task id generated or None if the job manager diverged from the journal
+    :rtype: int
+    """
+    global jm_counter_tasks_generated
+
+    last = resumed.last_taskid()
+    logger.info(f'Regenerating {last} tasks from the journal...')
+
+    for taskid in range(1, last + 1):
+        return_code, newtask, ctx = job.spits_job_manager_next_task(jm, taskid)
+        if return_code == 0 or newtask is None or ctx != taskid:
+            logger.error(f'The job manager did not generate task {taskid} again!')
+            return None
+
+        task = newtask[0] or b''
+        if resumed.tasks.get(taskid) != (len(task), zlib.crc32(task)):
+            logger.error(f'Task {taskid} differs from the one in the journal!')
+            return None
+
+        jm_counter_tasks_generated += 1
+        if taskid not in resumed.commits:
+            tasklist[taskid] = (0, newtask[0])
+            backlog.append((taskid, newtask[0]))
+
+    jm_metric_tasks_generated.inc(last)
+    logger.info(f'Resuming with {len(backlog)} outstanding tasks.')
+    return last
+
+
+###############################################################################
+# Commit again the results recorded in the journal
+###############################################################################
+def replay_commits(job: JobBinary, metrics: MetricManager, co: Pointer, resumed: JournalRun, completed: dict) -> None:
+    """ Rebuild the committer state committing again the results recorded in the journal
+
+    :param job: The SPITS job binary object to interact with the binary application via C code
+    :type job: JobBinary
+    :param co: Pointer to a Committer instance, generated with 'spits_committer_new'
+    :type co: Pointer
+    :param resumed: Progress of the run recovered from the journal
+    :type resumed: JournalRun
+    :param completed: The dict of completed tasks (see commit_tasks)
+    :type completed: dict
+    """
+    global co_counter_tasks_replayed
+
+    logger.info(f'Replaying {len(resumed.commits)} committed results from the journal...')
+    missing = 0
+    for taskid in sorted(resumed.commits):
+        r, r2, offset, size = resumed.commits[taskid]
+        # Results that failed to commit are not committed again, results
+        # not kept in the journal cannot be committed again
+        if r2 == 0 and offset is None:
+            missing += 1
+        elif r2 == 0:
+            r2 = job.spits_committer_commit_pit(co, resumed.result(taskid))
+            if r2 != 0:
+                logger.error(f'The task {taskid} was not successfully committed again, committer returned {r2}')
+        completed[taskid] = (r, r2)
+        co_counter_tasks_replayed += 1
+
+    co_metric_tasks_replayed.inc(len(resumed.commits))
+    if missing > 0:
+        logger.info(f'{missing} committed results were not kept in the journal and were not committed again, the '
+                    f'committer saved them before the restart')
+
+
+###############################################################################
+# Commit the results found in the memoization store
+###############################################################################
+def commit_memoized(job: JobBinary, metrics: MetricManager, runid: int, co: Pointer, tasklist: dict, completed: dict,
+                    memo_hits: list) -> None:
+    """ Commit the results of the tasks found in the memoization store by the job manager
+
+    :param job: The SPITS job binary object to interact with the binary application via C code
+    :type job: JobBinary
+    :param runid: Run identifier for the Job Manager
+    :type runid: int
+    :param co: Pointer to a Committer instance, generated with 'spits_committer_new'
+    :type co: Pointer
+    :param tasklist: The dict of generated tasks (see push_tasks)
+    :type tasklist: dict
+    :param completed: The dict of completed tasks (see commit_tasks)
+    :type completed: dict
+    :param memo_hits: List of (taskid, result) filled by the job manager
+    :type memo_hits: list
+    """
+    global co_counter_tasks_commited, co_counter_tasks_error
+
+    while len(memo_hits) > 0:
+        taskid, res = memo_hits.pop(0)
+        tasklist.pop(taskid, None)
+        if completed.get(taskid, (None, None))[0] != None:
+            continue
+
+        commit_start = time.monotonic()
+        r2 = job.spits_committer_commit_pit(co, res)
+        co_metric_commit_time.observe(time.monotonic() - commit_start)
+        if r2 != 0:
+            logger.error(f'The memoized task {taskid} was not successfully committed, committer returned {r2}')
+            co_counter_tasks_error += 1
+            co_metric_results_error.inc()
+        else:
+            co_counter_tasks_commited += 1
+            co_metric_tasks_commited.inc()
+
+        completed[taskid] = (0, r2)
+        if jm_journal is not None:
+            jm_journal.task_committed(runid, taskid, 0, r2, res)
 
 
 ###############################################################################
 # Job Manager routine
 ###############################################################################
-def jobmanager(argv: list, job: JobBinary, metrics: MetricManager, runid: int, jm: Pointer, tasklist: dict, completed: list) -> None:
+def jobmanager(argv: list, job: JobBinary, metrics: MetricManager, runid: int, jm: Pointer, tasklist: dict, completed: list,
+               memo_hits: list, resumed: JournalRun = None) -> None:
     """ Job Manager routine
 
     :param argv: Arguments from JobManager
@@ -887,10 +1255,15 @@ def jobmanager(argv: list, job: JobBinary, metrics: MetricManager, runid: int, j
     * [1]: The task
     :param completed: Variable indicating that all tasks were generated
     :type completed: list of bool
+    :param memo_hits: List that receives the (taskid, result) of tasks found in the memoization store
+    :type memo_hits: list
+    :param resumed: Progress of the run recovered from the journal, if resuming
+    :type resumed: JournalRun
     """
-    global jm_send_backoff, spits_running
+    global jm_send_backoff, spits_running, jm_gen_done
 
     logger.info('Job manager running...')
+    jm_gen_done = False
     memstat.stats()
 
     # Load the list of nodes to connect to
@@ -903,6 +1276,13 @@ def jobmanager(argv: list, job: JobBinary, metrics: MetricManager, runid: int, j
     taskid = 0
     task = None
 
+    # Tasks recovered from the journal that must be sent again
+    backlog = []
+    if resumed is not None:
+        taskid = fast_forward(job, metrics, runid, jm, resumed, tasklist, backlog)
+        if taskid is None:
+            abort('Could not resume the job manager from the journal!')
+
     while spits_running:
         # Reload the list of task managers at each
         # run so new tms can be added on the fly
@@ -933,7 +1313,8 @@ def jobmanager(argv: list, job: JobBinary, metrics: MetricManager, runid: int, j
 
                 # Task pushing loop. Send tasks to the task manager until its full
                 memstat.stats()
-                finished, taskid, task, sent = push_tasks(job, metrics, runid, jm, tm, taskid, task, tasklist, completed[0] == 1)
+                finished, taskid, task, sent = push_tasks(job, metrics, runid, jm, tm, taskid, task, tasklist, completed[0] == 1,
+                                                          backlog, memo_hits)
 
                 # Add the sent tasks to the submission list
                 submissions = submissions + sent
@@ -959,14 +1340,12 @@ def jobmanager(argv: list, job: JobBinary, metrics: MetricManager, runid: int, j
             # TODO: WARNING this will flood the system
             # with repeated tasks
             if finished and len(tasklist) > 0:
-                if len(submissions) == 0:
-                    logger.critical('The submission list is empty but the task list is not! Some tasks were lost!')
-
                 # Select the oldest task that is not already completed
-                while True:
+                submissions = [x for x in submissions if x[0] in tasklist]
+                if len(submissions) > 0:
                     taskid, task = submissions.pop(0)
-                    if taskid in tasklist:
-                        break
+                elif len(memo_hits) == 0:
+                    logger.critical('The submission list is empty but the task list is not! Some tasks were lost!')
 
         # Remove the committed tasks from the submission list
         submissions = [x for x in submissions if x[0] in tasklist]
@@ -978,16 +1357,22 @@ def jobmanager(argv: list, job: JobBinary, metrics: MetricManager, runid: int, j
 ###############################################################################
 # Committer routine
 ###############################################################################
-def committer(argv, job: JobBinary, metrics: MetricManager, runid, co, tasklist, completed):
+def committer(argv, job: JobBinary, metrics: MetricManager, runid, co, tasklist, completed, memo_hits, resumed=None):
     global spits_running
     logger.info('Committer running...')
     memstat.stats()
 
+    if resumed is not None:
+        replay_commits(job, metrics, co, resumed, completed)
+
     # Load the list of nodes to connect to
     tmlist = load_tm_list()
 
     # Result pulling loop
     while spits_running:
+        # Commit the results found in the memoization store
+        commit_memoized(job, metrics, runid, co, tasklist, completed, memo_hits)
+
         # Reload the list of task managers at each
         # run so new tms can be added on the fly
         #try:
@@ -1072,6 +1457,7 @@ def killtms():
 # msg_cd_query_metrics_list -- OK
 # msg_cd_query_metrics_last_values -- OK
 # msg_cd_query_metrics_history
+# msg_cd_query_metrics_since -- OK
 def server_callback(conn, addr, port, metrics: MetricManager):
     """ Server callback handler
 
@@ -1103,6 +1489,12 @@ def server_callback(conn, addr, port, metrics: MetricManager):
             metrics = json.dumps(metrics)
             conn.WriteString(metrics)
 
+        elif mtype == messaging.msg_cd_query_metrics_since:
+            serve_metrics_since(conn, metrics, jm_recv_timeout)
+
+        elif mtype == messaging.msg_cd_query_histograms:
+            serve_histograms(conn, metrics)
+
         elif mtype == messaging.msg_cd_nodes_append:
             # Format { "host": "xxx.xxx.xxx.xxx", "port": 0000 }
             node_string = conn.ReadString(jm_recv_timeout)
@@ -1143,11 +1535,27 @@ def run(argv, jobinfo, job: JobBinary, metrics: MetricManager, runid):
     # Keep an extra list of completed tasks
     completed = {0: 0}
 
+    # Results found in the memoization store, waiting to be committed
+    memo_hits = []
+
+    # Progress recovered from the journal
+    resumed = None
+    if jm_journal is not None and jm_resume:
+        resumed = jm_journal.get_run(runid)
+        if resumed is not None:
+            logger.info(f'Resuming job {runid} from journal {jm_journal_file}...')
+
+    # Tasks generated and not committed yet
+    jm_metric_tasks_pending.track(lambda: len(tasklist))
+
     # Start the Job Manager
     logger.info(f"Starting job manager {jm_name} for job {runid}...")
+    if jm_events is not None:
+        jm_events.record(EventLog.START, runid)
     # Create the job manager from the job module
     jm = job.spits_job_manager_new(argv, jobinfo)
-    jmthread = threading.Thread(target=jobmanager, args=(argv, job, metrics, runid, jm, tasklist, completed))
+    jmthread = threading.Thread(target=jobmanager, args=(argv, job, metrics, runid, jm, tasklist, completed, memo_hits,
+                                                         resumed), name='JobManager')
     jmthread.start()
     metrics.set_metric("jm_start_time", datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S.%f"))
 
@@ -1155,7 +1563,8 @@ def run(argv, jobinfo, job: JobBinary, metrics: MetricManager, runid):
     logger.info(f'Starting committer for job {runid}...')
     # Create the committer manager from the job module
     co = job.spits_committer_new(argv, jobinfo)
-    cothread = threading.Thread(target=committer, args=(argv, job, metrics, runid, co, tasklist, completed))
+    cothread = threading.Thread(target=committer, args=(argv, job, metrics, runid, co, tasklist, completed, memo_hits,
+                                                        resumed), name='Committer')
     cothread.start()
     metrics.set_metric("co_start_time", datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S.%f"))
 
@@ -1164,6 +1573,9 @@ def run(argv, jobinfo, job: JobBinary, metrics: MetricManager, runid):
     cothread.join()
     # server_listener.Join()
 
+    if jm_journal is not None:
+        jm_journal.sync()
+
     # Commit the job
     logger.info('Committing Job...')
     r, res, ctx = job.spits_committer_commit_job(co, 0x12345678)
@@ -1186,6 +1598,11 @@ def run(argv, jobinfo, job: JobBinary, metrics: MetricManager, runid):
         logger.error('Context verification failed for job!')
         return messaging.res_module_ctxer, None
 
+    # The run is complete, it is not resumed anymore
+    if jm_journal is not None:
+        jm_journal.run_finished(runid)
+        jm_journal.sync()
+
     logger.debug(f'Job {runid} finished successfully.')
 
     return r, res[0]
@@ -1197,7 +1614,11 @@ def run(argv, jobinfo, job: JobBinary, metrics: MetricManager, runid):
 def main(argv):
     # Print usage
     global spits_running, spits_binary, spits_binary_args, jm_verbosity, \
-        jm_log_file, metrics_file
+        jm_log_file, metrics_file, jm_journal, jm_memo, jm_tracer, \
+        jm_events, jm_metric_tasks_generated, jm_metric_tasks_sent, \
+        co_metric_results_error, co_metric_results_discarded, \
+        co_metric_tasks_commited, co_metric_tasks_replayed, \
+        jm_metric_tasks_pending, jm_metric_push_time, co_metric_commit_time
     parse_global_config(argv)
 
     # Setup logging
@@ -1213,14 +1634,56 @@ def main(argv):
     if jm_profiling:
         PerfModule(make_uid(), 0, jm_perf_rinterv, jm_perf_subsamp)
 
+    # Open the checkpoint journal
+    if jm_journal_file is not None:
+        try:
+            jm_journal = Journal(jm_journal_file, resume=jm_resume,
+                                 keep_results=jm_journal_results)
+        except ValueError as e:
+            abort(str(e))
+        # The committer state cannot be rebuilt without the results
+        missing = jm_journal.missing_results()
+        if missing > 0 and not jm_committer_persists:
+            abort(f'{missing} committed results were not kept in the '
+                  f'journal {jm_journal_file} (see --journal-results), the '
+                  f'job cannot be resumed unless the committer saves its own '
+                  f'state (--committer-persists)')
+
+    # Open the task lifecycle trace
+    if jm_trace_dir is not None:
+        jm_tracer = Tracer(jm_trace_dir, 'jobmanager')
+
+    # Open the binary event log
+    if jm_event_dir is not None:
+        jm_events = EventLog(jm_event_dir, 'jobmanager')
+
     # Load the module
     job = JobBinary(spits_binary, buffer_size=jm_spits_profile_buffer_size)
     metrics = MetricManager(job, buffer_size=10)
     job.metrics = Pointer(metrics.metric_manager)
 
+    # Counters are written to the metric buffers by the aggregator
+    aggregator = MetricAggregator(metrics)
+    jm_metric_tasks_generated = aggregator.counter("tasks_generated")
+    jm_metric_tasks_sent = aggregator.counter("tasks_sent")
+    co_metric_results_error = aggregator.counter("results_error")
+    co_metric_results_discarded = aggregator.counter("results_discarded")
+    co_metric_tasks_commited = aggregator.counter("tasks_commited")
+    co_metric_tasks_replayed = aggregator.counter("tasks_replayed")
+    jm_metric_tasks_pending = aggregator.gauge("tasks_pending")
+    jm_metric_push_time = aggregator.timer("push_time")
+    co_metric_commit_time = aggregator.timer("commit_time")
+    aggregator.start()
+
     # Remove JM arguments when passing to the module
     margv = [spits_binary] + spits_binary_args
 
+    # Open the memoization store
+    if jm_memo_dir is not None:
+        jm_memo = MemoStore(jm_memo_dir, spits_binary, spits_binary_args,
+                            jm_memo_size << 20)
+        jm_memo.register_metrics(aggregator)
+
     # Keep a run identifier
     runid = [0]
 
@@ -1234,13 +1697,16 @@ def main(argv):
 
     # Start the heartbeat
     def heartbeat_wrapper():
-        heartbeat(finished)
+        heartbeat(finished, aggregator)
 
-    threading.Thread(target=heartbeat_wrapper).start()
+    threading.Thread(target=heartbeat_wrapper, name='Heartbeat').start()
 
     # Start the server listener
     server_listener = Listener(
-        config.mode_tcp, '0.0.0.0', jm_port, server_callback, (metrics,))
+        config.mode_tcp, '0.0.0.0', jm_port, server_callback, (metrics,),
+        http_port=jm_metrics_port,
+        http_callback=None if jm_metrics_port is None else metrics_handler(
+            aggregator, dict(role='jobmanager', name=jm_name)))
     server_listener.Start()
 
     # Run the module
@@ -1257,6 +1723,8 @@ def main(argv):
     if jm_killtms:
         killtms()
 
+    aggregator.stop()
+
     if metrics_file is not None:
         with open(metrics_file, 'w') as f:
             metrics_final = metrics.get_metrics()
@@ -1264,6 +1732,16 @@ def main(argv):
 
     server_listener.Stop()
 
+    if jm_journal is not None:
+        jm_journal.close()
+
+    if jm_tracer is not None:
+        jm_tracer.close()
+
+    if jm_events is not None:
+        jm_events.record(EventLog.EXIT)
+        jm_events.close()
+
     # Print final memory report
     memstat.stats()
 
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Otávio Napoli <otavio.napoli@gmail.com>
+# Copyright (c) 2020 Edson Borin <edson@ic.unicamp.br>
+# Copyright (c) 2015 Caian Benedicto <caian@ggaunicamp.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import threading
+
+
+class BufferArena(object):
+    """Pool of reusable buffers grouped in power of two size classes.
+
+    Buffers are bytearrays, so they can be wrapped by ctypes (from_buffer)
+    and sent through sockets without copies. Returning a buffer with
+    release() is optional, buffers not returned are garbage collected.
+    """
+
+    def __init__(self, min_size=4096, max_size=64 << 20, max_free=8):
+        """
+        :param min_size: Smallest size class
+        :type min_size: int
+        :param max_size: Largest size class, larger buffers are not reused
+        :type max_size: int
+        :param max_free: Maximum free buffers kept per size class
+        :type max_free: int
+        """
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_free = max_free
+        self._free = {}
+        self._lock = threading.Lock()
+
+    def size_class(self, size):
+        if size <= self.min_size:
+            return self.min_size
+        return 1 << (size - 1).bit_length()
+
+    def acquire(self, size):
+        """ Get a buffer with at least size bytes
+
+        :rtype: bytearray
+        """
+        sc = self.size_class(size)
+        if sc > self.max_size:
+            return bytearray(size)
+        with self._lock:
+            free = self._free.get(sc)
+            if free:
+                return free.pop()
+        return bytearray(sc)
+
+    def release(self, buf):
+        """ Return a buffer (or a memoryview of it) to the arena. It must not
+        be used after this call
+        """
+        if isinstance(buf, memoryview):
+            buf = buf.obj
+        if not isinstance(buf, bytearray):
+            return
+        sc = len(buf)
+        if sc > self.max_size or sc != self.size_class(sc):
+            return
+        with self._lock:
+            free = self._free.setdefault(sc, [])
+            if len(free) < self.max_free:
+                free.append(buf)
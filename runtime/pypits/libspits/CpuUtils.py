@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Otávio Napoli <otavio.napoli@gmail.com>
+# Copyright (c) 2020 Edson Borin <edson@ic.unicamp.br>
+# Copyright (c) 2015 Caian Benedicto <caian@ggaunicamp.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import math
+import multiprocessing
+import os
+import threading
+
+
+def cgroup_dirs():
+    """ List the cgroup v2 directories of this process, from the innermost
+    to the root of the hierarchy
+
+    :rtype: list of str
+    """
+    dirs = []
+    try:
+        with open('/proc/self/cgroup') as f:
+            for line in f:
+                if line.startswith('0::'):
+                    path = line[3:].strip().strip('/')
+                    break
+            else:
+                return dirs
+    except OSError:
+        return dirs
+    parts = path.split('/') if path else []
+    for i in range(len(parts), -1, -1):
+        d = os.path.join('/sys/fs/cgroup', *parts[:i])
+        if os.path.isdir(d):
+            dirs.append(d)
+    return dirs
+
+
+def cgroup_cpu_quota():
+    """ Return the CPU quota (in CPUs) from the cgroup v2 cpu.max files of
+    this process, or None when it is not limited
+
+    :rtype: float
+    """
+    quota = None
+    for d in cgroup_dirs():
+        try:
+            with open(os.path.join(d, 'cpu.max')) as f:
+                q, p = f.read().split()[:2]
+        except (OSError, ValueError):
+            continue
+        if q == 'max':
+            continue
+        q = int(q) / int(p)
+        quota = q if quota is None else min(quota, q)
+    return quota
+
+
+def available_cpus():
+    """ Number of CPUs this process can really use, considering its affinity
+    mask and its cgroup CPU quota (and not only the host cores, as
+    multiprocessing.cpu_count() does)
+
+    :rtype: int
+    """
+    try:
+        n = len(os.sched_getaffinity(0))
+    except AttributeError:
+        n = multiprocessing.cpu_count()
+    quota = cgroup_cpu_quota()
+    if quota is not None:
+        n = min(n, max(1, math.ceil(quota)))
+    return n
+
+
+def cpu_pressure():
+    """ Return the percentage of time in the last 10 seconds some task waited
+    for a CPU (PSI avg10 of the cgroup, or of the system), or None when
+    pressure stall information is not available
+
+    :rtype: float
+    """
+    files = [os.path.join(d, 'cpu.pressure') for d in cgroup_dirs()[:1]]
+    files.append('/proc/pressure/cpu')
+    for fname in files:
+        try:
+            with open(fname) as f:
+                for line in f:
+                    if line.startswith('some'):
+                        for field in line.split()[1:]:
+                            k, v = field.split('=')
+                            if k == 'avg10':
+                                return float(v)
+        except (OSError, ValueError):
+            continue
+    return None
+
+
+def parse_cpulist(text):
+    """ Parse a kernel CPU list such as '0-3,8-11'
+
+    :rtype: list of int
+    """
+    cpus = []
+    for item in text.strip().split(','):
+        if not item:
+            continue
+        if '-' in item:
+            first, last = item.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(item))
+    return cpus
+
+
+def numa_nodes():
+    """ Read the NUMA topology from /sys/devices/system/node, keeping only the
+    CPUs in the affinity mask of this process. Without NUMA information all
+    CPUs are placed in node 0
+
+    :return: The CPUs of each node with at least one usable CPU
+    :rtype: dict of int to list of int
+    """
+    try:
+        allowed = os.sched_getaffinity(0)
+    except AttributeError:
+        allowed = set(range(multiprocessing.cpu_count()))
+    nodes = {}
+    basedir = '/sys/devices/system/node'
+    try:
+        names = os.listdir(basedir)
+    except OSError:
+        names = []
+    for name in names:
+        if not name.startswith('node') or not name[4:].isdigit():
+            continue
+        try:
+            with open(os.path.join(basedir, name, 'cpulist')) as f:
+                cpus = [c for c in parse_cpulist(f.read()) if c in allowed]
+        except (OSError, ValueError):
+            continue
+        if cpus:
+            nodes[int(name[4:])] = cpus
+    if not nodes:
+        nodes[0] = sorted(allowed)
+    return nodes
+
+
+affinity_policies = ['none', 'packed', 'spread', 'node']
+
+
+def worker_cpusets(nworkers, policy):
+    """ Compute the CPUs each worker is pinned to
+
+    packed: one CPU per worker, filling a NUMA node before the next one
+    spread: one CPU per worker, alternating between NUMA nodes
+    node: all the CPUs of a NUMA node, nodes assigned round robin
+
+    :param nworkers: Number of workers
+    :type nworkers: int
+    :param policy: One of affinity_policies
+    :type policy: str
+    :return: The CPU set of each worker, or None when not pinning
+    :rtype: list of set of int
+    """
+    if policy is None or policy == 'none':
+        return None
+    nodes = numa_nodes()
+    nodes = [nodes[n] for n in sorted(nodes)]
+    if policy == 'node':
+        return [set(nodes[i % len(nodes)]) for i in range(nworkers)]
+    if policy == 'packed':
+        cpus = [c for node in nodes for c in node]
+    elif policy == 'spread':
+        cpus = []
+        for i in range(max(len(node) for node in nodes)):
+            cpus.extend(node[i] for node in nodes if i < len(node))
+    else:
+        raise ValueError(f'Unknown affinity policy {policy}')
+    return [{cpus[i % len(cpus)]} for i in range(nworkers)]
+
+
+def pin_thread(cpus):
+    """ Pin the calling thread to a set of CPUs
+
+    :param cpus: CPUs the thread may run on
+    :type cpus: set of int
+    """
+    os.sched_setaffinity(threading.get_native_id(), cpus)
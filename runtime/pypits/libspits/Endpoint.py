@@ -42,6 +42,11 @@ class Endpoint(object):
     def WriteInt64(self, value):
         self.Write(struct.pack('!q', value))
 
+    def WriteInt64s(self, *values):
+        # A single write, so the peer does not wait for the rest of a
+        # message held back by the Nagle algorithm
+        self.Write(struct.pack(f'!{len(values)}q', *values))
+
     def ReadString(self, timeout):
         sz = struct.unpack('!I', self.Read(4, timeout))[0]
         if sz > 0:
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Otávio Napoli <otavio.napoli@gmail.com>
+# Copyright (c) 2020 Edson Borin <edson@ic.unicamp.br>
+# Copyright (c) 2015 Caian Benedicto <caian@ggaunicamp.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import collections
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+
+from .Trace import Tracer
+
+# Event log files start with a header (magic, version, size of the JSON
+# description of the process and the description) followed by records of
+# 32 bytes:
+#
+# event   ts:i64 task:i64 arg:i64 event:u16 flags:u16 thread:u32
+# name    ts:i64 name:16s event:u16 flags:u16 thread:u32
+#
+# Timestamps are nanoseconds since the epoch and thread is the native id
+# of the thread. A name record (event 0xFFFF) precedes the first event of
+# each thread and holds the first 16 bytes of its name.
+
+_magic = b'SPEV'
+_header = struct.Struct('<4sBH')
+_record = struct.Struct('<qqqHHI')
+_name = struct.Struct('<q16sHHI')
+
+RECORD_SIZE = _record.size
+
+
+class EventLog(object):
+    """Fixed-size binary records of task lifecycle, connection and queue
+    events.
+
+    record() only appends to a queue, a background thread packs the records
+    and writes them to the file every interval seconds.
+    """
+
+    # Task lifecycle (same codes of the Tracer stages), task is the task id
+    GENERATED = Tracer.GENERATED
+    SENT = Tracer.SENT
+    RECEIVED = Tracer.RECEIVED
+    DEQUEUED = Tracer.DEQUEUED
+    RUN_START = Tracer.RUN_START
+    RUN_END = Tracer.RUN_END
+    ENQUEUED = Tracer.ENQUEUED
+    PULLED = Tracer.PULLED
+    COMMITTED = Tracer.COMMITTED
+    # Process and threads
+    START = 16          # Job or task manager started its workers
+    WORKER_INIT = 17    # Worker thread initializing
+    KILL = 18           # Task manager received a kill signal
+    EXIT = 19           # Job or task manager exiting
+    # Connections, task is the message type and arg the peer port
+    CONN_OPEN = 32
+    CONN_CLOSE = 33
+    # Queue depths, task is the number of queued tasks and arg the number
+    # of queued results
+    QUEUE = 48
+
+    NAME = 0xFFFF
+
+    events = {
+        GENERATED: 'generated', SENT: 'sent', RECEIVED: 'received',
+        DEQUEUED: 'dequeued', RUN_START: 'run start', RUN_END: 'run end',
+        ENQUEUED: 'enqueued', PULLED: 'pulled', COMMITTED: 'committed',
+        START: 'start', WORKER_INIT: 'worker init', KILL: 'kill', EXIT: 'exit',
+        CONN_OPEN: 'connection open', CONN_CLOSE: 'connection close',
+        QUEUE: 'queue'
+    }
+
+    def __init__(self, dirname, role, name=None, interval=0.5):
+        """
+        :param dirname: Directory of the event log
+        :type dirname: str
+        :param role: jobmanager or taskmanager
+        :type role: str
+        :param name: Name of the process, also the file name
+        :type name: str
+        :param interval: Seconds between writes to the file
+        :type interval: float
+        """
+        self.name = name or f'{role}-{socket.gethostname()}-{os.getpid()}'
+        self.filename = os.path.join(dirname, self.name + '.events')
+        self.interval = interval
+        self.pending = collections.deque()
+        self.named = set()
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        os.makedirs(dirname, exist_ok=True)
+        self.file = open(self.filename, 'wb')
+        info = json.dumps(dict(name=self.name, role=role, pid=os.getpid(),
+            host=socket.gethostname())).encode('utf8')
+        self.file.write(_header.pack(_magic, 1, len(info)))
+        self.file.write(info)
+        self.thread = threading.Thread(target=self.run, name='EventLog-flush')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record(self, event, task=0, arg=0):
+        """ Record an event in the current thread """
+        tid = threading.get_native_id()
+        if tid not in self.named:
+            self.named.add(tid)
+            self.pending.append((time.time_ns(), threading.current_thread()
+                .name.encode('utf8')[:16], self.NAME, tid))
+        self.pending.append((time.time_ns(), task, arg, event, tid))
+
+    def flush(self):
+        with self.lock:
+            if self.file.closed:
+                return
+            data = bytearray()
+            pending = self.pending
+            while pending:
+                item = pending.popleft()
+                if len(item) == 4:
+                    ts, name, event, tid = item
+                    data += _name.pack(ts, name, event, 0, tid)
+                else:
+                    ts, task, arg, event, tid = item
+                    data += _record.pack(ts, task, arg, event, 0, tid)
+            if data:
+                self.file.write(data)
+                self.file.flush()
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            try:
+                self.flush()
+            except:
+                logging.debug('Error writing the event log', exc_info=True)
+
+    def close(self):
+        self.done.set()
+        self.thread.join()
+        self.flush()
+        with self.lock:
+            self.file.close()
+
+
+class EventLogReader(object):
+    """Read the records of an event log file, whole or in ranges of
+    records, so large logs can be read in parallel."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            magic, version, size = _header.unpack(f.read(_header.size))
+            if magic != _magic:
+                raise ValueError(f'{filename} is not an event log')
+            self.info = json.loads(f.read(size).decode('utf8'))
+        self.offset = _header.size + size
+        # A record being written when the process died is ignored
+        self.count = (os.path.getsize(filename) - self.offset) // RECORD_SIZE
+
+    def records(self, first=0, last=None):
+        """ Iterate over the records [first, last) as (ts, event, task, arg,
+        thread). The task of a name record is the name of the thread
+        """
+        last = self.count if last is None else min(last, self.count)
+        if first >= last:
+            return
+        with open(self.filename, 'rb') as f:
+            f.seek(self.offset + first * RECORD_SIZE)
+            # Read blocks of 64K records
+            for block in range(first, last, 65536):
+                data = f.read(min(65536, last - block) * RECORD_SIZE)
+                for i, (ts, task, arg, event, flags, tid) in \
+                        enumerate(_record.iter_unpack(data)):
+                    if event == EventLog.NAME:
+                        pos = i * RECORD_SIZE + 8
+                        task = data[pos:pos + 16].rstrip(b'\0') \
+                            .decode('utf8', 'replace')
+                    yield ts, event, task, arg, tid
+
+    def thread_names(self):
+        """ Names of the threads by native id """
+        return {tid: task for ts, event, task, arg, tid in self.records()
+                if event == EventLog.NAME}
+
+
+def read_events(filename):
+    """ Read a whole event log
+
+    :return: The process description, the names of the threads by native id
+        and the list of events as (ts, event, task, arg, thread)
+    :rtype: tuple
+    """
+    reader = EventLogReader(filename)
+    names = {}
+    events = []
+    for record in reader.records():
+        if record[1] == EventLog.NAME:
+            names[record[4]] = record[2]
+        else:
+            events.append(record)
+    return reader.info, names, events
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Otávio Napoli <otavio.napoli@gmail.com>
+# Copyright (c) 2020 Edson Borin <edson@ic.unicamp.br>
+# Copyright (c) 2015 Caian Benedicto <caian@ggaunicamp.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import json
+
+
+class Histogram(object):
+    """Log-linear (HDR style) histogram of non-negative values.
+
+    Values are recorded as integer multiples of unit. Integers smaller than
+    2 ** bits have a bucket each, larger ones share buckets with a width of
+    1 / 2 ** (bits - 1) of their power of two, so the relative error is
+    bounded whatever the range. Only non-empty buckets are stored, and
+    histograms with the same unit and bits can be merged.
+    """
+
+    def __init__(self, unit=1e-6, bits=5):
+        """
+        :param unit: Resolution of the recorded values (the default records
+            seconds with microsecond resolution)
+        :type unit: float
+        :param bits: Bits of the linear part of the buckets, relative error
+            is below 1 / 2 ** (bits - 1)
+        :type bits: int
+        """
+        self.unit = unit
+        self.bits = bits
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def index(self, value):
+        """ Bucket of an integer value """
+        size = 1 << self.bits
+        if value < size:
+            return value
+        shift = value.bit_length() - self.bits
+        half = size >> 1
+        return size + (shift - 1) * half + (value >> shift) - half
+
+    def bucket(self, index):
+        """ Lowest and highest integer values of a bucket """
+        size = 1 << self.bits
+        if index < size:
+            return index, index
+        half = size >> 1
+        shift = (index - size) // half + 1
+        mantissa = (index - size) % half + half
+        return mantissa << shift, ((mantissa + 1) << shift) - 1
+
+    def record(self, value, count=1):
+        """ Record value (in the same units of the histogram, e.g. seconds)
+        count times """
+        v = max(0, int(value / self.unit + 0.5))
+        i = self.index(v)
+        self.counts[i] = self.counts.get(i, 0) + count
+        self.count += count
+        self.total += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """ Add the values recorded by other to this histogram
+
+        :type other: Histogram
+        :rtype: Histogram
+        """
+        if other.count == 0:
+            return self
+        if (other.unit, other.bits) != (self.unit, self.bits):
+            raise ValueError('Histograms with different units or bits '
+                             'cannot be merged')
+        for i, n in list(other.counts.items()):
+            self.counts[i] = self.counts.get(i, 0) + n
+        self.count += other.count
+        self.total += other.total
+        if self.min is None or (other.min is not None and other.min < self.min):
+            self.min = other.min
+        if self.max is None or (other.max is not None and other.max > self.max):
+            self.max = other.max
+        return self
+
+    def copy(self):
+        return Histogram(self.unit, self.bits).merge(self)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def percentile(self, q):
+        """ Value below which q percent of the values are, None if the
+        histogram is empty. The highest value of the bucket is returned, so
+        the error is at most the width of the bucket """
+        if self.count == 0:
+            return None
+        rank = max(1, int(self.count * q / 100.0 + 0.5))
+        seen = 0
+        for i in sorted(self.counts):
+            seen += self.counts[i]
+            if seen >= rank:
+                return min(self.bucket(i)[1] * self.unit, self.max)
+        return self.max
+
+    def buckets(self):
+        """ Non-empty buckets as (lowest value, highest value, count) """
+        for i in sorted(self.counts):
+            low, high = self.bucket(i)
+            yield low * self.unit, high * self.unit, self.counts[i]
+
+    def cumulative(self, bounds):
+        """ Cumulative counts of the values up to each bound (the last
+        element counts all values). A bucket is counted in the first bound
+        not below its highest value """
+        counts = [0] * (len(bounds) + 1)
+        for low, high, n in self.buckets():
+            for j, bound in enumerate(bounds):
+                if high <= bound:
+                    counts[j] += n
+                    break
+            else:
+                counts[-1] += n
+        for j in range(1, len(counts)):
+            counts[j] += counts[j - 1]
+        return counts
+
+    def to_dict(self):
+        return dict(unit=self.unit, bits=self.bits, count=self.count,
+                    sum=self.total, min=self.min, max=self.max,
+                    counts=[[i, n] for i, n in sorted(self.counts.items())])
+
+    @staticmethod
+    def from_dict(d):
+        h = Histogram(d['unit'], d['bits'])
+        h.counts = {i: n for i, n in d['counts']}
+        h.count = d['count']
+        h.total = d['sum']
+        h.min = d['min']
+        h.max = d['max']
+        return h
+
+
+def serve_histograms(conn, metrics):
+    """ Answer a msg_cd_query_histograms with the histograms of the
+    MetricManager as JSON """
+    conn.WriteString(json.dumps(metrics.get_histograms()))
+
+
+def query_histograms(conn, timeout):
+    """ Query the histograms of a job or task manager through an open
+    connection (after the job id handshake)
+
+    :return: Histograms by name
+    :rtype: dict
+    """
+    from .messaging import msg_cd_query_histograms
+    conn.WriteInt64(msg_cd_query_histograms)
+    data = json.loads(conn.ReadString(timeout))
+    return {name: Histogram.from_dict(d) for name, d in data.items()}
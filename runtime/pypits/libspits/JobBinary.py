@@ -24,13 +24,14 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
-import struct
 import ctypes
 import os
 import base64
+import threading
 
 from typing import Union
 from libspits import Blob, Pointer
+from libspits.BufferArena import BufferArena
 
 
 # TODO try-except around C calls
@@ -40,6 +41,50 @@ class MethodNotFound(Exception):
     pass
 
 
+class PushSlot(object):
+    """Reusable push callback. The data pushed by the binary is kept in
+    the slot until taken, so no closure or ctypes thunk is created per call"""
+
+    def __init__(self, job):
+        self.job = job
+        self.busy = False
+        self.out = None
+        self.data = None
+        self.ctx = None
+        self.pushed = False
+        self.many = None
+        self.thunk = job.cpusher(self.push)
+
+    def push(self, cdata, cdatasz, ctx):
+        data = self.job.to_py_array(cdata, cdatasz, self.out)
+        if self.many is not None:
+            # Batch calls push once per task
+            self.many[ctx] = data
+            return
+        self.data = data
+        self.ctx = ctx
+        self.pushed = True
+
+    def take_many(self):
+        """ Return the data pushed by a batch call, by context, and clear
+        the slot
+        """
+        many = self.many
+        self.many = self.out = None
+        self.busy = False
+        return many
+
+    def take(self, r):
+        """ Build the [return code, (data,), context] result and clear the
+        slot
+        """
+        res = [r, (self.data,) if self.pushed else None, self.ctx]
+        self.out = self.data = self.ctx = None
+        self.pushed = False
+        self.busy = False
+        return res
+
+
 class JobBinary(object):
     """Class binding for the external job binary loaded by spits"""
 
@@ -157,7 +202,59 @@ class JobBinary(object):
             ctypes.c_void_p
         ])
 
+        # Batch methods are optional, the runtime falls back to the single
+        # task methods when the binary does not export them
+
+        self.has_next_tasks = self.try_init_optional_method(
+            'spits_job_manager_next_tasks', ctypes.c_longlong, [
+                ctypes.c_void_p,
+                self.cpusher,
+                ctypes.POINTER(c_context),
+                ctypes.c_longlong
+            ])
+
+        self.has_run_batch = self.try_init_optional_method(
+            'spits_worker_run_batch', ctypes.c_int, [
+                ctypes.c_void_p,
+                ctypes.POINTER(ctypes.c_void_p),
+                ctypes.POINTER(ctypes.c_longlong),
+                ctypes.c_longlong,
+                self.cpusher,
+                ctypes.POINTER(c_context),
+                ctypes.POINTER(ctypes.c_int)
+            ])
+
+        self.has_commit_pits = self.try_init_optional_method(
+            'spits_committer_commit_pits', ctypes.c_int, [
+                ctypes.c_void_p,
+                ctypes.POINTER(ctypes.c_void_p),
+                ctypes.POINTER(ctypes.c_longlong),
+                ctypes.c_longlong,
+                ctypes.POINTER(ctypes.c_int)
+            ])
+
         self.metrics = None
+        # Buffers for results, see spits_worker_run
+        self.arena = BufferArena()
+        self._local = threading.local()
+
+    def push_slot(self, out=None):
+        """ Get the push slot of the calling thread, or a new one if it is
+        in use (nested calls)
+
+        :param out: Routine returning the buffer for the pushed data, see
+            to_py_array
+        :type out: method(int)
+        :rtype: PushSlot
+        """
+        slot = getattr(self._local, 'slot', None)
+        if slot is None:
+            slot = self._local.slot = PushSlot(self)
+        elif slot.busy:
+            slot = PushSlot(self)
+        slot.busy = True
+        slot.out = out
+        return slot
 
     def try_init_method(self, name: str, restype, argtypes):
         """Set the specified format for a method in the module,
@@ -168,6 +265,37 @@ class JobBinary(object):
         method.restype = restype
         method.argtypes = argtypes
 
+    def try_init_optional_method(self, name: str, restype, argtypes):
+        """Same as try_init_method, but return False instead of raising
+        when the method does not exist"""
+        try:
+            self.try_init_method(name, restype, argtypes)
+        except MethodNotFound:
+            return False
+        return True
+
+    def c_array_list(self, items):
+        """ Get arrays of pointers and sizes to pass a list of buffers to the
+        binary. The returned keep list must be alive during the call
+
+        :rtype: tuple
+        """
+        count = len(items)
+        cptrs = (ctypes.c_void_p * count)()
+        csizes = (ctypes.c_longlong * count)()
+        keep = []
+        for i, it in enumerate(items):
+            cit, citsz = self.to_c_array(it)
+            keep.append(cit)
+            if isinstance(cit, bytes):
+                cptrs[i] = ctypes.cast(ctypes.c_char_p(cit), ctypes.c_void_p)
+            elif isinstance(cit, ctypes.c_void_p):
+                cptrs[i] = cit
+            else:
+                cptrs[i] = ctypes.addressof(cit)
+            csizes[i] = getattr(citsz, "value", citsz)
+        return cptrs, csizes, keep
+
     def c_argv(self, argv):
         # Encode the string to byte array
         argv = [x.encode('utf8') for x in argv]
@@ -178,35 +306,46 @@ class JobBinary(object):
         cargv[:] = argv
         return cargc, cargv
 
-    def bytes(self, it):
-        try:
-            if bytes != str:
-                return bytes(it)
-        except:
-            pass
-        return struct.pack('%db' % len(it), *it)
-
-    def unbyte(self, s):
-        try:
-            if bytes != str:
-                return s
-        except:
-            pass
-        return struct.unpack('%db' % len(s), s)
-
     def to_c_array(self, it):
+        """ Get a pointer and size to pass a buffer to the binary. The
+        interface takes const pointers, so bytes are passed as they are and
+        writable buffers (bytearray, mmap, memoryview...) are wrapped without
+        copying. Only read-only buffers other than bytes are copied
+
+        :param it: The buffer
+        :type it: bytes-like object
+        :rtype: tuple
+        """
         # Cover the case where an empty array or list is passed
-        if it == None or len(it) == 0:
+        if it is None or len(it) == 0:
             return ctypes.c_void_p(None), 0
-        # Normal C allocation
-        cit = (ctypes.c_byte * len(it))()
-        cit[:] = self.unbyte(it)
-        citsz = ctypes.c_longlong(len(it))
-        return cit, citsz
-
-    def to_py_array(self, v, sz):
-        v = ctypes.cast(v, ctypes.POINTER(ctypes.c_byte))
-        return self.bytes(v[0:sz])
+        if isinstance(it, bytes):
+            return it, ctypes.c_longlong(len(it))
+        view = memoryview(it).cast('B')
+        if view.readonly:
+            cit = (ctypes.c_byte * len(view)).from_buffer_copy(view)
+        else:
+            cit = (ctypes.c_byte * len(view)).from_buffer(view)
+        return cit, ctypes.c_longlong(len(view))
+
+    def to_py_array(self, v, sz, out=None):
+        """ Copy a buffer owned by the binary, which is only valid during
+        the push callback
+
+        :param v: Pointer to the buffer
+        :param sz: Size of the buffer
+        :type sz: int
+        :param out: Routine called with the size and returning a writable
+            buffer to copy the data into, instead of creating a bytes object
+        :type out: method(int)
+        :return: The bytes, or a memoryview of the buffer returned by out
+        """
+        if out is None:
+            return ctypes.string_at(v, sz) if sz > 0 else b''
+        view = memoryview(out(sz)).cast('B')[:sz]
+        if sz > 0:
+            ctypes.memmove((ctypes.c_byte * sz).from_buffer(view), v, sz)
+        return view
 
     def spits_main(self, argv, runner):
         # Call the runner if the job does not have an initializer
@@ -230,9 +369,11 @@ class JobBinary(object):
                 data[0] = None
                 size[0] = 0
             else:
-                cdata = (ctypes.c_byte * len(pdata))()
-                cdata[:] = self.unbyte(pdata)
-                data[0] = ctypes.cast(cdata, ctypes.c_void_p)
+                # The binary may use the data after the runner returns,
+                # keep it alive
+                self._rundata = (ctypes.c_byte * len(pdata)).from_buffer_copy(
+                    pdata)
+                data[0] = ctypes.cast(self._rundata, ctypes.c_void_p)
                 size[0] = len(pdata)
 
             return r
@@ -266,31 +407,50 @@ class JobBinary(object):
         * [2]: The task context
         :rtype: tuple
         """
-        res = [None, None, None]
         # Get the native pointer to the user data
         p_user_data = user_data.get_value()
 
-        # Create an inner converter for the callback
-        def push(ctask, ctasksz, ctx):
-            """ Task pusher callback. This function is called when a new task is generated and pushed from the JM binary
-            The result is placed in the 'res' variable
-
-            :param ctask: Generated Task
-            :type ctask: Pointer
-            :param ctasksz: Size of the task
-            :type ctasksz: int
-            :param ctx: Actual task context
-            :type ctx: Pointer
-            """
-            # Thanks to python closures, the context is not
-            # necessary, in any case, check for correctness
-            res[1] = (self.to_py_array(ctask, ctasksz),)
-            res[2] = ctx
+        # The task pushed by the binary is stored in the slot
+        slot = self.push_slot()
 
         # Get the next task
-        res[0] = self.module.spits_job_manager_next_task(p_user_data, self.cpusher(push), jmctx)
+        r = self.module.spits_job_manager_next_task(p_user_data, slot.thunk, jmctx)
         # Return the pushed data along with the return code of the method
-        return res
+        return slot.take(r)
+
+    def spits_job_manager_next_tasks(self, user_data: Pointer, jmctxs: list) -> list:
+        """ Generate up to len(jmctxs) tasks with a single call when the
+        binary exports spits_job_manager_next_tasks, otherwise call
+        spits_job_manager_next_task for each context
+
+        :param user_data: Ctype Pointer to the Job Manager instance
+        :type user_data: Pointer
+        :param jmctxs: Task contexts (task IDs), one per task
+        :type jmctxs: list of int
+        :return: The generated tasks, in order, as (context, task) tuples. The
+            task is None if it was not pushed. Fewer tasks than contexts are
+            returned when there are no more tasks
+        :rtype: list
+        """
+        if not self.has_next_tasks:
+            tasks = []
+            for jmctx in jmctxs:
+                r, task, ctx = self.spits_job_manager_next_task(user_data, jmctx)
+                if r == 0:
+                    break
+                tasks.append((jmctx, None if task is None or ctx != jmctx
+                              else task[0]))
+            return tasks
+
+        p_user_data = user_data.get_value()
+        count = len(jmctxs)
+        cctxs = (ctypes.c_void_p * count)(*jmctxs)
+        slot = self.push_slot()
+        slot.many = {}
+        n = self.module.spits_job_manager_next_tasks(p_user_data, slot.thunk,
+                                                     cctxs, count)
+        pushed = slot.take_many()
+        return [(jmctx, pushed.get(jmctx)) for jmctx in jmctxs[:n]]
 
     def spits_job_manager_finalize(self, user_data: Pointer):
         # Get the native pointer to the user data
@@ -309,25 +469,59 @@ class JobBinary(object):
         return Pointer(self.module.spits_worker_new(
             cargc, cargv, self.metrics.get_value()))
 
-    def spits_worker_run(self, user_data, task, taskctx):
-        res = [None, None, None]
+    def spits_worker_run(self, user_data, task, taskctx, out=None):
+        """ Run a task
+
+        :param out: Routine called with the result size and returning a
+            writable buffer where the result is copied to, see to_py_array.
+            Use self.arena.acquire to reuse buffers, returning them with
+            self.arena.release when the result is no longer needed
+        :type out: method(int)
+        """
         # Get the native pointer to the user data
         p_user_data = user_data.get_value()
         # Create the pointer to task and task size
         ctask, ctasksz = self.to_c_array(task)
 
-        # Create an inner converter for the callback
-        def push(cres, cressz, ctx):
-            # Thanks to python closures, the context is not
-            # necessary, in any case, check for correctness
-            res[1] = (self.to_py_array(cres, cressz),)
-            res[2] = ctx
+        # The result pushed by the binary is stored in the slot
+        slot = self.push_slot(out)
 
         # Run the task
-        res[0] = self.module.spits_worker_run(p_user_data, ctask,
-                                              ctasksz, self.cpusher(push), taskctx)
+        r = self.module.spits_worker_run(p_user_data, ctask,
+                                         ctasksz, slot.thunk, taskctx)
         # Return the pushed data along with the return code of the method
-        return res
+        return slot.take(r)
+
+    def spits_worker_run_batch(self, user_data, tasks, taskctxs, out=None):
+        """ Run many tasks with a single call when the binary exports
+        spits_worker_run_batch, otherwise call spits_worker_run for each task
+
+        :param tasks: The tasks
+        :type tasks: list
+        :param taskctxs: Task contexts (task IDs), one per task and unique
+        :type taskctxs: list of int
+        :param out: See spits_worker_run
+        :type out: method(int)
+        :return: One [return code, (result,), context] list per task, as
+            returned by spits_worker_run
+        :rtype: list
+        """
+        if not self.has_run_batch:
+            return [self.spits_worker_run(user_data, task, taskctx, out)
+                    for task, taskctx in zip(tasks, taskctxs)]
+
+        p_user_data = user_data.get_value()
+        count = len(tasks)
+        ctasks, ctaskszs, keep = self.c_array_list(tasks)
+        cctxs = (ctypes.c_void_p * count)(*taskctxs)
+        crets = (ctypes.c_int * count)()
+        slot = self.push_slot(out)
+        slot.many = {}
+        self.module.spits_worker_run_batch(p_user_data, ctasks, ctaskszs,
+                                           count, slot.thunk, cctxs, crets)
+        pushed = slot.take_many()
+        return [[crets[i], (pushed[ctx],) if ctx in pushed else None, ctx]
+                for i, ctx in enumerate(taskctxs)]
 
     def spits_worker_finalize(self, user_data):
         # Get the native pointer to the user data
@@ -354,23 +548,40 @@ class JobBinary(object):
         p_user_data = user_data.get_value()
         return self.module.spits_committer_commit_pit(p_user_data, cres, cressz)
 
+    def spits_committer_commit_pits(self, user_data, results):
+        """ Commit many results with a single call when the binary exports
+        spits_committer_commit_pits, otherwise call spits_committer_commit_pit
+        for each result
+
+        :param results: The results
+        :type results: list
+        :return: The return code of each commit
+        :rtype: list of int
+        """
+        if not self.has_commit_pits:
+            return [self.spits_committer_commit_pit(user_data, result)
+                    for result in results]
+
+        p_user_data = user_data.get_value()
+        count = len(results)
+        cres, cresszs, keep = self.c_array_list(results)
+        crets = (ctypes.c_int * count)()
+        self.module.spits_committer_commit_pits(p_user_data, cres, cresszs,
+                                                count, crets)
+        return list(crets)
+
     def spits_committer_commit_job(self, user_data, jobctx):
-        fres = [None, None, None]
         # Get the native pointer to the user data
         p_user_data = user_data.get_value()
 
-        # Create an inner converter for the callback
-        def push(cfres, cfressz, ctx):
-            # Thanks to python closures, the context is not
-            # necessary, in any case, check for correctness
-            fres[1] = (self.to_py_array(cfres, cfressz),)
-            fres[2] = ctx
+        # The final result pushed by the binary is stored in the slot
+        slot = self.push_slot()
 
         # Commit job and get the final result
-        fres[0] = self.module.spits_committer_commit_job(p_user_data,
-                                                         self.cpusher(push), jobctx)
+        r = self.module.spits_committer_commit_job(p_user_data,
+                                                   slot.thunk, jobctx)
         # Return the pushed data along with the return code of the method
-        return fres
+        return slot.take(r)
 
     def spits_committer_finalize(self, user_data):
         # Get the native pointer to the user data
@@ -464,8 +675,14 @@ class MetricManager:
             ctypes.POINTER(ctypes.c_uint)])
         self.job_binary.try_init_method('spits_free_metrics_history',
             None, [ctypes.POINTER(buffer_metrics), ctypes.c_uint])
+        self.has_since = self.job_binary.try_init_optional_method(
+            'spits_get_metrics_since', ctypes.POINTER(buffer_metrics),
+            [ctypes.c_void_p, ctypes.c_uint, ctypes.POINTER(ctypes.c_char_p),
+            ctypes.POINTER(ctypes.c_longlong)])
 
         self.metric_manager = self.job_binary.module.spits_metrics_new(buffer_size)
+        # MetricAggregator flushed before the buffers are read
+        self.aggregator = None
 
     def __del__(self):
         self.job_binary.module.spits_metrics_delete(self.metric_manager)
@@ -488,7 +705,11 @@ class MetricManager:
         else:
             raise TypeError(f"Invalid type {type(value)}")
 
-    def get_metrics(self) -> dict:
+    def list_buffers(self) -> dict:
+        """ Get the name, type and capacity of every buffer, with an empty
+        list of values """
+        if self.aggregator is not None:
+            self.aggregator.flush()
         buffers = self.job_binary.module.spits_get_metrics_list(self.metric_manager)
         metrics = {}
         info = buffer_infos.from_address(ctypes.addressof(buffers[0]))
@@ -501,44 +722,97 @@ class MetricManager:
                 'capacity': buffer_capacity,
                 'values': []
             }
+        self.job_binary.module.spits_free_metric_list(buffers)
+        return metrics
 
-        metric_names = list(metrics.keys())
-        num_metrics = len(metric_names)
-        names = (ctypes.c_char_p * num_metrics)(*[m.encode('ascii') for m in metric_names])
-        sizes = (ctypes.c_uint * num_metrics)(*[ metrics[m]['capacity'] for m in metric_names ])
-        metric_values = self.job_binary.module.spits_get_metrics_history(
-            self.metric_manager, ctypes.c_uint(num_metrics), names, sizes
-        )
+    def read_values(self, metrics: dict, metric_names: list, metric_values,
+            after: list = None, raw: bool = False):
+        """ Append the samples returned by the binary to the buffers in
+        metrics, skipping the ones at or below the after watermarks
 
-        for i in range(num_metrics):
+        :param raw: Keep bytes values as bytes instead of base64 strings
+        :type raw: bool
+        """
+        for i in range(len(metric_names)):
             metric = buffer_metrics.from_address(ctypes.addressof(metric_values[i]))
             m_name = metric_names[i]
+            m_type = metrics[m_name]['type']
+            values = metrics[m_name]['values']
             for j in range(metric.num_metrics):
-                dsize = metric.metrics[j].data_size
-                sec = metric.metrics[j].seconds
-                nsec = metric.metrics[j].nano_seconds
-                seq = metric.metrics[j].sequence_no
-                if metrics[m_name]['type'] == 'int':
-                    value = metric.metrics[j].data.i_data
-                elif metrics[m_name]['type'] == 'float':
-                    value = metric.metrics[j].data.f_data
-                elif metrics[m_name]['type'] == 'string':
-                    value = ctypes.cast(metric.metrics[j].data.c_data, ctypes.c_char_p)
-                    value = str(value.value.decode('ascii'))
+                info = metric.metrics[j]
+                seq = info.sequence_no
+                if after is not None and seq <= after[i]:
+                    continue
+                dsize = info.data_size
+                if m_type == 'int':
+                    value = info.data.i_data
+                elif m_type == 'float':
+                    value = info.data.f_data
+                elif m_type == 'string':
+                    value = ctypes.string_at(info.data.c_data)
+                    value = str(value.decode('ascii'))
                 else:
-                    value = bytearray(dsize)
-                    for k in range(dsize):
-                        value[k] = metric.metrics[j].data.c_data[k]
-                    value = base64.b64encode(value).decode('ascii')
+                    value = ctypes.string_at(info.data.c_data, dsize)
+                    if not raw:
+                        value = base64.b64encode(value).decode('ascii')
 
-                metrics[m_name]['values'].append({
+                values.append({
                     'value': value,
-                    'seconds': sec,
-                    'nano_seconds': nsec,
+                    'seconds': info.seconds,
+                    'nano_seconds': info.nano_seconds,
                     'sequence_no': seq,
                     'data_size': dsize
                 })
 
-        self.job_binary.module.spits_free_metric_list(buffers)
+    def get_metrics(self) -> dict:
+        metrics = self.list_buffers()
+        metric_names = list(metrics.keys())
+        num_metrics = len(metric_names)
+        names = (ctypes.c_char_p * num_metrics)(*[m.encode('ascii') for m in metric_names])
+        sizes = (ctypes.c_uint * num_metrics)(*[ metrics[m]['capacity'] for m in metric_names ])
+        metric_values = self.job_binary.module.spits_get_metrics_history(
+            self.metric_manager, ctypes.c_uint(num_metrics), names, sizes
+        )
+        self.read_values(metrics, metric_names, metric_values)
+        self.job_binary.module.spits_free_metrics_history(metric_values, num_metrics)
+        return metrics
+
+    def get_histograms(self) -> dict:
+        """ Get the histograms kept by the aggregator, as dicts (see
+        Histogram.to_dict)
+
+        :rtype: dict
+        """
+        if self.aggregator is None:
+            return {}
+        return {name: h.to_dict()
+                for name, h in self.aggregator.histograms().items()}
+
+    def get_metrics_since(self, watermarks: dict) -> dict:
+        """ Get only the samples with a sequence number greater than the
+        watermark of their buffer. Buffers missing from watermarks are
+        returned whole. Bytes values are returned as bytes
+
+        :param watermarks: Last sequence number seen for each buffer
+        :type watermarks: dict
+        :rtype: dict
+        """
+        metrics = self.list_buffers()
+        metric_names = list(metrics.keys())
+        num_metrics = len(metric_names)
+        after = [watermarks.get(m, -1) for m in metric_names]
+        names = (ctypes.c_char_p * num_metrics)(*[m.encode('ascii') for m in metric_names])
+        if self.has_since:
+            seqs = (ctypes.c_longlong * num_metrics)(*after)
+            metric_values = self.job_binary.module.spits_get_metrics_since(
+                self.metric_manager, ctypes.c_uint(num_metrics), names, seqs
+            )
+        else:
+            # Older binaries, filter the full history here
+            sizes = (ctypes.c_uint * num_metrics)(*[ metrics[m]['capacity'] for m in metric_names ])
+            metric_values = self.job_binary.module.spits_get_metrics_history(
+                self.metric_manager, ctypes.c_uint(num_metrics), names, sizes
+            )
+        self.read_values(metrics, metric_names, metric_values, after, raw=True)
         self.job_binary.module.spits_free_metrics_history(metric_values, num_metrics)
         return metrics
\ No newline at end of file
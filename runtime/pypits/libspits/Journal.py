@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Otávio Napoli <otavio.napoli@gmail.com>
+# Copyright (c) 2020 Edson Borin <edson@ic.unicamp.br>
+# Copyright (c) 2015 Caian Benedicto <caian@ggaunicamp.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import logging
+import os
+import struct
+import threading
+import zlib
+
+# Record types
+rec_task = 1     # A task was generated (taskid, task size, task crc)
+rec_commit = 2   # A result was committed (taskid, r, r2, result)
+rec_result = 3   # A result was committed (taskid, r, r2, result size and crc)
+rec_done = 4     # The job of the run was committed
+
+# type, runid, taskid, value1, value2, payload size, crc
+_header = struct.Struct('!BqqqqqI')
+# Payload of rec_result: result size, result crc
+_result = struct.Struct('!qI')
+
+
+class JournalRun(object):
+    """Progress of a single run recovered from the journal"""
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        # taskid -> (task size, task crc)
+        self.tasks = {}
+        # taskid -> (worker return code, committer return code, offset and
+        # size of the result in the journal). The offset is None when the
+        # result was not kept
+        self.commits = {}
+
+    def result(self, taskid):
+        """ Read the result of a committed task from the journal
+
+        :return: The result, None if it was empty
+        :rtype: bytes
+        :raises KeyError: If the result was not kept in the journal
+        """
+        r, r2, offset, size = self.commits[taskid]
+        if offset is None:
+            raise KeyError(taskid)
+        if size == 0:
+            return None
+        with open(self.filename, 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def last_taskid(self):
+        """ Get the highest task id generated in the run, or 0 if none
+        """
+        return max(self.tasks.keys(), default=0)
+
+    def outstanding(self):
+        """ Get the sorted list of generated task ids that were not committed
+        """
+        return sorted(t for t in self.tasks if t not in self.commits)
+
+
+class Journal(object):
+    """Append-only, fsync-batched journal of the job manager progress.
+
+    Records are buffered in memory and a background thread writes and
+    fsyncs them every sync_interval seconds, or earlier when sync_batch
+    records are pending. A crash loses at most the records of the last
+    batch, which are simply recomputed on resume.
+
+    Only the size and checksum of the committed results are recorded,
+    unless keep_results is set.
+    """
+
+    def __init__(self, filename: str, resume: bool = False,
+                 keep_results: bool = False, sync_interval: float = 1.0,
+                 sync_batch: int = 256):
+        """ Open a journal file
+
+        :param filename: Path of the journal file
+        :type filename: str
+        :param resume: Load the records from an existing journal and keep
+            appending to it. Otherwise, the journal is truncated, it must not
+            have runs that did not finish
+        :type resume: bool
+        :param keep_results: Record the committed results, so the committer
+            state can be rebuilt on resume
+        :type keep_results: bool
+        :param sync_interval: Maximum time (in seconds) a record stays in memory
+        :type sync_interval: float
+        :param sync_batch: Number of pending records that triggers a sync
+        :type sync_batch: int
+        """
+        self.filename = filename
+        self.keep_results = keep_results
+        self.sync_interval = sync_interval
+        self.sync_batch = sync_batch
+        self.runs = {}
+        self._pending = []
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._running = True
+
+        if resume and os.path.isfile(filename):
+            valid = self._load()
+            self._file = open(filename, 'r+b')
+            # Drop a record torn by a crash before appending
+            self._file.truncate(valid)
+            self._file.seek(valid)
+        else:
+            if Journal.unfinished(filename):
+                raise ValueError(f'The journal {filename} has runs that did '
+                                 f'not finish, resume the job or remove the '
+                                 f'journal')
+            self._file = open(filename, 'wb')
+
+        self._thread = threading.Thread(target=self._syncer, name='Journal')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @staticmethod
+    def unfinished(filename: str) -> list:
+        """ Get the runs of a journal that did not finish
+
+        :param filename: Path of the journal file
+        :type filename: str
+        :return: The sorted run identifiers, empty if there is no journal
+        :rtype: list
+        """
+        if not os.path.isfile(filename) or os.path.getsize(filename) == 0:
+            return []
+        journal = Journal.__new__(Journal)
+        journal.filename = filename
+        journal.runs = {}
+        journal._load()
+        return sorted(journal.runs)
+
+    def missing_results(self) -> int:
+        """ Get the number of successfully committed results that were not
+        kept in the journal, so they cannot be committed again on resume
+
+        :rtype: int
+        """
+        return sum(1 for run in self.runs.values()
+                   for r, r2, offset, size in run.commits.values()
+                   if r2 == 0 and offset is None)
+
+    def _load(self) -> int:
+        """ Read all the valid records of the journal into self.runs. The
+        records are streamed, results are left in the file
+
+        :return: Offset of the end of the last valid record
+        :rtype: int
+        """
+        offset = 0
+        with open(self.filename, 'rb') as f:
+            while True:
+                head = f.read(_header.size)
+                if len(head) < _header.size:
+                    break
+                rtype, runid, taskid, v1, v2, size, crc = \
+                    _header.unpack(head)
+                # Results are checked in blocks, not kept in memory
+                value = zlib.crc32(head[:-4])
+                payload = b''
+                left = size
+                while left > 0:
+                    data = f.read(min(left, 1 << 20))
+                    if not data:
+                        break
+                    value = zlib.crc32(data, value)
+                    if rtype != rec_commit:
+                        payload += data
+                    left -= len(data)
+                if left > 0:
+                    break
+                if value != crc:
+                    logging.warning(f'Corrupted record at offset {offset} of '
+                                    f'journal {self.filename}, ignoring the '
+                                    f'rest')
+                    break
+
+                # Finished runs are not resumed, records after the end of
+                # a run belong to a new execution of the job
+                if rtype == rec_done:
+                    self.runs.pop(runid, None)
+                    offset += _header.size + size
+                    continue
+
+                run = self.runs.get(runid)
+                if run is None:
+                    run = self.runs[runid] = JournalRun(self.filename)
+                if rtype == rec_task:
+                    run.tasks[taskid] = (v1, v2)
+                elif rtype == rec_commit:
+                    run.commits[taskid] = (v1, v2, offset + _header.size, size)
+                elif rtype == rec_result:
+                    run.commits[taskid] = (v1, v2, None,
+                                           _result.unpack(payload)[0])
+                offset += _header.size + size
+
+        total = os.path.getsize(self.filename)
+        if offset != total:
+            logging.warning(f'Discarding {total - offset} bytes from the '
+                            f'tail of journal {self.filename}')
+        return offset
+
+    def _append(self, rtype, runid, taskid, v1, v2, payload=b''):
+        head = _header.pack(rtype, runid, taskid, v1, v2, len(payload), 0)[:-4]
+        crc = zlib.crc32(payload, zlib.crc32(head))
+        record = head + struct.pack('!I', crc)
+        with self._lock:
+            self._pending.append(record)
+            if payload:
+                self._pending.append(bytes(payload))
+            if len(self._pending) >= self.sync_batch:
+                self._wakeup.set()
+
+    def _syncer(self):
+        while self._running:
+            self._wakeup.wait(self.sync_interval)
+            self._wakeup.clear()
+            try:
+                self.sync()
+            except:
+                logging.exception(f'Failed to sync journal {self.filename}!')
+
+    def get_run(self, runid: int):
+        """ Get the progress recovered for a run
+
+        :param runid: Run identifier
+        :type runid: int
+        :return: The recovered run or None if the run is not in the journal
+        :rtype: JournalRun
+        """
+        return self.runs.get(runid)
+
+    def task_generated(self, runid: int, taskid: int, task: bytes):
+        """ Record a generated task. Only its size and checksum are kept,
+        the task itself is generated again by the job manager on resume
+
+        :param runid: Run identifier
+        :type runid: int
+        :param taskid: Task identifier
+        :type taskid: int
+        :param task: The task payload
+        :type task: bytes
+        """
+        task = task or b''
+        self._append(rec_task, runid, taskid, len(task), zlib.crc32(task))
+
+    def task_committed(self, runid: int, taskid: int, r: int, r2: int,
+                       result: bytes):
+        """ Record the outcome of a commit. The result is kept, so the
+        committer state can be rebuilt on resume, only if keep_results is set
+        and it was successfully committed. Otherwise, only its size and
+        checksum are recorded
+
+        :param runid: Run identifier
+        :type runid: int
+        :param taskid: Task identifier
+        :type taskid: int
+        :param r: Return code of the worker
+        :type r: int
+        :param r2: Return code of the committer
+        :type r2: int
+        :param result: The committed result
+        :type result: bytes
+        """
+        if self.keep_results and r2 == 0:
+            self._append(rec_commit, runid, taskid, r, r2, result or b'')
+        else:
+            result = result or b''
+            self._append(rec_result, runid, taskid, r, r2,
+                         _result.pack(len(result), zlib.crc32(result)))
+
+    def run_finished(self, runid: int):
+        """ Record that the job of a run was committed, the run is not
+        resumed anymore
+
+        :param runid: Run identifier
+        :type runid: int
+        """
+        self._append(rec_done, runid, 0, 0, 0)
+
+    def sync(self):
+        """ Write the pending records and fsync the journal
+        """
+        with self._io_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            if not pending or self._file is None:
+                return
+            self._file.write(b''.join(pending))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        """ Sync the pending records and close the journal
+        """
+        self._running = False
+        self._wakeup.set()
+        self._thread.join()
+        self.sync()
+        self._file.close()
+        self._file = None
@@ -30,15 +30,42 @@ import socket
 import sys
 import threading
 import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 from libspits import ClientEndpoint
 from libspits import config
 
 
+def _http_request_handler(callback):
+    """ Request handler class for the HTTP server of a Listener """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            try:
+                response = callback(self.path)
+            except:
+                logging.debug(traceback.format_exc())
+                response = (500, 'text/plain', b'Internal error\n')
+            if response is None:
+                response = (404, 'text/plain', b'Not found\n')
+            status, content_type, body = response
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug(f'HTTP {self.address_string()}: {format % args}')
+
+    return Handler
+
+
 class Listener(object):
     """Threaded TCP/UDS listener with callback"""
 
-    def __init__(self, mode, address, port, callback, user_args):
+    def __init__(self, mode, address, port, callback, user_args,
+                 http_port=None, http_callback=None):
         """ Threaded TCP/UDS listener with callback
 
         :param mode: Operation mode ('tcp' or 'udp')
@@ -52,6 +79,12 @@ class Listener(object):
         :param user_args: User arguments (as tuple) to be passed to callback method when a connection occurs.
             Note: the tuple must contain the same number of arguments needed by the callback method
         :type user_args: tuple
+        :param http_port: TCP port of an optional HTTP server (0 for any)
+        :type http_port: int
+        :param http_callback: Method called with the path of each HTTP GET
+            request, returning (status, content type, body) or None if the
+            path is not found. The HTTP server only runs if it is provided
+        :type http_callback: method
         """
         self.mode = mode
         self.addr = address
@@ -61,6 +94,11 @@ class Listener(object):
         self.thread = None
         self.socket = None
         self.running = False
+        self.http_port = http_port
+        self.http_callback = http_callback
+        self.http_server = None
+        self.http_thread = None
+        self.stop_lock = threading.Lock()
 
     def GetConnectableAddr(self):
         """ Get the connectabele address from this listener
@@ -88,17 +126,22 @@ class Listener(object):
         self.running = True
 
         while self.running:
-            self.socket.settimeout(1)
+            # Stop() may close the socket at any time
+            sock = self.socket
+            if sock is None:
+                break
 
             try:
-                conn, addr = self.socket.accept()
+                sock.settimeout(1)
+                conn, addr = sock.accept()
             except:
                 continue
             try:
                 # Assign the address from the connection
                 if self.mode == config.mode_tcp:
-                    # TCP
+                    # TCP, messages are small and answered, do not delay them
                     addr, port = addr
+                    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
                 elif self.mode == config.mode_uds:
                     # UDS
                     addr = 'uds'
@@ -167,14 +210,45 @@ class Listener(object):
         self.thread = threading.Thread(target=self.listener, name='NetworkListener')
         self.thread.start()
 
+        if self.http_callback is not None:
+            self.StartHTTP()
+
+    def StartHTTP(self):
+        """ Create the HTTP server, on a TCP port of its own because the
+        SPITS protocol lets the server speak first
+        """
+        addr = self.addr if self.mode == config.mode_tcp else '0.0.0.0'
+        try:
+            self.http_server = ThreadingHTTPServer(
+                (addr, self.http_port or 0),
+                _http_request_handler(self.http_callback))
+        except socket.error:
+            raise Exception('Failed to bind HTTP socket!')
+        self.http_server.daemon_threads = True
+        self.http_port = self.http_server.server_address[1]
+        self.http_thread = threading.Thread(
+            target=self.http_server.serve_forever, args=(1,),
+            name='HTTPListener')
+        self.http_thread.daemon = True
+        self.http_thread.start()
+        logging.info(f'Serving HTTP at {addr}:{self.http_port}...')
+
     def Stop(self):
-        """ Stops the socket server
+        """ Stops the socket server. It may be called more than once and
+        from several threads, only the first call closes the servers
         """
         self.running = False
 
-        if self.socket:
-            self.socket.close()
-            self.socket = None
+        with self.stop_lock:
+            server, self.http_server = self.http_server, None
+            sock, self.socket = self.socket, None
+
+        if server:
+            server.shutdown()
+            server.server_close()
+
+        if sock:
+            sock.close()
             if self.mode == config.mode_uds:
                 # Remove the socket file if it is an UDS
                 try:
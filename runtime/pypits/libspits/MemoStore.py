@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Otávio Napoli <otavio.napoli@gmail.com>
+# Copyright (c) 2020 Edson Borin <edson@ic.unicamp.br>
+# Copyright (c) 2015 Caian Benedicto <caian@ggaunicamp.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import hashlib
+import logging
+import os
+import threading
+import time
+
+
+class MemoStore(object):
+    """Persistent content-addressed store of task results.
+
+    Results are stored as files named after the hash of the SPITS binary,
+    its arguments and the task payload, so an identical task of a later run
+    of the same job can be committed without being executed. The least
+    recently used results are evicted when the store exceeds max_bytes.
+    """
+
+    def __init__(self, dirname: str, binary: str, argv: list,
+                 max_bytes: int = 1 << 30):
+        """ Open (or create) a memoization store
+
+        :param dirname: Directory of the store
+        :type dirname: str
+        :param binary: Path to the SPITS binary
+        :type binary: str
+        :param argv: Arguments passed to the SPITS binary
+        :type argv: list of str
+        :param max_bytes: Maximum size of the stored results
+        :type max_bytes: int
+        """
+        self.dirname = dirname
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        self._lock = threading.Lock()
+        # key -> (size, last use), in least recently used order
+        self._index = {}
+
+        os.makedirs(dirname, exist_ok=True)
+
+        # Every key is prefixed by the binary and its arguments
+        h = hashlib.sha256()
+        with open(binary, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        h.update(b'\0'.join(a.encode('utf8') for a in argv))
+        self._prefix = h.digest()
+
+        self._load()
+
+    def _load(self):
+        entries = []
+        for name in os.listdir(self.dirname):
+            path = os.path.join(self.dirname, name)
+            if name.endswith('.tmp'):
+                # Leftover of an interrupted put
+                os.unlink(path)
+                continue
+            st = os.stat(path)
+            entries.append((st.st_mtime, name, st.st_size))
+        for mtime, name, size in sorted(entries):
+            self._index[name] = (size, mtime)
+            self.size += size
+        logging.info(f'Memoization store at {self.dirname} has '
+                     f'{len(self._index)} results ({self.size} bytes)')
+        with self._lock:
+            self._evict()
+
+    def _path(self, key):
+        return os.path.join(self.dirname, key)
+
+    def _evict(self):
+        while self.size > self.max_bytes and self._index:
+            key = next(iter(self._index))
+            size, _ = self._index.pop(key)
+            self.size -= size
+            self.evictions += 1
+            try:
+                os.unlink(self._path(key))
+            except OSError:
+                pass
+
+    def key(self, task: bytes) -> str:
+        """ Compute the key of a task
+
+        :param task: The task payload
+        :type task: bytes
+        :return: The hexadecimal key
+        :rtype: str
+        """
+        h = hashlib.sha256(self._prefix)
+        if task is not None:
+            h.update(task)
+        return h.hexdigest()
+
+    def get(self, key: str):
+        """ Get the result stored for a key
+
+        :param key: Key computed with key()
+        :type key: str
+        :return: The result or None on a miss
+        :rtype: bytes
+        """
+        with self._lock:
+            entry = self._index.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            now = time.time()
+            # Move to the most recently used end
+            self._index[key] = (entry[0], now)
+            self.hits += 1
+        try:
+            with open(self._path(key), 'rb') as f:
+                res = f.read()
+            os.utime(self._path(key), (now, now))
+            return res
+        except OSError:
+            with self._lock:
+                if self._index.pop(key, None) is not None:
+                    self.size -= entry[0]
+                self.hits -= 1
+                self.misses += 1
+            return None
+
+    def put(self, key: str, result: bytes):
+        """ Store the result of a task, evicting old results if necessary
+
+        :param key: Key computed with key()
+        :type key: str
+        :param result: The result of the task
+        :type result: bytes
+        """
+        result = result or b''
+        if len(result) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._index:
+                return
+        path = self._path(key)
+        tmp = f'{path}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(result)
+            os.replace(tmp, path)
+        except OSError:
+            logging.warning(f'Failed to store result {key} in {self.dirname}!')
+            return
+        with self._lock:
+            if key not in self._index:
+                self._index[key] = (len(result), time.time())
+                self.size += len(result)
+            self._evict()
+
+    def register_metrics(self, aggregator):
+        """ Publish the store statistics with gauges that read them when the
+        aggregator is flushed
+
+        :param aggregator: Aggregator used to publish the statistics
+        :type aggregator: MetricAggregator
+        """
+        aggregator.gauge("memo_hits").track(lambda: self.hits)
+        aggregator.gauge("memo_misses").track(lambda: self.misses)
+        aggregator.gauge("memo_evictions").track(lambda: self.evictions)
+        aggregator.gauge("memo_size_mb").track(
+            lambda: self.size / float(1 << 20))
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Otávio Napoli <otavio.napoli@gmail.com>
+# Copyright (c) 2020 Edson Borin <edson@ic.unicamp.br>
+# Copyright (c) 2015 Caian Benedicto <caian@ggaunicamp.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import logging
+import threading
+
+from .Histogram import Histogram
+
+
+class Counter(object):
+    """Monotonic counter. Each thread adds to its own cell, so inc() takes
+    no locks; the cells are summed when flushed."""
+
+    def __init__(self, name):
+        self.name = name
+        self._local = threading.local()
+        self._cells = []
+        self._lock = threading.Lock()
+        self._flushed = None
+
+    def _cell(self):
+        cell = [0]
+        with self._lock:
+            self._cells.append(cell)
+        self._local.cell = cell
+        return cell
+
+    def inc(self, n=1):
+        try:
+            cell = self._local.cell
+        except AttributeError:
+            cell = self._cell()
+        cell[0] += n
+
+    @property
+    def value(self):
+        return sum(cell[0] for cell in list(self._cells))
+
+    def flush(self, metrics):
+        value = self.value
+        if value != self._flushed:
+            metrics.set_metric(self.name, value)
+            self._flushed = value
+
+
+class Gauge(object):
+    """Last value set by any thread, or the value returned by the function
+    being tracked."""
+
+    def __init__(self, name):
+        self.name = name
+        self._value = None
+        self._func = None
+        self._flushed = None
+
+    def set(self, value):
+        self._value = value
+
+    def track(self, func):
+        """ Read the value from func() instead, None to stop tracking """
+        self._func = func
+
+    @property
+    def value(self):
+        func = self._func
+        return self._value if func is None else func()
+
+    def flush(self, metrics):
+        value = self.value
+        if value is not None and value != self._flushed:
+            metrics.set_metric(self.name, value)
+            self._flushed = value
+
+
+class HistogramMetric(object):
+    """Distribution of values, recorded per thread in log-linear
+    histograms. Histograms from other processes can be added with update(),
+    the snapshot merges them all."""
+
+    # Upper bounds of the buckets exposed to OpenMetrics
+    bounds = tuple(float(1 << i) for i in range(32))
+
+    # Resolution of the recorded values
+    unit = 1
+
+    def __init__(self, name):
+        self.name = name
+        self._local = threading.local()
+        self._cells = []
+        self._sources = {}
+        self._lock = threading.Lock()
+
+    def _cell(self):
+        cell = Histogram(self.unit)
+        with self._lock:
+            self._cells.append(cell)
+        self._local.cell = cell
+        return cell
+
+    def observe(self, value, count=1):
+        try:
+            cell = self._local.cell
+        except AttributeError:
+            cell = self._cell()
+        cell.record(value, count)
+
+    def update(self, source, histogram):
+        """ Replace the histogram received from source (e.g. the name of a
+        task manager) """
+        with self._lock:
+            self._sources[source] = histogram
+
+    def snapshot(self):
+        """ Merge of the values recorded by every thread and source
+
+        :rtype: Histogram
+        """
+        merged = Histogram(self.unit)
+        with self._lock:
+            cells = list(self._cells) + list(self._sources.values())
+        # Cells are updated by their threads without locks, the merge may
+        # miss the values being recorded
+        for cell in cells:
+            merged.merge(cell)
+        return merged
+
+    @property
+    def value(self):
+        h = self.snapshot()
+        return (h.count, h.total)
+
+    def flush(self, metrics):
+        pass
+
+
+class Timer(HistogramMetric):
+    """Durations in seconds. Each flush records the mean of the durations
+    observed since the previous one."""
+
+    # Upper bounds of the buckets exposed to OpenMetrics, in seconds
+    bounds = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+              1.0, 2.5, 5.0, 10.0, 25.0, 50.0, 100.0, 250.0, 1000.0)
+
+    # Microseconds
+    unit = 1e-6
+
+    def __init__(self, name):
+        super().__init__(name)
+        self._flushed = None
+
+    def flush(self, metrics):
+        count, total = self.value
+        last_count, last_total = self._flushed or (0, 0.0)
+        if count > last_count:
+            metrics.set_metric(self.name,
+                (total - last_total) / (count - last_count))
+            self._flushed = (count, total)
+
+
+class MetricAggregator(object):
+    """Accumulate metrics in Python and write them to a MetricManager
+    every interval seconds and before the manager is queried.
+
+    Handles are registered once by name and kept by the caller, updating
+    them does not cross into the binary.
+    """
+
+    def __init__(self, metrics, interval=1.0):
+        """
+        :param metrics: Metric manager that receives the values
+        :type metrics: MetricManager
+        :param interval: Seconds between flushes, None to flush only
+            when the metrics are queried
+        :type interval: float
+        """
+        self.metrics = metrics
+        self.interval = interval
+        self.handles = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.done = threading.Event()
+        metrics.aggregator = self
+
+    def _register(self, kind, name):
+        with self.lock:
+            handle = self.handles.get(name)
+            if handle is None:
+                handle = kind(name)
+                self.handles[name] = handle
+            elif type(handle) is not kind:
+                raise TypeError(f"Metric {name} is a {type(handle).__name__}")
+            return handle
+
+    def counter(self, name):
+        return self._register(Counter, name)
+
+    def gauge(self, name):
+        return self._register(Gauge, name)
+
+    def timer(self, name):
+        return self._register(Timer, name)
+
+    def histogram(self, name):
+        return self._register(HistogramMetric, name)
+
+    def histograms(self):
+        """ Snapshots of the histograms and timers by name
+
+        :rtype: dict
+        """
+        return {handle.name: handle.snapshot() for handle in self.snapshot()
+                if isinstance(handle, HistogramMetric)}
+
+    def snapshot(self):
+        """ Registered handles, sorted by name """
+        with self.lock:
+            return [self.handles[name] for name in sorted(self.handles)]
+
+    def flush(self):
+        with self.lock:
+            handles = list(self.handles.values())
+            for handle in handles:
+                try:
+                    handle.flush(self.metrics)
+                except:
+                    logging.debug('Error flushing metric %s', handle.name,
+                                  exc_info=True)
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            self.flush()
+
+    def start(self):
+        if self.interval is None or self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run, name='Metrics-flush')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.done.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
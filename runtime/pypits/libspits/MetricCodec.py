@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Otávio Napoli <otavio.napoli@gmail.com>
+# Copyright (c) 2020 Edson Borin <edson@ic.unicamp.br>
+# Copyright (c) 2015 Caian Benedicto <caian@ggaunicamp.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import struct
+
+from .messaging import msg_cd_query_metrics_since
+
+# Compact binary encoding for metric samples, used by the incremental query.
+#
+# blob    := count:u32 buffer*
+# buffer  := name_len:u16 name type:u8 capacity:u32 count:u32 sample*
+# sample  := sequence_no:u64 seconds:u64 nano_seconds:u32 value
+# value   := i32 | f32 | len:u32 bytes (string and bytes)
+
+type_codes = {'int': 0, 'float': 1, 'string': 2, 'bytes': 3}
+type_names = {v: k for k, v in type_codes.items()}
+
+_count = struct.Struct('!I')
+_name = struct.Struct('!H')
+_buffer = struct.Struct('!BII')
+_sample = struct.Struct('!QQI')
+_int = struct.Struct('!i')
+_float = struct.Struct('!f')
+
+
+def encode_metrics(metrics: dict) -> bytes:
+    """ Encode metrics as returned by MetricManager.get_metrics_since.
+    Buffers without samples are left out
+
+    :rtype: bytes
+    """
+    parts = []
+    buffers = [(n, m) for n, m in metrics.items() if m['values']]
+    parts.append(_count.pack(len(buffers)))
+    for name, m in buffers:
+        code = type_codes[m['type']]
+        name = name.encode('ascii')
+        parts.append(_name.pack(len(name)))
+        parts.append(name)
+        parts.append(_buffer.pack(code, m['capacity'], len(m['values'])))
+        for v in m['values']:
+            parts.append(_sample.pack(v['sequence_no'], v['seconds'],
+                v['nano_seconds']))
+            value = v['value']
+            if code == 0:
+                parts.append(_int.pack(value))
+            elif code == 1:
+                parts.append(_float.pack(value))
+            else:
+                if code == 2:
+                    value = value.encode('ascii')
+                parts.append(_count.pack(len(value)))
+                parts.append(value)
+    return b''.join(parts)
+
+
+def decode_metrics(data) -> dict:
+    """ Decode a blob produced by encode_metrics. Bytes values are returned
+    as bytes
+
+    :rtype: dict
+    """
+    data = memoryview(data)
+    metrics = {}
+    pos = _count.size
+    count, = _count.unpack_from(data, 0)
+    for _ in range(count):
+        size, = _name.unpack_from(data, pos)
+        pos += _name.size
+        name = bytes(data[pos:pos + size]).decode('ascii')
+        pos += size
+        code, capacity, nvalues = _buffer.unpack_from(data, pos)
+        pos += _buffer.size
+        values = []
+        for _ in range(nvalues):
+            seq, sec, nsec = _sample.unpack_from(data, pos)
+            pos += _sample.size
+            if code == 0:
+                value, = _int.unpack_from(data, pos)
+                size = _int.size
+                pos += size
+            elif code == 1:
+                value, = _float.unpack_from(data, pos)
+                size = _float.size
+                pos += size
+            else:
+                size, = _count.unpack_from(data, pos)
+                pos += _count.size
+                value = bytes(data[pos:pos + size])
+                pos += size
+                if code == 2:
+                    value = value.decode('ascii')
+                    size += 1
+            values.append({
+                'value': value,
+                'seconds': sec,
+                'nano_seconds': nsec,
+                'sequence_no': seq,
+                'data_size': size
+            })
+        metrics[name] = {
+            'type': type_names[code],
+            'capacity': capacity,
+            'values': values
+        }
+    return metrics
+
+
+def serve_metrics_since(conn, metrics, timeout):
+    """ Answer a msg_cd_query_metrics_since request. The request is the
+    number of watermarks followed by (name, sequence_no) pairs and the
+    answer is the size of the blob followed by the blob
+
+    :param conn: Connection
+    :type conn: Endpoint
+    :param metrics: Metric manager
+    :type metrics: MetricManager
+    """
+    watermarks = {}
+    for _ in range(conn.ReadInt64(timeout)):
+        name = conn.ReadString(timeout)
+        watermarks[name] = conn.ReadInt64(timeout)
+    blob = encode_metrics(metrics.get_metrics_since(watermarks))
+    conn.WriteInt64(len(blob))
+    conn.Write(blob)
+
+
+def query_metrics_since(conn, watermarks: dict, timeout) -> dict:
+    """ Query the samples newer than the watermarks from a job or task
+    manager. The watermarks are advanced to the last sample received
+
+    :param conn: Connection
+    :type conn: Endpoint
+    :param watermarks: Last sequence number seen for each buffer
+    :type watermarks: dict
+    :rtype: dict
+    """
+    conn.WriteInt64(msg_cd_query_metrics_since)
+    conn.WriteInt64(len(watermarks))
+    for name, seq in watermarks.items():
+        conn.WriteString(name)
+        conn.WriteInt64(seq)
+    size = conn.ReadInt64(timeout)
+    metrics = decode_metrics(conn.Read(size, timeout))
+    for name, m in metrics.items():
+        watermarks[name] = max(watermarks.get(name, -1),
+            m['values'][-1]['sequence_no'])
+    return metrics
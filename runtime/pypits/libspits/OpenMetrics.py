@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Otávio Napoli <otavio.napoli@gmail.com>
+# Copyright (c) 2020 Edson Borin <edson@ic.unicamp.br>
+# Copyright (c) 2015 Caian Benedicto <caian@ggaunicamp.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import re
+
+from .MetricAggregator import Counter, Gauge, HistogramMetric, Timer
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+def _name(prefix, name):
+    name = re.sub(r'[^a-zA-Z0-9_]', '_', name)
+    return f'{prefix}_{name}' if prefix else name
+
+
+def _labels(labels, extra=None):
+    items = list(labels.items()) + list((extra or {}).items())
+    if not items:
+        return ''
+    escaped = []
+    for key, value in items:
+        value = str(value).replace('\\', r'\\').replace('"', r'\"') \
+            .replace('\n', r'\n')
+        escaped.append(f'{key}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+
+def _number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def exposition(aggregator, labels=None, prefix='spits'):
+    """ Render the handles of a MetricAggregator in the OpenMetrics text
+    format. Counters are exposed as counters, gauges with numeric values as
+    gauges and histograms with the bounds of their handles (the log-linear
+    buckets are counted in the first bound not below them)
+
+    :param aggregator: Source of the metrics
+    :type aggregator: MetricAggregator
+    :param labels: Labels added to every sample, the ones with a None
+        value are left out
+    :type labels: dict
+    :param prefix: Prefix of the metric names
+    :type prefix: str
+    :rtype: str
+    """
+    labels = {k: v for k, v in (labels or {}).items() if v is not None}
+    lines = []
+    for handle in aggregator.snapshot():
+        if isinstance(handle, HistogramMetric):
+            name = _name(prefix, handle.name)
+            if isinstance(handle, Timer) and not name.endswith('_seconds'):
+                name += '_seconds'
+            h = handle.snapshot()
+            lines.append(f'# TYPE {name} histogram')
+            if isinstance(handle, Timer):
+                lines.append(f'# UNIT {name} seconds')
+            counts = h.cumulative(handle.bounds)
+            for bound, n in zip(handle.bounds + (None,), counts):
+                le = '+Inf' if bound is None else repr(float(bound))
+                lines.append(f'{name}_bucket{_labels(labels, dict(le=le))} '
+                             f'{n}')
+            lines.append(f'{name}_count{_labels(labels)} {h.count}')
+            lines.append(f'{name}_sum{_labels(labels)} {h.total!r}')
+        elif isinstance(handle, Counter):
+            name = _name(prefix, handle.name)
+            lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}_total{_labels(labels)} {handle.value}')
+        elif isinstance(handle, Gauge):
+            try:
+                value = _number(handle.value)
+            except:
+                value = None
+            if value is None:
+                continue
+            name = _name(prefix, handle.name)
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name}{_labels(labels)} {value}')
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_handler(aggregator, labels=None):
+    """ HTTP callback for Listener serving the exposition at /metrics """
+    def handler(path):
+        if path.split('?')[0] != '/metrics':
+            return None
+        body = exposition(aggregator, labels).encode('utf8')
+        return 200, CONTENT_TYPE, body
+    return handler
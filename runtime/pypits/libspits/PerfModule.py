@@ -27,22 +27,75 @@ from .LogUtils import log_lines
 from .pynvml import *
 
 import os, time, timeit, threading, logging, datetime, traceback, sys
+import json, struct
+from array import array
+
+# CPU sample files (./perf/<UID>-cpu.perf) start with a header (magic,
+# version, size of the JSON description of the process and the description)
+# followed by one block per report interval: the number of samples, the
+# size of a JSON object with the names of the threads first seen (or
+# renamed) in the interval, the names and the samples. Samples are rows of
+# 64-bit integers:
+#
+# ts tid utime stime rss
+#
+# Timestamps are nanoseconds since the epoch, tid is the native id of the
+# thread (0 for the whole process), utime and stime are clock ticks and rss
+# is the resident set size in pages (only sampled for the process).
+
+_magic = b'SPPF'
+_header = struct.Struct('<4sBH')
+_block = struct.Struct('<II')
+ROW_FIELDS = 5
+
+
+def _stat(data):
+    # Fields after the command name, which may contain spaces
+    fields = data[data.rfind(b')') + 2:].split()
+    return int(fields[11]), int(fields[12]), int(fields[21])
+
+
+def read_samples(filename):
+    """ Read a CPU sample file
+
+    :return: The process description, the names of the threads by native id
+        and the list of samples as (ts, tid, utime, stime, rss)
+    :rtype: tuple
+    """
+    names = {}
+    samples = []
+    with open(filename, 'rb') as f:
+        magic, version, size = _header.unpack(f.read(_header.size))
+        if magic != _magic:
+            raise ValueError(f'{filename} is not a PerfModule sample file')
+        info = json.loads(f.read(size).decode('utf8'))
+        while True:
+            data = f.read(_block.size)
+            if len(data) < _block.size:
+                break
+            rows, size = _block.unpack(data)
+            if size:
+                names.update((int(tid), name) for tid, name in
+                             json.loads(f.read(size).decode('utf8')).items())
+            block = array('q')
+            data = f.read(rows * ROW_FIELDS * block.itemsize)
+            # A block being written when the process died is ignored
+            if len(data) < rows * ROW_FIELDS * block.itemsize:
+                break
+            block.frombytes(data)
+            samples += zip(*[iter(block)] * ROW_FIELDS)
+    return info, names, samples
+
 
 class PerfModule():
     """
     Performance statistics acquisition module for PY-PITS. The statistics
-    are recorded in the SPITS log, as well as in a file inside ./perf/. The
-    file is unique for each SPITS process.
+    are recorded in files inside ./perf/, unique for each SPITS process.
 
     Available statistics:
-      - Number of compute workers
-      - Total wall time (since beginning of PerfModule) [us]
-      - Total user time (since beginning of PerfModule) [us]
-      - Total system time (since beginning of PerfModule) [us]
-      - CPU utilization in user mode (min, max, avg) [%]
-      - CPU utilization in system mode (min, max, avg) [%]
-      - Total CPU utilization (min, max, avg) [%]
-      - Resident set size (min, max, avg) [MiB]
+      - User and system CPU time of the process and of each thread, sampled
+        subsamp times per report interval (binary file, see read_samples)
+      - Resident set size
       - NVIDIA GPU utilization
       - NVIDIA GPU memory
 
@@ -78,6 +131,7 @@ class PerfModule():
         self.nw = nw
         self.rinterv = rinterv
         self.subsamp = subsamp
+        self.files = {}
 
         logging.info('Starting PerfModule...')
 
@@ -86,7 +140,7 @@ class PerfModule():
         def runcpu_wrapper():
             self.RunCPU()
 
-        tcpu = threading.Thread(target=runcpu_wrapper)
+        tcpu = threading.Thread(target=runcpu_wrapper, name='PerfModule-cpu')
 
         try:
             tcpu.daemon = True
@@ -148,7 +202,8 @@ class PerfModule():
             def runnv_wrapper():
                 self.RunNV(i, handle)
 
-            tnv = threading.Thread(target=runnv_wrapper)
+            tnv = threading.Thread(target=runnv_wrapper,
+                                   name='PerfModule-nv-%d' % i)
 
             try:
                 tnv.daemon = True
@@ -186,59 +241,42 @@ class PerfModule():
           header before writing the fields if True, otherwise just append
           fields.
         """
-        dirname = './perf/'
-        filename = '%s%s-%s' % (dirname, self.uid, tag)
-        mode = 'wt' if new else 'at'
         fields = ' '.join([str(i) for i in fields])
 
         try:
-            os.mkdir(dirname)
+            f = self.files.get(tag)
+            if new or f is None:
+                f = self.Open(tag, 'wt')
+                f.write(header + '\n')
+            f.write(fields + '\n')
+            f.flush()
         except:
             pass
 
-        try:
-            with open(filename, mode) as f:
-                if new:
-                    f.write(header + '\n')
-                f.write(fields + '\n')
-        except:
-            pass
-
-    def Stat(self, pid):
+    def Open(self, tag, mode):
         """
-        Query /proc/PID/stat.
+        Open (and keep open) the perf file of a statistic.
 
         Arguments:
 
-          pid: The target process id.
-
-        Return:
-
-          A tuple with the raw RSS, user time and system time.
-
-        Note:
+          tag: The suffix of the file.
 
-          This method will throw exception on failure.
+          mode: The mode of the file.
         """
+        dirname = './perf/'
+        filename = '%s%s-%s' % (dirname, self.uid, tag)
 
-        with open('/proc/%d/stat' % pid, 'rt') as f:
-            l = f.read()
-
-        # Remove the process name
-
-        i = l.find('(')
-        j = l.rfind(')')
-
-        if i >= 0 and j >= 0:
-            l = l[:i] + l[j:]
-
-        l = l.split()
-
-        rss = float(l[23])
-        ut = float(l[13])
-        st = float(l[14])
+        try:
+            os.mkdir(dirname)
+        except:
+            pass
 
-        return (rss, ut, st)
+        f = self.files.pop(tag, None)
+        if f is not None:
+            f.close()
+        f = open(filename, mode)
+        self.files[tag] = f
+        return f
 
     def NVStat(self, handle, pid):
         """
@@ -312,9 +350,40 @@ class PerfModule():
         return (ut, mut, temp, smclk, memclk, mem, pmem, power, throttle)
 
 
+    def ThreadNames(self, tids):
+        """
+        Names of the threads of the process.
+
+        Arguments:
+
+          tids: The native ids of the threads.
+
+        Return:
+
+          A dictionary with the name of each thread, Python threads are
+          named after their threading name, other threads after their
+          command name. Threads that already exited are left out.
+        """
+        pynames = {t.native_id: t.name for t in threading.enumerate()}
+        names = {}
+        for tid in tids:
+            name = pynames.get(tid)
+            if name is None:
+                try:
+                    with open('/proc/self/task/%d/comm' % tid, 'rt') as f:
+                        name = f.read().strip()
+                except:
+                    continue
+            names[tid] = name
+        return names
+
     def RunCPU(self):
         """
         CPU Monitoring thread.
+
+        The stat files of the process and of its threads are kept open and
+        read with pread, the samples of a report interval are stored in a
+        preallocated array and written to the file at once.
         """
 
         # Compute the sleep delay
@@ -348,151 +417,120 @@ class PerfModule():
 
         logging.debug('PerfModule: Tick frequency is %d Hz.' % ticpersec)
 
-        # Get the process PID
+        # Open the stat file of the process and the sample file
 
-        pid = os.getpid()
+        try:
+            procfd = os.open('/proc/self/stat', os.O_RDONLY)
+        except:
+            logging.info('PerfModule: Could not open the process stat file!')
+            return
 
-        # Run the perf module
+        info = json.dumps(dict(uid=str(self.uid), pid=os.getpid(),
+            nw=self.nw, ticks=ticpersec, pagesize=pagesize,
+            interval=self.rinterv, subsamp=self.subsamp)).encode('utf8')
 
-        logging.info('PerfModule CPU thread started.')
+        try:
+            f = self.Open('cpu.perf', 'wb')
+            f.write(_header.pack(_magic, 1, len(info)))
+            f.write(info)
+        except:
+            logging.info('PerfModule: Could not create the sample file!')
+            os.close(procfd)
+            return
 
-        isnew = True
+        # Run the perf module
 
-        refwtime = 0
+        logging.info('PerfModule CPU thread started.')
 
-        lastwtime = 0
-        lastutime = 0
-        laststime = 0
+        taskfds = {}
+        written = {}
+        samples = array('q')
 
         while not self.stop:
 
-            minupct = 0
-            maxupct = 0
-            avgupct = 0
-
-            minspct = 0
-            maxspct = 0
-            avgspct = 0
+            # Open the stat files of the threads started since the last
+            # interval, the files of finished threads fail and are closed
+            # when sampled. Threads are named as soon as they are seen,
+            # short-lived threads may not exist at the end of the interval
 
-            mintpct = 0
-            maxtpct = 0
-            avgtpct = 0
-
-            minrss = 0
-            maxrss = 0
-            avgrss = 0
+            new = []
+            try:
+                for tid in os.listdir('/proc/self/task'):
+                    tid = int(tid)
+                    if tid not in taskfds:
+                        taskfds[tid] = os.open(
+                            '/proc/self/task/%d/stat' % tid, os.O_RDONLY)
+                        new.append(tid)
+            except:
+                pass
+            current = self.ThreadNames(new)
 
-            firstwtime = 0
-            firstutime = 0
-            firststime = 0
+            size = self.subsamp * (len(taskfds) + 1) * ROW_FIELDS
+            if len(samples) < size:
+                samples = array('q', bytes(size * samples.itemsize))
 
             n = 0
 
-            cpuheader = """# (1) Number of compute workers
-# (2) Total wall time (since beginning of PerfModule) [us]
-# (3) Total user time (since beginning of PerfModule) [us]
-# (4) Total system time (since beginning of PerfModule) [us]
-# (5-7) CPU utilization in user mode (min, max, avg) [%]
-# (8-10) CPU utilization in system mode (min, max, avg) [%]
-# (11-13) Total user + system CPU utilization (min, max, avg) [%]"""
-
-            memheader = """# (1) Total wall time (since beginning of PerfModule) [us]
-# (2-4) Resident set size (min, max, avg) [MiB]"""
-
             for sample in range(self.subsamp):
 
                 if self.stop:
                     break
 
-                try:
-
-                    wt = timeit.default_timer()
-                    rss, ut, st = self.Stat(pid)
-
-                    rss = rss * pagesize / 1024.0 / 1024.0
-                    ut = ut / ticpersec
-                    st = st / ticpersec
-
-                    if refwtime == 0:
-
-                        refwtime = wt
-                        delta = delay
-
-                        refstamp = datetime.datetime.utcnow()
-                        cpuheader = '# ' + \
-                            refstamp.strftime('%Y-%m-%d %H:%M:%S.%f') + \
-                            '\n' + cpuheader
-                        memheader = '# ' + \
-                            refstamp.strftime('%Y-%m-%d %H:%M:%S.%f') + \
-                            '\n' + memheader
-
-                    else:
-
-                        delta = wt - lastwtime
-
-                        avgrss += rss
-
-                        upd = ut - lastutime
-                        spd = st - laststime
-                        tpd = upd + spd
-
-                        upc = (upd * 100 / delta)
-                        spc = (spd * 100 / delta)
-                        tpc = (tpd * 100 / delta)
-
-                        if n == 0:
-                            firstwtime = wt
-                            firstutime = ut
-                            firststime = st
-                            minrss = rss
-                            maxrss = rss
-                            minupct = upc
-                            maxupct = upc
-                            minspct = spc
-                            maxspct = spc
-                            mintpct = tpc
-                            maxtpct = tpc
-                        else:
-                            minrss = min(minrss, rss)
-                            maxrss = max(maxrss, rss)
-                            minupct = min(minupct, upc)
-                            maxupct = max(maxupct, upc)
-                            minspct = min(minspct, spc)
-                            maxspct = max(maxspct, spc)
-                            mintpct = min(mintpct, tpc)
-                            maxtpct = max(maxtpct, tpc)
-
-                        n += 1
-
-                    lastwtime = wt
-                    lastutime = ut
-                    laststime = st
+                ts = time.time_ns()
 
+                try:
+                    ut, st, rss = _stat(os.pread(procfd, 4096, 0))
+                    samples[n] = ts
+                    samples[n + 1] = 0
+                    samples[n + 2] = ut
+                    samples[n + 3] = st
+                    samples[n + 4] = rss
+                    n += ROW_FIELDS
                 except:
                     # Ignore errors
                     pass
 
+                for tid, fd in list(taskfds.items()):
+                    try:
+                        ut, st, _ = _stat(os.pread(fd, 4096, 0))
+                    except:
+                        os.close(fd)
+                        del taskfds[tid]
+                        continue
+                    samples[n] = ts
+                    samples[n + 1] = tid
+                    samples[n + 2] = ut
+                    samples[n + 3] = st
+                    samples[n + 4] = 0
+                    n += ROW_FIELDS
+
                 time.sleep(delay)
 
             # Something went wrong
             if n == 0:
                 continue
 
-            wtime = int((wt - refwtime) * 1000000)
-            utime = int(ut * 1000000)
-            stime = int(st * 1000000)
+            # Names of the threads first seen or renamed in the interval
 
-            avgrss /= n
-            avgupct = ((ut - firstutime) * 100 / (wt - firstwtime))
-            avgspct = ((st - firststime) * 100 / (wt - firstwtime))
-            avgtpct = ((ut - firstutime + st - firststime) * 100 / (wt - firstwtime))
+            current.update(self.ThreadNames(taskfds))
+            names = {tid: name for tid, name in current.items()
+                if written.get(tid) != name}
+            written.update(names)
+            names = json.dumps({str(tid): name for tid, name in
+                names.items()}).encode('utf8') if names else b''
 
-            if not self.stop:
-                self.Dump(cpuheader, [self.nw, wtime, utime, stime, minupct,
-                    maxupct, avgupct, minspct, maxspct, avgspct, mintpct,
-                    maxtpct, avgtpct], 'cpu', isnew)
-                self.Dump(memheader, [wtime, minrss, maxrss, avgrss], 'cpumem', isnew)
-                isnew = False
+            try:
+                f.write(_block.pack(n // ROW_FIELDS, len(names)))
+                f.write(names)
+                f.write(memoryview(samples)[:n])
+                f.flush()
+            except:
+                # Ignore errors
+                pass
+
+        os.close(procfd)
+        for fd in taskfds.values():
+            os.close(fd)
 
         logging.info('PerfModule CPU thread stopped.')
 
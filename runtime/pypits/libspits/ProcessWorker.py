@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Otávio Napoli <otavio.napoli@gmail.com>
+# Copyright (c) 2020 Edson Borin <edson@ic.unicamp.br>
+# Copyright (c) 2015 Caian Benedicto <caian@ggaunicamp.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import ctypes
+import logging
+import mmap
+import multiprocessing
+import os
+import signal
+import tempfile
+
+from libspits import messaging
+
+PR_SET_PDEATHSIG = 1
+
+# Live workers of this process, their pipes are closed in forked processes
+_workers = set()
+
+
+class SharedBuffer(object):
+    """Growable memory region shared with forked processes.
+
+    The region is backed by an unlinked temporary file (in /dev/shm when
+    available) so it is released when every process using it exits.
+    Processes forked after the buffer is created share it; when the writer
+    grows the buffer, the reader maps the new size on its next read.
+    """
+
+    def __init__(self, size=1 << 20):
+        dirname = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        self._file = tempfile.TemporaryFile(dir=dirname)
+        os.ftruncate(self._file.fileno(), size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+
+    def _remap(self, size):
+        self._map.close()
+        self._map = mmap.mmap(self._file.fileno(), size)
+
+    def reserve(self, size):
+        """ Grow the buffer to at least size bytes and return a view of
+        its first size bytes. The view must be released before the buffer
+        grows again
+        """
+        if size > len(self._map):
+            newsize = max(size, 2 * len(self._map))
+            os.ftruncate(self._file.fileno(), newsize)
+            self._remap(newsize)
+        return memoryview(self._map)[:size]
+
+    def write(self, data):
+        """ Copy data to the beginning of the buffer, growing it if necessary
+        """
+        with self.reserve(len(data)) as view:
+            view[:] = data
+
+    def view(self, size):
+        """ Return a view of the first size bytes, written by another
+        process. The view must be released before the buffer grows again
+        """
+        if size > len(self._map):
+            self._remap(os.fstat(self._file.fileno()).st_size)
+        return memoryview(self._map)[:size]
+
+    def read(self, size):
+        """ Copy size bytes from the beginning of the buffer
+        """
+        with self.view(size) as view:
+            return view.tobytes()
+
+
+def _process_main(job, argv, conn, tasks, results, ppid):
+    """ Main routine of a forked worker. Tasks are read from the tasks buffer
+    and results written to the results buffer, the pipe only carries sizes
+    and return codes
+    """
+    # Die with the task manager, it exits without finalizing the workers
+    # when killed. The signal follows the forking thread, the workers of
+    # the task pool never exit
+    try:
+        ctypes.CDLL(None, use_errno=True).prctl(PR_SET_PDEATHSIG,
+                                                signal.SIGKILL)
+    except (OSError, AttributeError):
+        pass
+    if os.getppid() != ppid:
+        os._exit(0)
+
+    # Close the task manager side of the pipes inherited from the fork,
+    # otherwise recv never sees the end of the pipe
+    for worker in _workers:
+        worker.conn.close()
+
+    state = job.spits_worker_new(argv)
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, OSError):
+            # The task manager is gone
+            break
+        if msg is None:
+            break
+        taskctx, tasksz = msg
+        # The task is read and the result written in place
+        task = tasks.view(tasksz) if tasksz > 0 else None
+        r, res, ctx = job.spits_worker_run(state, task, taskctx,
+                                           out=results.reserve)
+        if task is not None:
+            task.release()
+        if res is None:
+            conn.send((r, None, ctx))
+            continue
+        ressz = len(res[0])
+        res[0].release()
+        conn.send((r, ressz, ctx))
+    job.spits_worker_finalize(state)
+
+
+class ProcessWorker(object):
+    """Worker state living in a forked process.
+
+    A crash inside the SPITS binary kills only the forked process. The task
+    being executed is reported as failed and a new process is forked
+    (calling spits_worker_new again) for the next task.
+    """
+
+    def __init__(self, job, argv):
+        """
+        :param job: The SPITS job binary object
+        :type job: JobBinary
+        :param argv: Arguments passed to spits_worker_new
+        :type argv: list of str
+        """
+        self.job = job
+        self.argv = argv
+        self.tasks = SharedBuffer()
+        self.results = SharedBuffer()
+        self.process = None
+        self.conn = None
+        self.spawn()
+        _workers.add(self)
+
+    def spawn(self):
+        """ Fork a new worker process
+        """
+        ctx = multiprocessing.get_context('fork')
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_process_main, args=(
+            self.job, self.argv, child_conn, self.tasks, self.results,
+            os.getpid()))
+        self.process.daemon = True
+        self.process.start()
+        # Keep only the child side in the child, so a crash closes the pipe
+        child_conn.close()
+        logging.info(f'Forked worker process {self.process.pid}')
+
+    def run(self, task, taskctx):
+        """ Run a task in the worker process
+
+        :param task: The task payload
+        :type task: bytes
+        :param taskctx: Task context (task id)
+        :type taskctx: int
+        :return: The same [return code, (result,), context] list returned by
+            JobBinary.spits_worker_run. If the process crashed, the return
+            code is res_module_error and the result is empty
+        :rtype: list
+        """
+        try:
+            if task:
+                self.tasks.write(task)
+            self.conn.send((taskctx, len(task) if task else 0))
+            r, ressz, ctx = self.conn.recv()
+        except (EOFError, OSError):
+            self.process.join()
+            logging.error(f'Worker process {self.process.pid} died with code '
+                          f'{self.process.exitcode} while executing task '
+                          f'{taskctx}!')
+            self.conn.close()
+            self.spawn()
+            return [messaging.res_module_error, (b'',), taskctx]
+
+        if ressz is None:
+            return [r, None, ctx]
+        return [r, (self.results.read(ressz),), ctx]
+
+    def finalize(self, timeout=None):
+        """ Stop the worker process
+
+        :param timeout: Seconds to wait for the task being executed before
+            killing the process, None to wait for it
+        :type timeout: float
+        """
+        _workers.discard(self)
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+    @staticmethod
+    def finalize_all(timeout=None):
+        """ Stop the worker processes of every ProcessWorker
+
+        :param timeout: Seconds to wait for each task being executed before
+            killing the process, None to wait for them
+        :type timeout: float
+        """
+        for worker in list(_workers):
+            worker.finalize(timeout)
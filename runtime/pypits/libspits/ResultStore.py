@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Otávio Napoli <otavio.napoli@gmail.com>
+# Copyright (c) 2020 Edson Borin <edson@ic.unicamp.br>
+# Copyright (c) 2015 Caian Benedicto <caian@ggaunicamp.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import collections
+import logging
+import mmap
+import os
+import tempfile
+import threading
+
+try:
+    import Queue as queue # Python 2
+except:
+    import queue # Python 3
+
+
+class _Segment(object):
+    """Spill file mapped in memory. Results are appended to it and the file
+    is released when all of them were read back
+    """
+
+    def __init__(self, dirname, size):
+        self.size = size
+        self.offset = 0
+        self.live = 0
+        self._file = tempfile.TemporaryFile(prefix='spits-results-',
+                                            dir=dirname)
+        os.ftruncate(self._file.fileno(), size)
+        self.map = mmap.mmap(self._file.fileno(), size)
+
+    def append(self, data):
+        offset = self.offset
+        self.map[offset:offset + len(data)] = data
+        self.offset += len(data)
+        self.live += 1
+        return offset
+
+    def close(self):
+        self.map.close()
+        self._file.close()
+
+
+class ResultStore(object):
+    """FIFO of task results with a memory budget.
+
+    When the results in memory exceed the memory budget, the oldest ones are
+    spilled to segment files in dirname and read back from there. When the
+    disk budget is also exhausted put() blocks until results are taken,
+    stalling the workers that produce them. A budget of None is unlimited.
+    """
+
+    def __init__(self, mem_budget=None, disk_budget=None, dirname=None,
+                 segment_size=64 << 20):
+        """
+        :param mem_budget: Maximum bytes of results kept in memory
+        :type mem_budget: int
+        :param disk_budget: Maximum bytes of results spilled to disk
+        :type disk_budget: int
+        :param dirname: Directory of the spill files
+        :type dirname: str
+        :param segment_size: Size of each spill file
+        :type segment_size: int
+        """
+        self.mem_budget = mem_budget
+        self.disk_budget = disk_budget
+        self.dirname = dirname or os.getcwd()
+        self.segment_size = segment_size
+        if disk_budget is not None:
+            self.segment_size = max(1, min(segment_size, disk_budget))
+        self.mem_bytes = 0
+        self.disk_bytes = 0
+        self.spilled = 0
+        # Items are (taskid, runid, r, res) in memory and
+        # (taskid, runid, r, (segment, offset, size)) on disk
+        self._disk = collections.deque()
+        self._mem = collections.deque()
+        self._segments = []
+        self._cond = threading.Condition()
+
+    @staticmethod
+    def _size(res):
+        return 0 if res is None else len(res)
+
+    @staticmethod
+    def _footprint(res):
+        # Results in arena buffers hold the whole buffer, not only the
+        # bytes of the result
+        if isinstance(res, memoryview) and res.obj is not None:
+            return max(res.nbytes, len(res.obj))
+        return 0 if res is None else len(res)
+
+    def _spill(self):
+        while self.mem_bytes > self.mem_budget and self._mem:
+            taskid, runid, r, res = self._mem[0]
+            size = self._size(res)
+            seg = self._segments[-1] if self._segments else None
+            if seg is None or seg.offset + size > seg.size:
+                segsize = max(self.segment_size, size)
+                if self.disk_budget is not None and \
+                    self.disk_bytes + segsize > self.disk_budget and \
+                    self._segments:
+                    return
+                seg = _Segment(self.dirname, segsize)
+                self._segments.append(seg)
+                self.disk_bytes += segsize
+            offset = seg.append(res) if size > 0 else seg.offset
+            if size == 0:
+                seg.live += 1
+            self._mem.popleft()
+            self.mem_bytes -= self._footprint(res)
+            self._disk.append((taskid, runid, r, (seg, offset, size)))
+            self.spilled += 1
+            logging.debug('Result of task %d spilled to disk', taskid)
+
+    def _release(self, seg):
+        seg.live -= 1
+        if seg.live == 0 and (seg is not self._segments[-1] or
+                              seg.offset == seg.size):
+            self._segments.remove(seg)
+            self.disk_bytes -= seg.size
+            seg.close()
+        elif seg.live == 0:
+            # The last segment is reused from the beginning
+            seg.offset = 0
+
+    def Full(self):
+        """ True when both the memory and the disk budgets are exhausted
+        """
+        with self._cond:
+            return self._full()
+
+    def _full(self):
+        # Results are spilled after every change, so results still over the
+        # memory budget did not fit in the disk budget
+        return self.mem_budget is not None and self.mem_bytes > self.mem_budget
+
+    def put(self, item, block=True):
+        """ Store a (taskid, runid, r, res) result
+
+        :param item: The result
+        :type item: tuple
+        :param block: Wait while the store is full. Results put back after a
+            failed transfer must not block
+        :type block: bool
+        """
+        with self._cond:
+            while block and self._full():
+                self._cond.wait()
+            self._mem.append(item)
+            self.mem_bytes += self._footprint(item[3])
+            if self.mem_budget is not None:
+                self._spill()
+
+    def get_nowait(self):
+        """ Take the oldest result
+
+        :raises queue.Empty: if there are no results
+        :rtype: tuple
+        """
+        with self._cond:
+            if self._disk:
+                taskid, runid, r, (seg, offset, size) = self._disk.popleft()
+                res = seg.map[offset:offset + size]
+                self._release(seg)
+                item = (taskid, runid, r, res)
+            elif self._mem:
+                item = self._mem.popleft()
+                self.mem_bytes -= self._footprint(item[3])
+            else:
+                raise queue.Empty()
+            if self.mem_budget is not None:
+                self._spill()
+            self._cond.notify_all()
+            return item
+
+    def qsize(self):
+        with self._cond:
+            return len(self._disk) + len(self._mem)
+
+    def empty(self):
+        return self.qsize() == 0
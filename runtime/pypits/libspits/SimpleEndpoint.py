@@ -67,6 +67,9 @@ class SimpleEndpoint(Endpoint):
         self.socket = socket.socket(socktype, socket.SOCK_STREAM)
         self.socket.settimeout(timeout)
         self.socket.connect(sockaddr)
+        if socktype == socket.AF_INET:
+            # Messages are small and answered, do not delay them
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
     def Read(self, size, timeout):
         return messaging.recv(self.socket, size, timeout)
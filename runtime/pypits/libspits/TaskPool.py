@@ -22,7 +22,9 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS 
 # IN THE SOFTWARE.
 
-import threading, sys, logging
+import threading, sys, logging, time
+
+from .CpuUtils import available_cpus, cpu_pressure, pin_thread
 
 try:
     import Queue as queue # Python 2
@@ -34,7 +36,22 @@ class TaskPool(object):
     This class implements a pool of workers to process tasks
     '''
 
-    def __init__(self, max_threads, overfill, initializer, worker, user_args):
+    # Elastic mode: CPU pressure (%) above which workers are parked
+    pressure_high = 40.0
+    # Elastic mode: relative throughput gain expected from a new worker
+    min_gain = 0.05
+    # Elastic mode: intervals to wait before growing again after a
+    # worker did not improve the throughput
+    hold_intervals = 6
+    # Adaptive depth: weight of new samples in the moving averages
+    alpha = 0.2
+    # Adaptive depth: maximum queued tasks per worker
+    max_depth_per_worker = 16
+
+    def __init__(self, max_threads, overfill, initializer, worker, user_args,
+                 elastic=False, interval=5.0, affinity=None, adaptive=False,
+                 byte_budget=None, pending_bytes=None, batch=1,
+                 batch_worker=None, queue_time=None):
         '''
         Create and initialize spits workers (threads) to process incoming tasks in the Pool
 
@@ -48,21 +65,150 @@ class TaskPool(object):
         :type worker: method(**kwargs)
         :param user_args: User parameters to initializer and worker methods
         :type user_args: tuple
+        :param elastic: Adjust the number of active workers to the available
+            CPUs, the CPU pressure and the task throughput. All max_threads
+            workers are created and initialized, the ones not needed are
+            parked
+        :type elastic: bool
+        :param interval: Interval (seconds) between adjustments in elastic
+            mode
+        :type interval: float
+        :param affinity: CPUs each worker is pinned to before calling the
+            initializer, so the memory it allocates is local to them
+        :type affinity: list of set of int
+        :param adaptive: Size the task queue from the measured task service
+            time, the interval between pushes and the rate results are
+            drained, queueing just enough tasks to keep the workers busy
+            until the next push (Little's law). overfill is used only until
+            there are enough measurements
+        :type adaptive: bool
+        :param byte_budget: Maximum bytes of task payloads queued or being
+            processed plus pending results. A task is always accepted when
+            nothing is using the budget
+        :type byte_budget: int
+        :param pending_bytes: Routine returning the bytes of results waiting
+            to be collected
+        :type pending_bytes: method()
+        :param batch: Maximum number of queued tasks a worker takes at once.
+            A worker takes only its share of the queued tasks
+        :type batch: int
+        :param batch_worker: Routine used to execute more than one task, it
+            receives a list of (taskid, jobid, task) instead of a single task
+        :type batch_worker: method(**kwargs)
+        :param queue_time: Timer that observes the seconds each task waited
+            in the queue
+        :type queue_time: Timer
         '''
         self.max_threads = max_threads
         self.user_args = user_args
         self.initializer = initializer
         self.worker = worker
-        self.tasks = queue.Queue(maxsize=max_threads + overfill)
-        self.threads = [threading.Thread(target=self.runner, name='Worker-{i}'.format(i=i)) for
+        self.adaptive = adaptive
+        self.overfill = overfill
+        # Without adaptive depth, the queue is bounded by the workers that
+        # may be active and the depth by the ones active now
+        self.depth = max_threads + overfill
+        self.tasks = queue.Queue(maxsize=0 if adaptive else self.depth)
+        self.service_time = None
+        self.push_interval = None
+        self.drain_rate = None
+        self.last_push = None
+        self.last_drain = None
+        self.byte_budget = byte_budget
+        self.pending_bytes = pending_bytes or (lambda: 0)
+        self.queued_bytes = 0
+        self.batch = batch if batch_worker is not None else 1
+        self.batch_worker = batch_worker
+        self.queue_time = queue_time
+        self.threads = [threading.Thread(target=self.runner, args=(i,),
+            name='Worker-{i}'.format(i=i)) for
             i in range(max_threads)]
+        self.elastic = elastic
+        self.affinity = affinity
+        self.interval = interval
+        self.active = max_threads
+        self.completed = 0
+        self.cond = threading.Condition()
+        if elastic:
+            self.active = max(1, min(max_threads, available_cpus()))
+            logging.info('Elastic task pool: %d of %d workers active',
+                self.active, max_threads)
+            if not adaptive:
+                self.depth = self.active + overfill
 
     def start(self):
         for t in self.threads:
             t.start()
+        if self.elastic:
+            t = threading.Thread(target=self.controller, name='Worker-control')
+            t.daemon = True
+            t.start()
+
+    def resize(self, active):
+        '''
+        Set the number of active workers, the others are parked after
+        finishing their current task
+
+        :param active: Number of active workers
+        :type active: int
+        '''
+        active = max(1, min(self.max_threads, active))
+        with self.cond:
+            if active == self.active:
+                return
+            logging.info('Resizing task pool from %d to %d active workers',
+                self.active, active)
+            self.active = active
+            if not self.adaptive:
+                self.depth = active + self.overfill
+            self.cond.notify_all()
+
+    def controller(self):
+        last_rate = None
+        grown = False
+        hold = 0
+        last_completed = self.completed
+        while True:
+            time.sleep(self.interval)
+            completed = self.completed
+            rate = (completed - last_completed) / self.interval
+            last_completed = completed
+            limit = available_cpus()
+            pressure = cpu_pressure()
+            hold = max(0, hold - 1)
+            if self.active > limit:
+                self.resize(limit)
+                grown = False
+            elif pressure is not None and pressure > self.pressure_high and \
+                self.active > 1:
+                self.resize(self.active - 1)
+                grown = False
+            elif grown and last_rate is not None and \
+                rate <= last_rate * (1 + self.min_gain):
+                # The last worker did not pay off
+                self.resize(self.active - 1)
+                grown = False
+                hold = self.hold_intervals
+            elif not self.tasks.empty() and self.active < limit and hold == 0:
+                self.resize(self.active + 1)
+                grown = True
+            else:
+                grown = False
+            last_rate = rate
+
+    def park(self, index):
+        with self.cond:
+            while index >= self.active:
+                self.cond.wait()
 
-    def runner(self):
+    def runner(self, index):
         state = None
+        if self.affinity:
+            try:
+                pin_thread(self.affinity[index])
+            except:
+                logging.warning('Could not pin worker %d to CPUs %s', index,
+                    sorted(self.affinity[index]))
         try:
             # Initialize the module worker
             state = self.initializer(*self.user_args)
@@ -72,22 +218,133 @@ class TaskPool(object):
         while True:
             # Pick a task from the queue and execute it
             # TODO better tm kill
-            taskid, jobid, task = self.tasks.get()
+            self.park(index)
+            taskid, jobid, task, queued = self.tasks.get()
+            items = [(taskid, jobid, task)]
+            waits = [queued]
+            if self.batch > 1:
+                extra = min(self.batch - 1,
+                    self.tasks.qsize() // max(1, self.active))
+                for i in range(extra):
+                    try:
+                        item = self.tasks.get_nowait()
+                    except queue.Empty:
+                        break
+                    items.append(item[:3])
+                    waits.append(item[3])
+            start = time.monotonic()
+            if self.queue_time is not None:
+                for queued in waits:
+                    self.queue_time.observe(start - queued)
             try:
-                self.worker(state, taskid, jobid, task, *self.user_args)
+                if len(items) == 1:
+                    self.worker(state, taskid, jobid, task, *self.user_args)
+                else:
+                    self.batch_worker(state, items, *self.user_args)
             except:
                 logging.error('The worker crashed while processing ' +
-                    'the task %d', taskid)
+                    'the tasks %s', [item[0] for item in items])
+            with self.cond:
+                self.completed += len(items)
+                for item in items:
+                    self.queued_bytes -= 0 if item[2] is None else len(item[2])
+                self.service_time = self.average(self.service_time,
+                    (time.monotonic() - start) / len(items))
+
+    def average(self, value, sample):
+        if value is None:
+            return sample
+        return value + self.alpha * (sample - value)
+
+    def NotePush(self):
+        '''
+        Called when the job manager starts pushing tasks
+        '''
+        now = time.monotonic()
+        with self.cond:
+            if self.last_push is not None:
+                self.push_interval = self.average(self.push_interval,
+                    now - self.last_push)
+            self.last_push = now
+            if self.adaptive:
+                self.update_depth()
 
-    def Put(self, taskid, jobid, task):
+    def NoteDrain(self, count):
+        '''
+        Called after the committer reads results
+
+        :param count: Number of results read
+        :type count: int
+        '''
+        now = time.monotonic()
+        with self.cond:
+            if self.last_drain is not None and now > self.last_drain:
+                self.drain_rate = self.average(self.drain_rate,
+                    count / (now - self.last_drain))
+            self.last_drain = now
+
+    def update_depth(self):
+        if not self.service_time or self.push_interval is None:
+            return
+        # Tasks consumed by the workers until the next push
+        rate = self.active / self.service_time
+        if self.drain_rate is not None:
+            # Do not queue faster than the results are collected
+            rate = min(rate, max(self.drain_rate, 1.0 / self.service_time))
+        depth = int(rate * self.push_interval) + 1
+        depth = max(1, min(depth, self.max_depth_per_worker * self.max_threads))
+        if depth != self.depth:
+            logging.debug('Task queue depth set to %d', depth)
+            self.depth = depth
+
+    def Capacity(self):
+        '''
+        Number of tasks that can be queued now
+        '''
+        return max(0, self.depth - self.tasks.qsize())
+
+    def FreeBytes(self):
+        '''
+        Bytes of the budget still available, -1 if any task is accepted
+        '''
+        if self.byte_budget is None:
+            return -1
+        with self.cond:
+            used = self.queued_bytes + self.pending_bytes()
+        if used == 0:
+            return -1
+        return max(0, self.byte_budget - used)
+
+    def Put(self, taskid, jobid, task, block=False):
+        '''
+        Queue a task. Returns False when the pool is full, unless block is
+        set, then wait until there is room in the queue
+        '''
+        if block:
+            with self.cond:
+                self.queued_bytes += 0 if task is None else len(task)
+            self.tasks.put((taskid, jobid, task, time.monotonic()))
+            return True
+        if self.tasks.qsize() >= self.depth:
+            return False
+        size = 0 if task is None else len(task)
+        free = self.FreeBytes()
+        if free >= 0 and size > free:
+            return False
+        with self.cond:
+            self.queued_bytes += size
         try:
-            self.tasks.put_nowait((taskid, jobid, task))
+            self.tasks.put_nowait((taskid, jobid, task, time.monotonic()))
         except queue.Full:
+            with self.cond:
+                self.queued_bytes -= size
             return False
         return True
 
     def Full(self):
-        return self.tasks.full()
+        if self.FreeBytes() == 0:
+            return True
+        return self.tasks.qsize() >= self.depth
 
     def Empty(self):
         return self.tasks.empty()
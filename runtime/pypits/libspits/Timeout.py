@@ -24,11 +24,82 @@
 # IN THE SOFTWARE.
 
 
+import heapq
+import itertools
 import logging
+import time
 import traceback
-import inspect
-from threading import Timer
-from threading import Lock
+from threading import Condition, Thread
+
+class Watchdog(object):
+    """
+    Single thread that fires the callbacks of many Timeout objects.
+
+    Deadlines are kept in a heap. Resetting a timeout only updates its
+    deadline, the heap entry is moved when it reaches the top of the heap.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = Condition()
+        self._thread = None
+
+    def schedule(self, t, deadline):
+        """ Set the deadline of t, a monotonic time or None to cancel it
+
+        :param t: Timeout to schedule
+        :type t: Timeout
+        :param deadline: New deadline, as returned by time.monotonic()
+        :type deadline: float
+        """
+        with self._cond:
+            t._deadline = deadline
+            if deadline is None or t._scheduled:
+                return
+            t._scheduled = True
+            heapq.heappush(self._heap, (deadline, next(self._seq), t))
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='Watchdog')
+                self._thread.daemon = True
+                self._thread.start()
+            elif self._heap[0][2] is t:
+                self._cond.notify()
+
+    def _next_expired(self):
+        with self._cond:
+            while True:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                deadline, _, t = self._heap[0]
+                if t._deadline is None:
+                    # Cancelled
+                    heapq.heappop(self._heap)
+                    t._scheduled = False
+                elif t._deadline != deadline:
+                    # Reset since it was pushed
+                    heapq.heapreplace(self._heap,
+                        (t._deadline, next(self._seq), t))
+                else:
+                    now = time.monotonic()
+                    if deadline > now:
+                        self._cond.wait(deadline - now)
+                        continue
+                    heapq.heappop(self._heap)
+                    t._scheduled = False
+                    t._deadline = None
+                    return t
+
+    def _run(self):
+        while True:
+            t = self._next_expired()
+            try:
+                t._callback()
+            except:
+                logging.debug(traceback.format_exc())
+
+_watchdog = Watchdog()
 
 def timeout(timeout, callback, *args, **kwargs):
     if timeout is None or timeout <= 0:
@@ -43,35 +114,22 @@ class TimeoutNoop(object):
         pass
 
 class Timeout(object):
-    def __init__(self, timeout, callback, args=[], kwargs={}):
+    def __init__(self, timeout, callback, args=[], kwargs={},
+                 watchdog=None):
         self.timeout = timeout
         self.callback = callback
         self._args = args
         self._kwargs = kwargs
-        self._timer = None
-        self._lock = Lock()
+        self._watchdog = watchdog or _watchdog
+        self._deadline = None
+        self._scheduled = False
 
     def _callback(self):
         if self.callback(*self._args, **self._kwargs):
             self.reset()
 
     def reset(self):
-        _frame = inspect.currentframe()
-        frame = _frame.f_back
-        fname = frame.f_code.co_filename
-        fnum = frame.f_lineno
-        self._lock.acquire()
-        self._cancel()
-        self._timer = Timer(self.timeout, self._callback)
-        self._timer.start()
-        self._lock.release()
-
-    def _cancel(self):
-        if self._timer is not None:
-            self._timer.cancel()
-            self._timer = None
+        self._watchdog.schedule(self, time.monotonic() + self.timeout)
 
     def cancel(self):
-        self._lock.acquire()
-        self._cancel()
-        self._lock.release()
+        self._watchdog.schedule(self, None)
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Otávio Napoli <otavio.napoli@gmail.com>
+# Copyright (c) 2020 Edson Borin <edson@ic.unicamp.br>
+# Copyright (c) 2015 Caian Benedicto <caian@ggaunicamp.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+
+# Per-process trace files. After the header (magic, version, size of the
+# JSON description of the process and the description) the file is a
+# sequence of records starting with their kind:
+#
+# stage   kind:u8 ts:i64 taskid:i64 thread:u16 peer:u16
+# name    0xFF index:u16 size:u16 utf8
+# clock   0xFE offset:i64 rtt:i64 peer:u16
+#
+# Timestamps are nanoseconds since the epoch in the clock of the process.
+# Threads and peers are indexes of the names defined before them, 0 is
+# none.
+
+_magic = b'SPTR'
+_header = struct.Struct('!4sBH')
+_kind = struct.Struct('!B')
+_stage = struct.Struct('!qqHH')
+_name = struct.Struct('!HH')
+_clock = struct.Struct('!qqH')
+
+_kind_name = 0xFF
+_kind_clock = 0xFE
+
+
+class Tracer(object):
+    """Record the lifecycle stages of tasks in a per-process trace file.
+
+    Records are buffered and written when the buffer is full and when the
+    tracer is flushed or closed.
+    """
+
+    # Task lifecycle stages
+    GENERATED = 1   # Job manager: task generated by the binary
+    SENT = 2        # Job manager: task sent to a task manager
+    RECEIVED = 3    # Task manager: task received from the job manager
+    DEQUEUED = 4    # Task manager: task taken by a worker
+    RUN_START = 5   # Task manager: binary called to run the task
+    RUN_END = 6     # Task manager: binary returned
+    ENQUEUED = 7    # Task manager: result queued for the committer
+    PULLED = 8      # Task manager: result sent to the committer
+    COMMITTED = 9   # Job manager: result committed by the binary
+
+    stages = {
+        GENERATED: 'generated', SENT: 'sent', RECEIVED: 'received',
+        DEQUEUED: 'dequeued', RUN_START: 'run start', RUN_END: 'run end',
+        ENQUEUED: 'enqueued', PULLED: 'pulled', COMMITTED: 'committed'
+    }
+
+    def __init__(self, dirname, role, name=None, buffer_size=64 << 10):
+        """
+        :param dirname: Directory of the trace file
+        :type dirname: str
+        :param role: jobmanager or taskmanager
+        :type role: str
+        :param name: Name of the process in the trace, also the file name
+        :type name: str
+        :param buffer_size: Bytes buffered before writing to the file
+        :type buffer_size: int
+        """
+        self.name = name or f'{role}-{socket.gethostname()}-{os.getpid()}'
+        self.filename = os.path.join(dirname, self.name + '.trace')
+        self.buffer_size = buffer_size
+        self.names = {}
+        self.buffer = bytearray()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        os.makedirs(dirname, exist_ok=True)
+        self.file = open(self.filename, 'wb')
+        info = json.dumps(dict(name=self.name, role=role, pid=os.getpid(),
+            host=socket.gethostname())).encode('utf8')
+        self.file.write(_header.pack(_magic, 1, len(info)))
+        self.file.write(info)
+
+    def _index(self, name):
+        # Must be called with the lock held
+        index = self.names.get(name)
+        if index is None:
+            index = len(self.names) + 1
+            self.names[name] = index
+            data = name.encode('utf8')
+            self.buffer += _kind.pack(_kind_name)
+            self.buffer += _name.pack(index, len(data))
+            self.buffer += data
+        return index
+
+    def record(self, stage, taskid, peer=None):
+        """ Record a stage of a task in the current thread
+
+        :param stage: One of the stage constants
+        :type stage: int
+        :param peer: Process at the other end, if any
+        :type peer: str
+        """
+        ts = time.time_ns()
+        thread = threading.current_thread().name
+        with self.lock:
+            t = self._index(thread)
+            p = 0 if peer is None else self._index(peer)
+            self.buffer += _kind.pack(stage)
+            self.buffer += _stage.pack(ts, taskid, t, p)
+            if len(self.buffer) >= self.buffer_size:
+                self._flush()
+
+    def clock(self, peer, offset, rtt):
+        """ Record the offset of the clock of the peer process relative to
+        this one, measured with the given round trip time (nanoseconds)
+        """
+        with self.lock:
+            p = self._index(peer)
+            self.buffer += _kind.pack(_kind_clock)
+            self.buffer += _clock.pack(offset, rtt, p)
+
+    def _flush(self):
+        self.file.write(self.buffer)
+        self.buffer = bytearray()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file.closed:
+                return
+            self._flush()
+            self.file.close()
+
+
+def sync_clock(conn, tracer, timeout):
+    """ Estimate the clock offset of the process at the other end of conn
+    (which must answer msg_cd_query_clock) and record it in tracer
+    """
+    from .messaging import msg_cd_query_clock
+    t0 = time.time_ns()
+    conn.WriteInt64(msg_cd_query_clock)
+    remote = conn.ReadInt64(timeout)
+    name = conn.ReadString(timeout)
+    t1 = time.time_ns()
+    if name:
+        tracer.clock(name, remote - (t0 + t1) // 2, t1 - t0)
+
+
+def serve_clock(conn, tracer):
+    """ Answer a msg_cd_query_clock with the time of this process and the
+    name of its trace
+    """
+    conn.WriteInt64(time.time_ns())
+    conn.WriteString('' if tracer is None else tracer.name)
+
+
+def read_trace(filename):
+    """ Read a trace file
+
+    :return: The process description, the list of stage records as
+        (stage, ts, taskid, thread, peer) and the list of clock records
+        as (peer, offset, rtt)
+    :rtype: tuple
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    magic, version, size = _header.unpack_from(data, 0)
+    if magic != _magic:
+        raise ValueError(f'{filename} is not a trace file')
+    pos = _header.size
+    info = json.loads(data[pos:pos + size].decode('utf8'))
+    pos += size
+    names = {0: None}
+    records = []
+    clocks = []
+    while pos < len(data):
+        kind, = _kind.unpack_from(data, pos)
+        pos += _kind.size
+        if kind == _kind_name:
+            index, size = _name.unpack_from(data, pos)
+            pos += _name.size
+            names[index] = data[pos:pos + size].decode('utf8')
+            pos += size
+        elif kind == _kind_clock:
+            offset, rtt, peer = _clock.unpack_from(data, pos)
+            pos += _clock.size
+            clocks.append((names[peer], offset, rtt))
+        else:
+            if pos + _stage.size > len(data):
+                break  # Truncated by a crash
+            ts, taskid, thread, peer = _stage.unpack_from(data, pos)
+            pos += _stage.size
+            records.append((kind, ts, taskid, names[thread], names[peer]))
+    return info, records, clocks
+
+
+# Spans drawn between two stages of a task in the same process
+_spans = [
+    (Tracer.GENERATED, Tracer.SENT, 'waiting to be sent'),
+    (Tracer.RECEIVED, Tracer.DEQUEUED, 'queued'),
+    (Tracer.RUN_START, Tracer.RUN_END, 'run'),
+    (Tracer.ENQUEUED, Tracer.PULLED, 'waiting to be pulled'),
+]
+
+# Arrows drawn between processes
+_flows = [
+    (Tracer.SENT, Tracer.RECEIVED, 'task'),
+    (Tracer.PULLED, Tracer.COMMITTED, 'result'),
+]
+
+
+def merge_traces(filenames):
+    """ Merge trace files into a Chrome/Perfetto trace. Timestamps are
+    moved to the clock of the process that measured the offsets of the
+    others (the job manager), using the measurement with the shortest
+    round trip of each process
+
+    :rtype: dict
+    """
+    traces = [read_trace(f) for f in filenames]
+
+    # Pick the best clock offset of each process
+    offsets = {}
+    reference = None
+    for info, records, clocks in traces:
+        if clocks and reference is None:
+            reference = info['name']
+        for peer, offset, rtt in clocks:
+            if peer not in offsets or rtt < offsets[peer][1]:
+                offsets[peer] = (offset, rtt)
+    if reference is None and traces:
+        reference = traces[0][0]['name']
+    offsets[reference] = (0, 0)
+
+    events = []
+    first = None
+    for info, records, clocks in traces:
+        if info['name'] not in offsets:
+            logging.warning('No clock offset for %s, its times are not '
+                            'corrected', info['name'])
+        offset = offsets.get(info['name'], (0, 0))[0]
+        for i, record in enumerate(records):
+            records[i] = (record[0], record[1] - offset) + record[2:]
+            if first is None or records[i][1] < first:
+                first = records[i][1]
+
+    def us(ts):
+        return (ts - first) / 1000.0
+
+    for pid, (info, records, clocks) in enumerate(traces, 1):
+        events.append(dict(name='process_name', ph='M', pid=pid,
+                           args=dict(name=info['name'])))
+        tids = {}
+        starts = {}
+        for stage, ts, taskid, thread, peer in records:
+            if thread not in tids:
+                tids[thread] = len(tids) + 1
+                events.append(dict(name='thread_name', ph='M', pid=pid,
+                                   tid=tids[thread], args=dict(name=thread)))
+            tid = tids[thread]
+            args = dict(task=taskid)
+            if peer is not None:
+                args['peer'] = peer
+            events.append(dict(name=Tracer.stages.get(stage, str(stage)),
+                               ph='i', s='t', ts=us(ts), pid=pid, tid=tid,
+                               args=args))
+            for begin, end, name in _spans:
+                if stage == begin:
+                    starts[(begin, taskid)] = ts
+                elif stage == end and (begin, taskid) in starts:
+                    start = starts.pop((begin, taskid))
+                    events.append(dict(name=name, ph='X', ts=us(start),
+                                       dur=us(ts) - us(start), pid=pid,
+                                       tid=tid, args=dict(task=taskid)))
+            # Viewers drop the ends of flows without a start
+            for begin, end, name in _flows:
+                if stage == begin:
+                    events.append(dict(name=name, cat=name, ph='s',
+                                       id=f'{name}-{taskid}', ts=us(ts),
+                                       pid=pid, tid=tid))
+                elif stage == end:
+                    events.append(dict(name=name, cat=name, ph='f', bp='e',
+                                       id=f'{name}-{taskid}', ts=us(ts),
+                                       pid=pid, tid=tid))
+
+    return dict(traceEvents=events, displayTimeUnit='ms')
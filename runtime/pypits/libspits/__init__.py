@@ -35,8 +35,23 @@ from .ClientEndpoint import ClientEndpoint
 from .Listener import Listener
 from .TaskPool import TaskPool
 from .Timeout import timeout
-from .PerfModule import PerfModule
+from .PerfModule import PerfModule, read_samples
 from .UIDUtils import make_uid
+from .Journal import Journal
+from .MemoStore import MemoStore
+from .CpuUtils import available_cpus, cpu_pressure, worker_cpusets, \
+    affinity_policies
+from .ProcessWorker import ProcessWorker
+from .ResultStore import ResultStore
+from .BufferArena import BufferArena
+from .Histogram import Histogram, query_histograms
+from .MetricAggregator import MetricAggregator
+from .OpenMetrics import exposition, metrics_handler
+from .Trace import Tracer, sync_clock, serve_clock, read_trace, \
+    merge_traces
+from .EventLog import EventLog, EventLogReader, read_events
+from .MetricCodec import encode_metrics, decode_metrics, \
+    query_metrics_since
 
 
 def main():
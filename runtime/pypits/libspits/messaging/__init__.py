@@ -38,6 +38,8 @@ msg_send_full  = 0x0203
 msg_send_rjct  = 0x0204
 
 msg_read_result = 0x0101
+msg_read_accept = 0x0102
+msg_read_skip  = 0x0103
 msg_read_empty = 0x0000
 msg_terminate = 0xFFFF
 
@@ -48,13 +50,17 @@ msg_cd_query_metrics_history = 0x403
 msg_cd_nodes_append = 0x404
 msg_cd_nodes_list = 0x405
 msg_cd_nodes_remove = 0x406
+msg_cd_query_metrics_since = 0x407
+msg_cd_query_clock = 0x408
+msg_cd_query_histograms = 0x409
 
 # Signal the spits system through the upper 32
 # bits of the result variable that an error
-# occurred with the function call itself
-res_module_error = 0xFFFFFFFF00000000
-res_module_noans = 0xFFFFFFFE00000000
-res_module_ctxer = 0xFFFFFFFD00000000
+# occurred with the function call itself. The values are
+# kept signed so they can be sent with WriteInt64
+res_module_error = 0xFFFFFFFF00000000 - (1 << 64)
+res_module_noans = 0xFFFFFFFE00000000 - (1 << 64)
+res_module_ctxer = 0xFFFFFFFD00000000 - (1 << 64)
 
 # Definition of the recv method for sockets, considering
 # a definite size and timeout
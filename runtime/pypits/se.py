@@ -23,132 +23,313 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS 
 # IN THE SOFTWARE.
 
-from utils import JobBinary, SimpleEndpoint
-from utils import messaging, config
 
-import Args
-import sys, threading, os, time, ctypes, logging, struct, threading, traceback
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+from libspits import JobBinary, TaskPool, Pointer
+from libspits import setup_log, get_logger, log_lines
+from libspits import messaging, available_cpus
+from libspits.JobBinary import MetricManager
+
+try:
+    import Queue as queue  # Python 2
+except ImportError:
+    import queue  # Python 3
+
+# Global configuration parameters
+se_nw = 0           # Number of workers
+se_overfill = 0     # Extra space in the task queue
+se_batch = 1        # Maximum tasks run by a worker in a single call
+se_gen_batch = 1    # Maximum tasks generated in a single call
+se_commit_batch = 64  # Maximum results committed in a single call
+se_log_file = None  # Output file for logging
+se_verbosity = 0    # Verbosity level for logging
+spits_binary = ''
+spits_binary_args = []
+
+logger = get_logger(os.path.basename(sys.argv[0]))
+
 
 ###############################################################################
 # Parse global configuration
 ###############################################################################
-def parse_global_config(argdict):
-    pass
+def parse_global_config(arguments):
+    """ Parse the command-line arguments to global variables
+    """
+    global se_nw, se_overfill, se_batch, se_gen_batch, se_log_file, \
+        se_verbosity, spits_binary, spits_binary_args
+
+    parser = argparse.ArgumentParser(
+        description="SPITS single process executor. Runs the job manager, "
+                    "the workers and the committer of a job in this process, "
+                    "without sockets")
+    parser.add_argument('binary', metavar='PATH', type=str,
+                        help='Path to the SPITS binary')
+    parser.add_argument('binary_args', metavar='ARGS', type=str,
+                        nargs=argparse.REMAINDER,
+                        help='SPITS binary arguments')
+    parser.add_argument('--nw', action='store', type=int,
+                        default=available_cpus(),
+                        help='Number of workers (default: CPUs available, '
+                             '%(default)s)')
+    parser.add_argument('--overfill', action='store', type=int, default=None,
+                        help='Extra space in the task queue (default: the '
+                             'number of workers)')
+    parser.add_argument('--batch', action='store', type=int, default=1,
+                        help='Maximum number of queued tasks a worker runs '
+                             'in a single call to the binary')
+    parser.add_argument('--gen-batch', action='store', type=int, default=1,
+                        help='Maximum number of tasks generated in a single '
+                             'call to the binary')
+    parser.add_argument('--log', action='store', type=str, default=None,
+                        help='Log file')
+    parser.add_argument('--verbose', action='store', type=int, default=0,
+                        help='Verbosity level: 0 (error), 1 (info) or '
+                             '2 (debug)')
+
+    args = parser.parse_args(arguments)
+    se_nw = max(1, args.nw)
+    se_overfill = se_nw if args.overfill is None else args.overfill
+    se_batch = max(1, args.batch)
+    se_gen_batch = max(1, args.gen_batch)
+    se_log_file = args.log
+    se_verbosity = args.verbose
+    spits_binary = args.binary
+    spits_binary_args = args.binary_args
 
-###############################################################################
-# Configure the log output format
-###############################################################################
-def setup_log():
-    root = logging.getLogger()
-    root.setLevel(logging.DEBUG)
-    root.handlers = []
-    ch = logging.StreamHandler(sys.stderr)
-    ch.setLevel(logging.DEBUG)
-    formatter = logging.Formatter('%(asctime)s - %(threadName)s - '+
-        '%(levelname)s - %(message)s')
-    ch.setFormatter(formatter)
-    root.addHandler(ch)
 
 ###############################################################################
-# Abort the aplication with message
+# Initializer routine for the worker
 ###############################################################################
-def abort(error):
-    logging.critical(error)
-    exit(1)
+def initializer(rqueue, job, argv):
+    logger.info('Initializing worker...')
+    return job.spits_worker_new(argv)
 
 
 ###############################################################################
-# Run routine
+# Send the outcome of a task to the commit loop
 ###############################################################################
-def run(argv, job):
-    jm = job.spits_job_manager_new(argv)
-    co = job.spits_committer_new(argv)
-    wk = job.spits_worker_new(argv)
-    taskid = 0
+def report(taskid, runid, r, res, ctx, rqueue):
+    if res is None:
+        logger.error('Task %d did not push any result!', taskid)
+        rqueue.put((taskid, runid, messaging.res_module_noans, None))
+    elif ctx != taskid:
+        logger.error('Context verification failed for task %d!', taskid)
+        rqueue.put((taskid, runid, messaging.res_module_ctxer, None))
+    else:
+        rqueue.put((taskid, runid, r, res[0]))
 
 
-    while True:
-        taskid += 1
+###############################################################################
+# Worker routine
+###############################################################################
+def worker(state, taskid, runid, task, rqueue, job, argv):
+    logger.debug('Processing task %d from job %d...', taskid, runid)
+    try:
+        # Results are written to reusable buffers, returned to the arena
+        # after being committed
+        r, res, ctx = job.spits_worker_run(state, task, taskid,
+                                           out=job.arena.acquire)
+    except:
+        logger.error('The worker crashed while processing task %d!', taskid)
+        log_lines(traceback.format_exc(), logger.debug)
+        r, res, ctx = messaging.res_module_error, None, taskid
+    report(taskid, runid, r, res, ctx, rqueue)
 
-        r1, task = job.spits_job_manager_next_task(jm)
-        
-        if r1 == 0:
-            break
 
-        #logging.debug('Generated task %d.', taskid)
+###############################################################################
+# Batch worker routine
+###############################################################################
+def batch_worker(state, items, rqueue, job, argv):
+    taskids = [taskid for taskid, runid, task in items]
+    # The contexts of a batch must be unique
+    if len(set(taskids)) != len(taskids):
+        for taskid, runid, task in items:
+            worker(state, taskid, runid, task, rqueue, job, argv)
+        return
+
+    logger.debug('Processing tasks %s...', taskids)
+    try:
+        results = job.spits_worker_run_batch(
+            state, [task for _, _, task in items], taskids,
+            out=job.arena.acquire)
+    except:
+        logger.error('The worker crashed while processing tasks %s!', taskids)
+        log_lines(traceback.format_exc(), logger.debug)
+        results = [(messaging.res_module_error, None, taskid)
+                   for taskid in taskids]
+    for (taskid, runid, task), (r, res, ctx) in zip(items, results):
+        report(taskid, runid, r, res, ctx, rqueue)
 
-        #logging.info('Processing task %d...', taskid)
 
-        r2, res, ctx = job.spits_worker_run(wk, task, taskid)
+###############################################################################
+# Generator routine
+###############################################################################
+def generate(job, jm, tpool, rqueue, runid, progress):
+    """ Generate the tasks of the job and queue them in the task pool. The
+    number of tasks queued is left in progress['generated'] and a None is
+    sent to the commit loop at the end
+    """
+    taskid = 0
+    try:
+        while True:
+            if se_gen_batch > 1:
+                newtasks = job.spits_job_manager_next_tasks(
+                    jm, list(range(taskid + 1, taskid + 1 + se_gen_batch)))
+            else:
+                r, task, ctx = job.spits_job_manager_next_task(jm, taskid + 1)
+                newtasks = [] if r == 0 else \
+                    [(taskid + 1, None if task is None or ctx != taskid + 1
+                      else task[0])]
+
+            for newtaskid, newtask in newtasks:
+                taskid = newtaskid
+                if newtask is None:
+                    logger.error(f'Task {taskid} was not pushed or failed '
+                                 f'the context verification!')
+                    continue
+                tpool.Put(taskid, runid, newtask, block=True)
+                progress['generated'] += 1
+
+            if len(newtasks) < se_gen_batch:
+                break
+    except:
+        logger.error('Error generating tasks!')
+        log_lines(traceback.format_exc(), logger.debug)
+    rqueue.put(None)
 
-        logging.info('Task %d processed.', taskid)
 
-        if res == None:
-            logging.error('Task %d did not push any result!', taskid)
-            continue
-
-        if ctx != taskid:
-            logging.error('Context verification failed for task %d!', taskid)
-            continue
+###############################################################################
+# Commit a group of results
+###############################################################################
+def commit(job, co, items, progress):
+    results = []
+    for taskid, runid, r, res in items:
+        if r != 0:
+            progress['errors'] += 1
+            logger.error('The task %d was not successfully executed, '
+                         'worker returned %d!', taskid, r)
+        if res is not None:
+            results.append((taskid, res))
+
+    if len(results) == 1:
+        rets = [job.spits_committer_commit_pit(co, results[0][1])]
+    else:
+        rets = job.spits_committer_commit_pits(co, [res for _, res in results])
+
+    for (taskid, res), r in zip(results, rets):
+        job.arena.release(res)
+        if r != 0:
+            progress['errors'] += 1
+            logger.error('The task %d was not successfully committed, '
+                         'committer returned %d', taskid, r)
+        else:
+            progress['committed'] += 1
 
-        r3 = job.spits_committer_commit_pit(co, res[0])
 
-        if r3 != 0:
-            logging.error('The task %d was not successfully committed, ' +
-                'committer returned %d', taskid, r3)
+###############################################################################
+# Run routine
+###############################################################################
+def run(argv, jobinfo, job, tpool, rqueue, runid):
+    jm = job.spits_job_manager_new(argv, jobinfo)
+    co = job.spits_committer_new(argv, jobinfo)
+
+    progress = dict(generated=0, received=0, committed=0, errors=0)
+    start = time.monotonic()
+
+    # The tasks are generated in another thread while results are
+    # committed in this one
+    generator = threading.Thread(target=generate, name='Generator',
+        args=(job, jm, tpool, rqueue, runid, progress))
+    generator.start()
+
+    generated = False
+    while not generated or progress['received'] < progress['generated']:
+        item = rqueue.get()
+        if item is None:
+            generated = True
             continue
+        items = [item]
+        while len(items) < se_commit_batch:
+            try:
+                item = rqueue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                generated = True
+                break
+            items.append(item)
+        progress['received'] += len(items)
+        commit(job, co, items, progress)
+
+    generator.join()
+    elapsed = time.monotonic() - start
+    logger.info(f'Job {runid}: {progress["committed"]} tasks committed, '
+                f'{progress["errors"]} errors, in {elapsed:.3f}s '
+                f'({progress["received"] / max(elapsed, 1e-9):.1f} tasks/s)')
 
     job.spits_job_manager_finalize(jm)
 
-    #logging.info('Committing Job...')
+    logger.info('Committing Job...')
     r, res, ctx = job.spits_committer_commit_job(co, 0x12345678)
+    job.spits_committer_finalize(co)
 
-    job.spits_worker_finalize(wk)
-
-    if res == None:
-        logging.error('Job did not push any result!')
+    if res is None:
+        logger.error('Job did not push any result!')
         return messaging.res_module_noans, None
 
     if ctx != 0x12345678:
-        logging.error('Context verification failed for job!')
+        logger.error('Context verification failed for job!')
         return messaging.res_module_ctxer, None
 
     return r, res[0]
 
+
 ###############################################################################
 # Main routine
 ###############################################################################
 def main(argv):
-    # Setup logging
-    setup_log()
-    logging.debug('Hello!')
+    parse_global_config(argv[1:])
+    setup_log(se_verbosity, se_log_file)
 
-    # Print usage
-    if len(argv) <= 1:
-        abort('USAGE: jm module [module args]')
+    # Load the module
+    job = JobBinary(spits_binary)
+    metrics = MetricManager(job, buffer_size=10)
+    job.metrics = Pointer(metrics.metric_manager)
 
-    # Parse the arguments
-    args = Args.Args(argv[1:])
-    parse_global_config(args.args)
+    # Remove executor arguments when passing to the module
+    margv = [spits_binary] + spits_binary_args
 
-    # Load the module
-    module = args.margs[0]
-    job = JobBinary(module)
+    # Workers keep their spits_worker_new state between runs
+    rqueue = queue.Queue()
+    tpool = TaskPool(se_nw, se_overfill, initializer, worker,
+                     (rqueue, job, margv), batch=se_batch,
+                     batch_worker=batch_worker)
+    logger.info(f'Starting {se_nw} workers...')
+    tpool.start()
 
-    # Remove JM arguments when passing to the module
-    margv = args.margs
+    runid = [0]
 
     # Wrapper to include job module
-    def run_wrapper(argv):
-        return run(argv, job)
+    def run_wrapper(argv, jobinfo):
+        runid[0] = runid[0] + 1
+        return run(argv, jobinfo, job, tpool, rqueue, runid[0])
 
     # Run the module
-    logging.info('Running module')
+    logger.info('Running module')
     r = job.spits_main(margv, run_wrapper)
 
-    # Finalize
-    logging.debug('Bye!')
-    #exit(r)
+    # Finalize, the workers never return
+    logger.debug('Bye!')
+    logging.shutdown()
+    os._exit(r)
+
 
 ###############################################################################
 # Entry point
@@ -18,7 +18,8 @@ def is_valid_spits_bin(spits_bin: str) -> bool:
     return True
 
 
-def create_job_dir(jobs_dir: str, job_id: str, force: bool = False) -> str:
+def create_job_dir(jobs_dir: str, job_id: str, force: bool = False,
+                   memo: bool = False) -> str:
     print(f"Creating job {job_id} at {jobs_dir}")
     job_dir = path_extend(jobs_dir, job_id)
     if os.path.exists(job_dir):
@@ -32,6 +33,8 @@ def create_job_dir(jobs_dir: str, job_id: str, force: bool = False) -> str:
         path_extend(job_dir, 'logs'),
         path_extend(job_dir, 'nodes')
     ]
+    if memo:
+        dirs_to_create.append(path_extend(job_dir, 'memo'))
     for d in dirs_to_create:
         print(f"Creating directory: {d}...")
         os.makedirs(d, exist_ok=True)
@@ -88,6 +91,10 @@ def main(argv):
                              "link it")
     parser.add_argument('--force', '-f', action='store_true', default=False,
                         help="Force job creation even it path already exists")
+    parser.add_argument('--memo', '-m', action='store_true', default=False,
+                        help="Memoize task results in the job's memo directory, "
+                             "so identical tasks are not executed again when "
+                             "the job is run again")
     parser.add_argument('filename', action='store', help="SPITS binary to run")
     parser.add_argument('args', nargs='*', action='store',
                         help='SPITS binary arguments')
@@ -96,7 +103,7 @@ def main(argv):
     if 'SPITS_JOB_DIR' in os.environ:
         args.jobdir = os.environ['SPITS_JOB_DIR']
 
-    job_dir = create_job_dir(args.jobdir, args.jobid, args.force)
+    job_dir = create_job_dir(args.jobdir, args.jobid, args.force, args.memo)
     binary_file = os.path.join('bin', os.path.basename(args.filename))
 
     if not args.no_binary:
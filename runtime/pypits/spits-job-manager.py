@@ -108,6 +108,8 @@ def main(argv):
     spits_err = path_extend(logs_dir, f"{SPITS_UID}.err")
     spits_log = path_extend(logs_dir, f"{SPITS_UID}.log")
     metrics_file = path_extend(logs_dir, f"{SPITS_UID}.metrics.json")
+    journal_file = path_extend(SPITS_JOB_DIR, 'jm.journal')
+    memo_dir = path_extend(SPITS_JOB_DIR, 'memo')
     PIDFILE = path_extend(SPITS_JOB_DIR, f"jm.pid")
     RETCODE_FILE = path_extend(logs_dir, f"{SPITS_UID}.ret")
 
@@ -118,6 +120,12 @@ def main(argv):
     if os.path.exists(PIDFILE) and not args.force:
         abort("Job manager already exists. There is a job manager PID file at "
               f"{PIDFILE}")
+    if '--resume' not in args.jmargs:
+        from libspits.Journal import Journal
+        if Journal.unfinished(journal_file):
+            abort(f"There is an unfinished run in the checkpoint journal at "
+                  f"{journal_file}. Pass --resume to the job manager to "
+                  f"continue the job or remove the journal to start it again")
     with open(os.path.join(SPITS_JOB_DIR, 'job'), 'r') as file:
         job_cmd = file.readline()
 
@@ -126,6 +134,9 @@ def main(argv):
     run_args += ['--jobid', args.jobid]
     run_args += ['--log', spits_log]
     run_args += ['--metrics-file', metrics_file]
+    run_args += ['--journal', journal_file]
+    if os.path.isdir(memo_dir):
+        run_args += ['--memo', memo_dir]
     run_args += [x.strip() for x in job_cmd.split(' ')]
     cmd_line = ' '.join(run_args)
 
@@ -140,7 +151,8 @@ PID File: {PIDFILE}
 Using {spits_output} as default output
 Using {spits_err} as default error output
 Using {spits_log} as default task manager log outputs
-Metrics will be dumped to: {metrics_file}""")
+Metrics will be dumped to: {metrics_file}
+Checkpoint journal: {journal_file}""")
 
     signal.signal(signal.SIGINT, exit_gracefully)
     signal.signal(signal.SIGTERM, exit_gracefully)
@@ -0,0 +1,113 @@
+#! /usr/bin/python3
+
+import os
+import sys
+import argparse
+import glob
+
+from libspits import read_samples
+
+
+def usage(info, names, samples, window, show_idle=False):
+    """ CPU usage of the process (tid 0) and of each thread, threads that
+    did not use the CPU are omitted unless show_idle is set
+
+    :return: Rows (tid, name, user s, system s, average %, peak %) and the
+        timeline as (time s, {tid: CPU %}) for each window
+    """
+    ticks = float(info['ticks'])
+    first = {}
+    last = {}
+    start = {}
+    peak = {}
+    timeline = []
+    t0 = samples[0][0] if samples else 0
+    for ts, tid, ut, st, rss in samples:
+        if tid not in first:
+            first[tid] = start[tid] = (ts, ut, st)
+            peak[tid] = 0.0
+        last[tid] = (ts, ut, st)
+        # CPU of the thread in each window of at least window seconds
+        wts, wut, wst = start[tid]
+        if ts - wts >= window * 1e9:
+            pct = (ut + st - wut - wst) / ticks * 1e11 / (ts - wts)
+            peak[tid] = max(peak[tid], pct)
+            start[tid] = (ts, ut, st)
+            if tid == 0:
+                timeline.append(((ts - t0) / 1e9, {}))
+            if timeline:
+                timeline[-1][1][tid] = pct
+
+    rows = []
+    for tid in first:
+        if tid != 0 and not show_idle and \
+                last[tid][1:] == first[tid][1:]:
+            continue
+        fts, fut, fst = first[tid]
+        lts, lut, lst = last[tid]
+        wall = (lts - fts) / 1e9
+        user = (lut - fut) / ticks
+        system = (lst - fst) / ticks
+        avg = (user + system) * 100 / wall if wall > 0 else 0.0
+        name = 'process' if tid == 0 else names.get(tid, str(tid))
+        rows.append((tid, name, user, system, avg, peak[tid]))
+    rows.sort(key=lambda r: (r[0] != 0, -(r[2] + r[3])))
+    return rows, timeline
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Summarize the CPU usage of the threads of SPITS "
+                    "processes sampled by the PerfModule (--profile)")
+    parser.add_argument('files', metavar='PATH', type=str, nargs='+',
+                        help="Sample files (*-cpu.perf) or directories "
+                             "(default location: ./perf)")
+    parser.add_argument('--window', action='store', type=float, default=1.0,
+                        help="Seconds of the intervals of the peak CPU "
+                             "usage and of the timeline (default: "
+                             "%(default)s)")
+    parser.add_argument('--all', action='store_true',
+                        help="Include the threads that did not use the CPU")
+    parser.add_argument('--timeline', action='store_true',
+                        help="Print the CPU usage of each thread in each "
+                             "interval")
+    args = parser.parse_args(argv)
+
+    filenames = []
+    for path in args.files:
+        if os.path.isdir(path):
+            filenames += sorted(glob.glob(os.path.join(path, '*-cpu.perf')))
+        else:
+            filenames.append(path)
+    if not filenames:
+        print('No sample files found')
+        return 1
+
+    for filename in filenames:
+        info, names, samples = read_samples(filename)
+        rows, timeline = usage(info, names, samples, args.window,
+                               args.all)
+        rss = [s[4] * info['pagesize'] / 1048576.0 for s in samples
+               if s[1] == 0]
+        print(f"{filename}, pid {info['pid']}, {len(samples)} samples")
+        if rss:
+            print(f"RSS (MiB), average {sum(rss) / len(rss):.2f}, "
+                  f"max {max(rss):.2f}")
+        print("Thread, tid, user (s), system (s), average %, peak %")
+        for tid, name, user, system, avg, peak in rows:
+            print(f"{name}, {tid}, {user:.2f}, {system:.2f}, {avg:.2f}, "
+                  f"{peak:.2f}")
+        if args.timeline:
+            tids = [r[0] for r in rows]
+            print()
+            print(', '.join(['Time (s)'] + [r[1] for r in rows]))
+            for t, pct in timeline:
+                print(', '.join([f'{t:.3f}'] +
+                                [f'{pct[tid]:.2f}' if tid in pct else ''
+                                 for tid in tids]))
+        print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,43 @@
+#! /usr/bin/python3
+
+import os
+import sys
+import json
+import argparse
+import glob
+
+from libspits import merge_traces
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Merge SPITS task lifecycle traces into a Chrome/Perfetto "
+                    "trace (open with chrome://tracing or ui.perfetto.dev)")
+    parser.add_argument('traces', metavar='PATH', type=str, nargs='+',
+                        help="Trace files or directories written with --trace")
+    parser.add_argument('-o', '--output', action='store', type=str,
+                        default='trace.json',
+                        help="Output file (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    filenames = []
+    for path in args.traces:
+        if os.path.isdir(path):
+            filenames += sorted(glob.glob(os.path.join(path, '*.trace')))
+        else:
+            filenames.append(path)
+    if not filenames:
+        print('No trace files found')
+        return 1
+
+    # Merge the job manager first, its clock is the reference
+    filenames.sort(key=lambda f: not os.path.basename(f).startswith('jobmanager'))
+    trace = merge_traces(filenames)
+    with open(args.output, 'w') as f:
+        json.dump(trace, f)
+    print(f"Merged {len(filenames)} traces into {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -30,18 +30,25 @@ import time
 from datetime import datetime
 
 from libspits import JobBinary, setup_log, get_logger, Pointer
-from libspits import Listener, TaskPool
+from libspits import Listener, TaskPool, ProcessWorker, ResultStore
 from libspits import messaging, config
 from libspits import timeout as Timeout
-from libspits import make_uid
+from libspits import make_uid, available_cpus, worker_cpusets, \
+    affinity_policies
 from libspits import log_lines
 from libspits import PerfModule
+from libspits import MetricAggregator
+from libspits import Tracer, serve_clock
+from libspits import EventLog
+from libspits import metrics_handler
 
 import sys, os, socket, logging, multiprocessing, traceback, json
 
 from threading import Lock
 
 from libspits.JobBinary import MetricManager
+from libspits.MetricCodec import serve_metrics_since
+from libspits.Histogram import serve_histograms
 
 try:
     import Queue as queue  # Python 2
@@ -54,6 +61,13 @@ tm_addr = ''  # Bind address
 tm_port = 0  # Bind port
 tm_nw = 0       # Maximum number of workers
 tm_overfill = 0  # Extra space in the task queue
+tm_elastic = False  # Adjust the number of active workers at runtime
+tm_affinity = 'none'  # Policy used to pin workers to CPUs
+tm_result_memory = None  # Memory budget for results (MB)
+tm_result_disk = None  # Disk budget for spilled results (MB)
+tm_memory_budget = None  # Budget for tasks and results in memory (MB)
+tm_batch = 1  # Maximum tasks run in a single call to the binary
+tm_worker_mode = 'thread'  # Run tasks in threads or forked processes
 tm_announce = None  # Mechanism used to broadcast TM address
 tm_log_file = None  # Output file for logging
 tm_verbosity = 0    # Verbosity level for logging
@@ -68,6 +82,11 @@ tm_jobid = None
 tm_name = None
 tm_spits_profile_buffer_size = None
 tm_announce_filename = ''
+tm_trace_dir = None  # Directory of the task lifecycle trace
+tm_tracer = None
+tm_event_dir = None  # Directory of the binary event log
+tm_events = None
+tm_metrics_port = None  # Port of the OpenMetrics HTTP endpoint
 
 spits_binary = ''
 spits_binary_args = []
@@ -76,18 +95,30 @@ metrics_file = None
 tm_hostname = None
 METRICS = None
 
+# Metric handles, registered by App
+tm_metric_tasks_processed = None
+tm_metric_task_time = None
+
 logger = get_logger(os.path.basename(sys.argv[0]))
 
 ###############################################################################
 # Parse global configuration
 ###############################################################################
+def overfill_type(value):
+    if value == 'auto':
+        return value
+    return int(value)
+
+
 def parse_global_config(arguments):
     global tm_mode, tm_addr, tm_port, tm_nw, tm_log_file, tm_verbosity, \
         tm_overfill, tm_announce, tm_conn_timeout, tm_recv_timeout, \
         tm_send_timeout, tm_timeout, tm_profiling, tm_perf_rinterv, \
         tm_perf_subsamp, tm_jobid, tm_spits_profile_buffer_size, tm_name, \
         spits_binary, spits_binary_args, tm_announce_filename, metrics_file, \
-        tm_hostname
+        tm_hostname, tm_worker_mode, tm_elastic, tm_affinity, \
+        tm_result_memory, tm_result_disk, tm_memory_budget, tm_batch, \
+        tm_trace_dir, tm_metrics_port, tm_event_dir
 
     parser = argparse.ArgumentParser(description="SPITS Task Manager runtime")
     parser.add_argument('binary', metavar='PATH', type=str,
@@ -106,11 +137,45 @@ def parse_global_config(arguments):
                         type=int, default=0,
                         help="Task manager bind port (default: %(default)s)")
     parser.add_argument('--nw', action='store', metavar='WORKERS',
-                        type=int, default=multiprocessing.cpu_count(),
+                        type=int, default=available_cpus(),
                         help="Maximum number of workers (default: %(default)s)")
+    parser.add_argument('--elastic', action='store_true', default=False,
+                        help='Keep only the workers that the available CPUs '
+                             'can run active, parking the others')
     parser.add_argument('--tm-overfill', action='store', metavar='EXTRA',
-                        type=int, default=0,
-                        help="Extra space in the task queue (default: %(default)s)")
+                        type=overfill_type, default=0,
+                        help="Extra space in the task queue, or 'auto' to "
+                             "size the queue from the measured task time and "
+                             "push interval (default: %(default)s)")
+    parser.add_argument('--affinity', action='store', type=str,
+                        choices=affinity_policies, default='none',
+                        help='Pin workers to CPUs: one CPU each filling a '
+                             'NUMA node first (packed), one CPU each '
+                             'alternating NUMA nodes (spread) or all CPUs '
+                             'of a NUMA node (node) (default: %(default)s)')
+    parser.add_argument('--result-memory', action='store', metavar='MB',
+                        type=int, default=None,
+                        help='Memory budget for results not yet collected, '
+                             'older results are spilled to disk (default: '
+                             'unlimited)')
+    parser.add_argument('--result-disk', action='store', metavar='MB',
+                        type=int, default=None,
+                        help='Disk budget for spilled results, workers wait '
+                             'when it is exhausted (default: unlimited)')
+    parser.add_argument('--memory-budget', action='store', metavar='MB',
+                        type=int, default=None,
+                        help='Budget for the payload of the queued tasks plus '
+                             'the results kept in memory, tasks that do not '
+                             'fit are not accepted (default: unlimited)')
+    parser.add_argument('--batch', action='store', metavar='N',
+                        type=int, default=1,
+                        help='Maximum number of queued tasks a worker runs '
+                             'in a single call to the binary (default: '
+                             '%(default)s)')
+    parser.add_argument('--worker-mode', action='store', type=str,
+                        choices=['thread', 'process'], default='thread',
+                        help='Run tasks in worker threads or in forked '
+                             'worker processes (default: %(default)s)')
     parser.add_argument('--announce', action='store', metavar='TYPE',
                         type=str, default=config.announce_file,
                         help="Mechanism used to broadcast TM address "
@@ -156,6 +221,19 @@ def parse_global_config(arguments):
                         help="Dump metrics to file when process ends")
     parser.add_argument('--hostname', action='store', type=str,
                         help="Hostname to use")
+    parser.add_argument('--trace', action='store', type=str, metavar='PATH',
+                        help="Trace the lifecycle of the tasks to a file in "
+                             "this directory, see spits-trace.py")
+    parser.add_argument('--event-log', action='store', type=str,
+                        metavar='PATH',
+                        help="Record task, connection and queue events in a "
+                             "binary log in this directory, read by "
+                             "perf-pits.py")
+    parser.add_argument('--metrics-port', action='store', type=int,
+                        metavar='PORT',
+                        help="Serve the metrics in the OpenMetrics text "
+                             "format over HTTP at this port (0 for any) "
+                             "under /metrics")
 
     args = parser.parse_args(arguments)
     spits_binary = args.binary
@@ -167,6 +245,13 @@ def parse_global_config(arguments):
     tm_port = args.tmport
     tm_nw = args.nw
     tm_overfill = args.tm_overfill
+    tm_worker_mode = args.worker_mode
+    tm_elastic = args.elastic
+    tm_affinity = args.affinity
+    tm_result_memory = args.result_memory
+    tm_result_disk = args.result_disk
+    tm_memory_budget = args.memory_budget
+    tm_batch = max(1, args.batch)
     tm_announce = args.announce
     tm_log_file = args.log
     tm_verbosity = args.verbose
@@ -183,6 +268,9 @@ def parse_global_config(arguments):
     tm_announce_filename = args.announce_file
     tm_hostname = args.hostname
     metrics_file = args.metrics_file
+    tm_trace_dir = args.trace
+    tm_event_dir = args.event_log
+    tm_metrics_port = args.metrics_port
 
 
 ###############################################################################
@@ -232,22 +320,44 @@ def announce_file(addr: str):
 
 
 def terminate():
-    global metrics_file, METRICS
+    global metrics_file, METRICS, tm_tracer, tm_events
 
     if metrics_file is not None:
         with open(metrics_file, 'w') as f:
             metrics_final = METRICS.get_metrics()
             json.dump(metrics_final, f, indent=4, sort_keys=True)
 
+    if tm_tracer is not None:
+        tm_tracer.close()
+
+    if tm_events is not None:
+        tm_events.record(EventLog.EXIT)
+        tm_events.close()
+
+    # The forked workers are not joined by os._exit
+    if tm_worker_mode == 'process':
+        ProcessWorker.finalize_all(timeout=1)
+
     os._exit(0)
 
 
+###############################################################################
+# Record the stages of the tasks in the trace and in the event log
+###############################################################################
+def record_task(stage, taskid):
+    if tm_tracer is not None:
+        tm_tracer.record(stage, taskid)
+    if tm_events is not None:
+        tm_events.record(stage, taskid)
+
+
 ###############################################################################
 # Server callback
 ###############################################################################
 def server_callback(conn, addr, port, job, metrics, tpool, cqueue, timeout):
     global tm_recv_timeout, tm_send_timeout
     logger.debug('Connected to {}:{}.'.format(addr, port))
+    mtype = 0
 
     try:
         # Send the job identifier
@@ -265,10 +375,14 @@ def server_callback(conn, addr, port, job, metrics, tpool, cqueue, timeout):
         # Read the type of message
         mtype = conn.ReadInt64(tm_recv_timeout)
         timeout.reset()
+        if tm_events is not None:
+            tm_events.record(EventLog.CONN_OPEN, mtype, port)
 
         # Termination signal
         if mtype == messaging.msg_terminate:
             logger.info(f'Received a kill signal from {addr}:{port}.')
+            if tm_events is not None:
+                tm_events.record(EventLog.KILL)
             terminate()
 
         # Job manager is sending heartbeats
@@ -277,16 +391,21 @@ def server_callback(conn, addr, port, job, metrics, tpool, cqueue, timeout):
 
         # Job manager is trying to send tasks to the task manager
         elif mtype == messaging.msg_send_task:
+            tpool.NotePush()
+            # Tell the job manager how many tasks fit in the queue
+            conn.WriteInt64(0 if cqueue.Full() else tpool.Capacity())
             # Two phase pull: test-try-pull
-            while not tpool.Full():
-                # Task pool is not full, start asking for data
-                conn.WriteInt64(messaging.msg_send_more)
+            while not tpool.Full() and not cqueue.Full():
+                # Task pool is not full, start asking for data and tell
+                # the job manager the largest task that fits
+                conn.WriteInt64s(messaging.msg_send_more, tpool.FreeBytes())
                 # Write Data
                 taskid = conn.ReadInt64(tm_recv_timeout)
                 runid = conn.ReadInt64(tm_recv_timeout)
                 tasksz = conn.ReadInt64(tm_recv_timeout)
                 task = conn.Read(tasksz, tm_recv_timeout)
                 logger.info('Received task {} from {}:{}.'.format(taskid, addr, port))
+                record_task(Tracer.RECEIVED, taskid)
 
                 # Try enqueue the received task
                 if not tpool.Put(taskid, runid, task):
@@ -297,10 +416,14 @@ def server_callback(conn, addr, port, job, metrics, tpool, cqueue, timeout):
 
             # Task pool is full, stop receiving tasks
             conn.WriteInt64(messaging.msg_send_full)
+            if tm_events is not None:
+                tm_events.record(EventLog.QUEUE, tpool.tasks.qsize(),
+                                 cqueue.qsize())
 
         # Job manager is querying the results of the completed tasks
         elif mtype == messaging.msg_read_result:
             taskid = None
+            drained = 0
             try:
                 # Dequeue completed tasks until cqueue fires
                 # an Empty exception
@@ -310,14 +433,25 @@ def server_callback(conn, addr, port, job, metrics, tpool, cqueue, timeout):
 
                     logger.info('Sending task {} to committer {}:{}...'.format(taskid, addr, port))
 
-                    # Send the task
+                    # Send the task header
                     conn.WriteInt64(taskid)
                     conn.WriteInt64(runid)
                     conn.WriteInt64(r)
-                    if res is None:
-                        conn.WriteInt64(0)
-                    else:
-                        conn.WriteInt64(len(res))
+                    conn.WriteInt64(0 if res is None else len(res))
+
+                    # The committer tells if it still needs the result
+                    # before the payload is sent
+                    ans = conn.ReadInt64(tm_recv_timeout)
+                    if ans == messaging.msg_read_skip:
+                        logger.info('Task {} dropped, committer {}:{} does not need it.'.format(taskid, addr, port))
+                        job.arena.release(res)
+                        taskid = None
+                        continue
+                    if ans != messaging.msg_read_accept:
+                        logger.warning('Unknown response received from {}:{} while committing task'.format(addr, port))
+                        raise messaging.MessagingError()
+
+                    if res is not None:
                         conn.Write(res)
 
                     # Wait for the confirmation that the task has
@@ -327,17 +461,24 @@ def server_callback(conn, addr, port, job, metrics, tpool, cqueue, timeout):
                         logger.warning('Unknown response received from {}:{} while committing task'.format(addr, port))
                         raise messaging.MessagingError()
 
+                    record_task(Tracer.PULLED, taskid)
+                    job.arena.release(res)
                     taskid = None
+                    drained += 1
 
             except queue.Empty:
                 # Finish the response
                 conn.WriteInt64(messaging.msg_read_empty)
+                tpool.NoteDrain(drained)
+                if tm_events is not None:
+                    tm_events.record(EventLog.QUEUE, tpool.tasks.qsize(),
+                                     cqueue.qsize())
 
             except:
                 # Something went wrong while sending, put
                 # the last task back in the queue
                 if taskid is not None:
-                    cqueue.put((taskid, runid, r, res))
+                    cqueue.put((taskid, runid, r, res), block=False)
                     logger.info('Task {} put back in the queue.'.format(taskid))
                 pass
 
@@ -346,6 +487,16 @@ def server_callback(conn, addr, port, job, metrics, tpool, cqueue, timeout):
             metrics = json.dumps(metrics)
             conn.WriteString(metrics)
 
+        elif mtype == messaging.msg_cd_query_metrics_since:
+            serve_metrics_since(conn, metrics, tm_recv_timeout)
+
+        elif mtype == messaging.msg_cd_query_histograms:
+            serve_histograms(conn, metrics)
+
+        # Job manager is estimating the offset of the trace clock
+        elif mtype == messaging.msg_cd_query_clock:
+            serve_clock(conn, tm_tracer)
+
         # Unknow message received or a wrong sized packet could be trashing
         # the buffer, don't do anything
         else:
@@ -362,6 +513,8 @@ def server_callback(conn, addr, port, job, metrics, tpool, cqueue, timeout):
         log_lines(traceback.format_exc(), logging.debug)
 
     conn.Close()
+    if tm_events is not None:
+        tm_events.record(EventLog.CONN_CLOSE, mtype, port)
     logger.debug(f'Connection to {addr}:{port} closed.')
 
 
@@ -370,23 +523,35 @@ def server_callback(conn, addr, port, job, metrics, tpool, cqueue, timeout):
 ###############################################################################
 def initializer(cqueue, job, metrics, argv, active_workers, timeout):
     logger.info('Initializing worker...')
+    if tm_events is not None:
+        tm_events.record(EventLog.WORKER_INIT)
+    if tm_worker_mode == 'process':
+        # Each process calls spits_worker_new on its own
+        return ProcessWorker(job, argv)
     return job.spits_worker_new(argv)
 
 
 ###############################################################################
 # Worker routine
 ###############################################################################
-TASKS_PROCESSED = 0
 def worker(state, taskid, runid, task, cqueue, job, metrics: MetricManager, argv, active_workers, timeout):
-    global TASKS_PROCESSED
     timeout.reset()
     active_workers.inc()
     logger.info('Processing task %d from job %d...', taskid, runid)
+    record_task(Tracer.DEQUEUED, taskid)
+    record_task(Tracer.RUN_START, taskid)
 
     # Execute the task using the job module
     start_time = time.time()
-    r, res, ctx = job.spits_worker_run(state, task, taskid)
+    if isinstance(state, ProcessWorker):
+        r, res, ctx = state.run(task, taskid)
+    else:
+        # Results are written to reusable buffers, returned to the arena
+        # after being sent to the committer
+        r, res, ctx = job.spits_worker_run(state, task, taskid,
+                                           out=job.arena.acquire)
     task_time = time.time() - start_time
+    record_task(Tracer.RUN_END, taskid)
 
     logger.info('Task %d processed.', taskid)
 
@@ -399,10 +564,58 @@ def worker(state, taskid, runid, task, cqueue, job, metrics: MetricManager, argv
         return
 
     # Enqueue the result
-    TASKS_PROCESSED += 1
-    metrics.set_metric("tasks_processed", TASKS_PROCESSED)
-    metrics.set_metric("task_time", task_time)
+    tm_metric_tasks_processed.inc()
+    tm_metric_task_time.observe(task_time)
     cqueue.put((taskid, runid, r, res[0]))
+    record_task(Tracer.ENQUEUED, taskid)
+    active_workers.dec()
+
+
+###############################################################################
+# Batch worker routine
+###############################################################################
+def batch_worker(state, items, cqueue, job, metrics: MetricManager, argv, active_workers, timeout):
+    taskids = [taskid for taskid, runid, task in items]
+    # Forked workers run one task at a time, and the contexts of a batch
+    # must be unique
+    if isinstance(state, ProcessWorker) or len(set(taskids)) != len(taskids):
+        for taskid, runid, task in items:
+            worker(state, taskid, runid, task, cqueue, job, metrics, argv,
+                   active_workers, timeout)
+        return
+
+    timeout.reset()
+    active_workers.inc()
+    logger.info('Processing tasks %s...', taskids)
+    for taskid in taskids:
+        record_task(Tracer.DEQUEUED, taskid)
+        record_task(Tracer.RUN_START, taskid)
+
+    # Execute the tasks using the job module
+    start_time = time.time()
+    results = job.spits_worker_run_batch(state, [task for _, _, task in items],
+                                         taskids, out=job.arena.acquire)
+    task_time = (time.time() - start_time) / len(items)
+    for taskid in taskids:
+        record_task(Tracer.RUN_END, taskid)
+
+    logger.info('Tasks %s processed.', taskids)
+
+    for (taskid, runid, task), (r, res, ctx) in zip(items, results):
+        if res is None:
+            logger.error('Task %d did not push any result!', taskid)
+            continue
+
+        if ctx != taskid:
+            logger.error('Context verification failed for task %d!', taskid)
+            continue
+
+        # Enqueue the result
+        tm_metric_tasks_processed.inc()
+        cqueue.put((taskid, runid, r, res[0]))
+        record_task(Tracer.ENQUEUED, taskid)
+
+    tm_metric_task_time.observe(task_time, len(items))
     active_workers.dec()
 
 
@@ -433,19 +646,41 @@ class AtomicInc(object):
 class App(object):
     def __init__(self):
         global spits_binary, spits_binary_args, tm_nw, tm_overfill, tm_mode, \
-            tm_addr, tm_port, METRICS
+            tm_addr, tm_port, METRICS, tm_metric_tasks_processed, \
+            tm_metric_task_time
         self.margv = [spits_binary] + spits_binary_args
         self.timeout = Timeout(tm_timeout, self.timeout_exit)
         self.job = JobBinary(spits_binary)
         self.metrics = MetricManager(self.job, buffer_size=10)
         METRICS = self.metrics
         self.job.metrics = Pointer(self.metrics.metric_manager)
-        self.cqueue = queue.Queue()
+        self.aggregator = MetricAggregator(self.metrics)
+        tm_metric_tasks_processed = self.aggregator.counter("tasks_processed")
+        tm_metric_task_time = self.aggregator.timer("task_time")
+        self.cqueue = ResultStore(
+            None if tm_result_memory is None else tm_result_memory << 20,
+            None if tm_result_disk is None else tm_result_disk << 20)
         self.active_workers = AtomicInc()
         data = (self.cqueue, self.job, self.metrics, self.margv, self.active_workers, self.timeout)
-        self.tpool = TaskPool(tm_nw, tm_overfill, initializer, worker, data)
+        adaptive = tm_overfill == 'auto'
+        self.tpool = TaskPool(tm_nw, tm_nw if adaptive else tm_overfill,
+                              initializer, worker, data, adaptive=adaptive,
+                              elastic=tm_elastic,
+                              affinity=worker_cpusets(tm_nw, tm_affinity),
+                              byte_budget=None if tm_memory_budget is None
+                              else tm_memory_budget << 20,
+                              pending_bytes=lambda: self.cqueue.mem_bytes,
+                              batch=tm_batch, batch_worker=batch_worker,
+                              queue_time=self.aggregator.timer("queue_time"))
+        self.aggregator.gauge("tasks_queued").track(self.tpool.tasks.qsize)
+        self.aggregator.gauge("results_queued").track(self.cqueue.qsize)
+        self.aggregator.gauge("active_workers").track(self.active_workers.get)
         self.server = Listener(tm_mode, tm_addr, tm_port, server_callback,
-                               (self.job, self.metrics, self.tpool, self.cqueue, self.timeout))
+                               (self.job, self.metrics, self.tpool, self.cqueue, self.timeout),
+                               http_port=tm_metrics_port,
+                               http_callback=None if tm_metrics_port is None
+                               else metrics_handler(self.aggregator,
+                                   dict(role='taskmanager', name=tm_name)))
 
     def run(self):
         global tm_spits_profile_buffer_size, tm_nw, tm_perf_rinterv, \
@@ -459,7 +694,10 @@ class App(object):
 
         self.timeout.reset()
         logger.info('Starting workers...')
+        if tm_events is not None:
+            tm_events.record(EventLog.START)
         self.tpool.start()
+        self.aggregator.start()
         logger.info('Starting network listener...')
         self.server.Start()
         if tm_hostname:
@@ -475,11 +713,16 @@ class App(object):
         #self.job.spits_set_metric_string("tm_start_time", datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S.%f"))
         self.server.Join()
         self.server.Stop()
+        self.aggregator.stop()
         # self.job.spits_metric_finish()
 
     def timeout_exit(self):
         if self.tpool.Empty() and self.active_workers.get() <= 0:
             logger.error('Task Manager exited due to timeout')
+            # The listener takes a while to stop, terminate() records the
+            # exit again
+            if tm_events is not None:
+                tm_events.record(EventLog.EXIT)
             self.server.Stop()
             sys.exit(1)
         else:
@@ -490,10 +733,14 @@ class App(object):
 # Main routine
 ###############################################################################
 def main(argv):
-    global tm_verbosity, tm_log_file
+    global tm_verbosity, tm_log_file, tm_tracer, tm_events
     parse_global_config(argv)
     setup_log(tm_verbosity, tm_log_file)
     logger.debug('Hello!')
+    if tm_trace_dir is not None:
+        tm_tracer = Tracer(tm_trace_dir, 'taskmanager')
+    if tm_event_dir is not None:
+        tm_events = EventLog(tm_event_dir, 'taskmanager')
     App().run()
     logger.debug('Bye!')
     terminate()
@@ -1,118 +1,378 @@
 #!/usr/bin/env python3
-import sys, argparse
-from datetime import datetime, timedelta
-from statistics import mean, stdev
-
-
-def loadFiles(fList):
-  jobs = []
+import sys, os, re, argparse, calendar, time
+from array import array
+from bisect import bisect_left
+from multiprocessing import Pool
+from statistics import mean, stdev, median
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+# Binary event logs (--event-log of the runtime) are read with libspits
+try:
+  from libspits.EventLog import EventLog, EventLogReader, RECORD_SIZE
+except ImportError:
+  sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               '..', 'runtime', 'pypits'))
+  try:
+    from libspits.EventLog import EventLog, EventLogReader, RECORD_SIZE
+  except ImportError:
+    EventLog = EventLogReader = RECORD_SIZE = None
+
+# Kinds of the task events
+TASK_START = 0
+TASK_END = 1
+
+# Only the lines with these words are parsed
+KEYWORDS = re.compile(rb'rocess|Initializing|Starting workers|kill')
+
+# "[2020-01-01 10:00:00,000] [tm.py] [INFO] [Worker-0]: message"
+NEW_FORMAT = re.compile(r'\[([^\]]+)\] \[[^\]]*\] \[[^\]]*\] \[([^\]]*)\]: (.*)')
+
+days = {}
+
+
+def parseTime(stamp):
+  # "YYYY-mm-dd HH:MM:SS,fff" to integer milliseconds, so sums are exact,
+  # much faster than datetime.strptime
+  day = days.get(stamp[:10])
+  if day is None:
+    day = calendar.timegm(time.strptime(stamp[:10], '%Y-%m-%d')) * 1000
+    days[stamp[:10]] = day
+  return (day + int(stamp[11:13]) * 3600000 + int(stamp[14:16]) * 60000 +
+          int(stamp[17:19]) * 1000 + int(stamp[20:23]))
+
+
+def splitLine(line):
+  # Returns (time stamp, thread, message), both the current log format and
+  # the older "date - thread - level - message" are accepted
+  if line.startswith('['):
+    m = NEW_FORMAT.match(line)
+    if m is None:
+      return None
+    return m.group(1), m.group(2), m.group(3)
+  v = line.split(" - ", 3)
+  if len(v) < 4:
+    return None
+  return v[0].strip(), v[1], v[3]
+
+
+def taskIds(text):
+  # "5" or "[5, 6, 7]"
+  return [int(t) for t in text.strip('[] ').split(',') if t.strip()]
+
+
+def isEventLog(filename):
+  with open(filename, 'rb') as f:
+    return f.read(4) == b'SPEV'
+
+
+def makeChunks(fList, chunkSize):
+  # Split the files in ranges of bytes (or records of event logs) parsed
+  # independently
+  chunks = []
   for i in fList:
-    # Create Job
-    job = {"Name" : i, "Start Time" :"", "End Init. Time" :"", "Kill Time" :"", "Stats": "", "Threads" : {}}
-
-    #  Parse Log
     try:
-      f = open(i)
+      events = isEventLog(i)
+      if events:
+        if EventLogReader is None:
+          print("ERROR: libspits is required to read the event log \"{}\"".format(i))
+          exit(1)
+        size = EventLogReader(i).count
+        step = max(1, chunkSize // RECORD_SIZE)
+      else:
+        size = os.path.getsize(i)
+        step = chunkSize
     except Exception as e:
       print(e)
       exit(1)
-    
-    job["Kill Time"] = None
-    job["Start Time"] = None
-    job["Initializing"] = None
-
-    for j in f:
-      jVec = j.strip().split(" - ") # [0] = datetime, [1] thread, [2] log type, [3] message
-      if(len(jVec) < 4):
+    begin = 0
+    while True:
+      end = min(size, begin + step)
+      chunks.append((i, begin, end, events))
+      if end >= size:
+        break
+      begin = end
+  return chunks
+
+
+def newChunk():
+  return {"Start Time": None, "Kill Time": None, "Exit Time": None, "Last Time": None, "Threads": {}, "Names": {}}
+
+
+def parseEvents(filename, begin, end):
+  # Records [begin, end) of an event log, threads are identified by their
+  # native ids until the chunks are merged. Nanoseconds are converted to
+  # milliseconds, the unit of the log files
+  chunk = newChunk()
+  reader = EventLogReader(filename)
+  taskManager = reader.info.get("role") == "taskmanager"
+
+  def thread(tid, t):
+    th = chunk["Threads"].get(tid)
+    if th is None:
+      th = {"Init": None, "First": t, "Times": array('q'), "Tasks": array('q'), "Kinds": array('b')}
+      chunk["Threads"][tid] = th
+    return th
+
+  for ts, event, task, arg, tid in reader.records(begin, end):
+    t = ts // 1000000
+    chunk["Last Time"] = t
+    if event == EventLog.RUN_START:
+      th = thread(tid, t)
+      th["Times"].append(t)
+      th["Tasks"].append(task)
+      th["Kinds"].append(TASK_START)
+    elif event == EventLog.RUN_END:
+      th = thread(tid, t)
+      th["Times"].append(t)
+      th["Tasks"].append(task)
+      th["Kinds"].append(TASK_END)
+    elif event == EventLog.NAME:
+      chunk["Names"][tid] = task
+    elif event == EventLog.WORKER_INIT:
+      th = thread(tid, t)
+      if th["Init"] is None:
+        th["Init"] = t
+    elif event == EventLog.START:
+      # The job manager does not run tasks
+      if taskManager and chunk["Start Time"] is None:
+        chunk["Start Time"] = t
+    elif event == EventLog.KILL:
+      chunk["Kill Time"] = t
+    elif event == EventLog.EXIT:
+      # The first one, the exit may be recorded more than once
+      if chunk["Exit Time"] is None:
+        chunk["Exit Time"] = t
+  return filename, chunk
+
+
+def parseChunk(args):
+  # Lines starting in [begin, end) of the file. Task events are kept per
+  # thread in arrays, in the order they were logged
+  filename, begin, end, events = args
+  if events:
+    return parseEvents(filename, begin, end)
+  chunk = newChunk()
+  lastLine = None
+
+  def thread(name, t):
+    th = chunk["Threads"].get(name)
+    if th is None:
+      th = {"Init": None, "First": t, "Times": array('q'), "Tasks": array('q'), "Kinds": array('b')}
+      chunk["Threads"][name] = th
+    return th
+
+  with open(filename, 'rb') as f:
+    pos = begin
+    if begin > 0:
+      # The line crossing begin belongs to the previous chunk
+      f.seek(begin - 1)
+      pos += len(f.readline()) - 1
+    while pos < end:
+      line = f.readline()
+      if not line:
+        break
+      pos += len(line)
+      if line.strip():
+        lastLine = line
+      if KEYWORDS.search(line) is None:
         continue
-      time = datetime.strptime(jVec[0].strip(), '%Y-%m-%d %H:%M:%S,%f')
-      if("Starting workers" in jVec[3]):
-        job["Start Time"] = time
-      elif("Initializing" in jVec[3]):
-        job["Threads"][jVec[1]] = {"Start Time": time, "Stats": "", "Tasks": {}}
-      elif("Processing" in jVec[3]):
-        taskNum = int(jVec[3][jVec[3].index("task ") + 5 : jVec[3].index(" from job")])
-        job["Threads"][jVec[1]]["Tasks"][taskNum] = {"Start Time": time}
-      elif("processed" in jVec[3]):
-        taskNum = int(jVec[3][jVec[3].index("Task ") + 5 : jVec[3].index(" processed")])
-        job["Threads"][jVec[1]]["Tasks"][taskNum]["End Time"] = time
-      elif("kill" in jVec[3]):
-        job["Kill Time"] = time
-    f.close()
+      fields = splitLine(line.decode('utf8', 'replace').strip())
+      if fields is None:
+        continue
+      stamp, name, msg = fields
+      try:
+        t = parseTime(stamp)
+      except ValueError:
+        continue
+      if "Starting workers" in msg:
+        if chunk["Start Time"] is None:
+          chunk["Start Time"] = t
+      elif "Initializing" in msg:
+        th = thread(name, t)
+        if th["Init"] is None:
+          th["Init"] = t
+      elif msg.startswith("Processing task"):
+        # "Processing task 5 from job 1..." or "Processing tasks [5, 6]..."
+        text = msg[msg.index(" ", 11) + 1:]
+        text = text[:text.index(" from job")] if " from job" in text else text.rstrip('.')
+        th = thread(name, t)
+        for task in taskIds(text):
+          th["Times"].append(t)
+          th["Tasks"].append(task)
+          th["Kinds"].append(TASK_START)
+      elif msg.endswith(" processed."):
+        # "Task 5 processed." or "Tasks [5, 6] processed."
+        text = msg[msg.index(" ") + 1:-len(" processed.")]
+        th = thread(name, t)
+        for task in taskIds(text):
+          th["Times"].append(t)
+          th["Tasks"].append(task)
+          th["Kinds"].append(TASK_END)
+      elif "kill" in msg:
+        chunk["Kill Time"] = t
+
+  if lastLine is not None:
+    fields = splitLine(lastLine.decode('utf8', 'replace').strip())
+    try:
+      chunk["Last Time"] = parseTime(fields[0]) if fields else None
+    except ValueError:
+      pass
+  return filename, chunk
+
+
+def mergeChunk(job, chunk):
+  # Chunks of a file must be merged in order
+  if job["Start Time"] is None:
+    job["Start Time"] = chunk["Start Time"]
+  if chunk["Kill Time"] is not None:
+    job["Kill Time"] = chunk["Kill Time"]
+  if job["Exit Time"] is None:
+    job["Exit Time"] = chunk["Exit Time"]
+  if chunk["Last Time"] is not None:
+    job["Last Time"] = chunk["Last Time"]
+  job["Names"].update(chunk["Names"])
+  for name, th in chunk["Threads"].items():
+    current = job["Threads"].get(name)
+    if current is None:
+      job["Threads"][name] = th
+      continue
+    if current["Init"] is None:
+      current["Init"] = th["Init"]
+    current["Times"].extend(th["Times"])
+    current["Tasks"].extend(th["Tasks"])
+    current["Kinds"].extend(th["Kinds"])
+
 
+def loadFiles(fList, nprocs=None, chunkSize=64 << 20):
+  jobs = {}
+  for i in fList:
+    jobs[i] = newChunk()
+    jobs[i]["Name"] = i
+
+  chunks = makeChunks(fList, chunkSize)
+  if nprocs == 1 or len(chunks) == 1:
+    for filename, chunk in map(parseChunk, chunks):
+      mergeChunk(jobs[filename], chunk)
+  else:
+    with Pool(nprocs) as pool:
+      for filename, chunk in pool.imap(parseChunk, chunks):
+        mergeChunk(jobs[filename], chunk)
+
+  result = []
+  for i in fList:
+    job = jobs[i]
     # Handle TMs that were interrupted before receiving the kill signal.
-    if job["Kill Time"] == None :
-      job["Kill Time"] = time # Receive last time
+    # Event logs record the exit of the process, like the last line of
+    # the log file
+    if job["Kill Time"] is None:
+      job["Kill Time"] = job["Exit Time"] or job["Last Time"] # Receive last time
 
-    if job["Start Time"] == None :
+    if job["Start Time"] is None:
       print("WARNING: Could not find the Start Time on log file \"{}\"".format(i))
       print("It will not be included on the statistics...")
-    else:
-      jobs.append(job)
+      continue
 
-  return jobs
+    # Threads of event logs are named after the merge, their names may
+    # not be unique
+    if job["Names"]:
+      names = {}
+      for tid, th in job["Threads"].items():
+        name = job["Names"].get(tid, str(tid))
+        names[name if name not in names else "{}-{}".format(name, tid)] = th
+      job["Threads"] = names
+
+    # Pair the task events of each thread
+    for name, th in job["Threads"].items():
+      starts, ends, tasks, done = array('q'), array('q'), array('q'), array('b')
+      running = {}
+      for t, task, kind in zip(th["Times"], th["Tasks"], th["Kinds"]):
+        if kind == TASK_START:
+          running[task] = t
+        elif task in running:
+          starts.append(running.pop(task))
+          ends.append(t)
+          tasks.append(task)
+          done.append(1)
+      # Tasks interrupted due to job completion
+      for task, t in running.items():
+        starts.append(t)
+        ends.append(max(t, job["Kill Time"]))
+        tasks.append(task)
+        done.append(0)
+      job["Threads"][name] = {
+        "Start Time": th["Init"] if th["Init"] is not None else th["First"],
+        "Starts": starts, "Ends": ends, "Tasks": tasks, "Done": done
+      }
+    result.append(job)
+
+  return result
 
 def processTasks(jobs):
+  # Only the first execution of each task to finish is committed
   tasksGlobalendTime = {}
   for j in jobs:
-    firstTaskTime = datetime.now()
-    for th in j["Threads"]:
-      for task in j["Threads"][th]["Tasks"]:
-        currentTask = j["Threads"][th]["Tasks"][task]
-        currentTask["Status"] = "undefined"
-        firstTaskTime = min(firstTaskTime, currentTask["Start Time"])
-        if("End Time" not in currentTask):
-          currentTask["Status"] = "unfinished"
-          currentTask["Duration"] = j["Kill Time"] - currentTask["Start Time"]
-          continue
-        tasksGlobalendTime[task] = min(currentTask["End Time"], tasksGlobalendTime.get(task, datetime.now()))
-        currentTask["Duration"] = currentTask["End Time"] - currentTask["Start Time"]
-    j["End Init. Time"] = firstTaskTime
+    for th in j["Threads"].values():
+      for task, end, done in zip(th["Tasks"], th["Ends"], th["Done"]):
+        if done and (task not in tasksGlobalendTime or end < tasksGlobalendTime[task]):
+          tasksGlobalendTime[task] = end
 
   for j in jobs:
     j["Stats"] = {
       "Time" :
       {
-        "Successful" : timedelta(0),
-        "Repeated": timedelta(0),
-        "Unfinished": timedelta(0),
-        "Init. Overhead": timedelta(0),
-        "Total" : timedelta(0)
+        "Successful" : 0,
+        "Repeated": 0,
+        "Unfinished": 0,
+        "Init. Overhead": 0,
+        "Total" : 0
       }
     }
+    firstTaskTime = None
 
-    for th in j["Threads"]:
+    for th in j["Threads"].values():
       #  Threads statistics
-      currentThread = j["Threads"][th]
-      currentThread["Stats"] = {
+      th["Stats"] = {
         "Time" :
         {
-          "Successful" : timedelta(0),
-          "Repeated": timedelta(0),
-          "Unfinished": timedelta(0),
-          "Total" : j["Kill Time"] - currentThread["Start Time"]
+          "Successful" : 0,
+          "Repeated": 0,
+          "Unfinished": 0,
+          "Total" : j["Kill Time"] - th["Start Time"]
         }
       }
+      success = array('b')
 
       #  Process tasks
-      for task in j["Threads"][th]["Tasks"]:
-        currentTask = j["Threads"][th]["Tasks"][task]
-        if(currentTask["Status"] != "undefined"):
-          currentThread["Stats"]["Time"]["Unfinished"] += currentTask["Duration"]
-          continue
-        if(currentTask["End Time"] == tasksGlobalendTime[task]):
-          currentTask["Status"] = "success"
-          currentThread["Stats"]["Time"]["Successful"] += currentTask["Duration"]
+      for task, start, end, done in zip(th["Tasks"], th["Starts"], th["Ends"], th["Done"]):
+        if firstTaskTime is None or start < firstTaskTime:
+          firstTaskTime = start
+        if not done:
+          th["Stats"]["Time"]["Unfinished"] += end - start
+          success.append(0)
+        elif end == tasksGlobalendTime[task]:
+          th["Stats"]["Time"]["Successful"] += end - start
+          success.append(1)
         else:
-          currentTask["Status"] = "repeated"
-          currentThread["Stats"]["Time"]["Repeated"] += currentTask["Duration"]
-      j["Stats"]["Time"]["Unfinished"] += currentThread["Stats"]["Time"]["Unfinished"]
-      j["Stats"]["Time"]["Successful"] += currentThread["Stats"]["Time"]["Successful"]
-      j["Stats"]["Time"]["Repeated"] += currentThread["Stats"]["Time"]["Repeated"]
-      j["Stats"]["Time"]["Total"] += currentThread["Stats"]["Time"]["Total"]
+          th["Stats"]["Time"]["Repeated"] += end - start
+          success.append(0)
+      th["Success"] = success
+      j["Stats"]["Time"]["Unfinished"] += th["Stats"]["Time"]["Unfinished"]
+      j["Stats"]["Time"]["Successful"] += th["Stats"]["Time"]["Successful"]
+      j["Stats"]["Time"]["Repeated"] += th["Stats"]["Time"]["Repeated"]
+      j["Stats"]["Time"]["Total"] += th["Stats"]["Time"]["Total"]
+    j["End Init. Time"] = firstTaskTime if firstTaskTime is not None else j["Start Time"]
     if(len(j["Threads"])):
       j["Stats"]["Time"]["Init. Overhead"] = j["End Init. Time"] - j["Start Time"]
 
+    # Milliseconds to seconds
+    for stats in [j["Stats"]] + [th["Stats"] for th in j["Threads"].values()]:
+      for k in stats["Time"]:
+        stats["Time"][k] /= 1000.0
+
 def printStatistics(name, v, total):
   print("%s, %.2f, %.6f, %.6f, %.6f, %.6f, %.6f" % (name, 100*sum(v)/total, sum(v), mean(v), (lambda x:stdev(x) if len(x) > 1 else 0)(v), min(v), max(v)))
 
@@ -124,22 +384,142 @@ def jobStatistics(jobs):
   duplicated_work = []
 
   for j in jobs:
-    if(j["Kill Time"] == ""):
-      continue
-    init_overhead.append(j["Stats"]["Time"]["Init. Overhead"].total_seconds() * len(j["Threads"]))
-    useful_work.append(j["Stats"]["Time"]["Successful"].total_seconds())
-    duplicated_work.append((j["Stats"]["Time"]["Repeated"] + j["Stats"]["Time"]["Unfinished"]).total_seconds())
-    starving.append(j["Stats"]["Time"]["Total"].total_seconds() - duplicated_work[-1] - useful_work[-1] - init_overhead[-1])
+    init_overhead.append(j["Stats"]["Time"]["Init. Overhead"] * len(j["Threads"]))
+    useful_work.append(j["Stats"]["Time"]["Successful"])
+    duplicated_work.append(j["Stats"]["Time"]["Repeated"] + j["Stats"]["Time"]["Unfinished"])
+    starving.append(j["Stats"]["Time"]["Total"] - duplicated_work[-1] - useful_work[-1] - init_overhead[-1])
 
   total = sum(init_overhead) + sum(useful_work) + sum(duplicated_work) + sum(starving)
   if(total == 0):
     print("Failed to parse logs")
-    return
+    return False
   print("Metric, %, total, average, std, min, max")
   printStatistics("Init overhead", init_overhead, total)
   printStatistics("Useful work", useful_work, total)
   printStatistics("Duplicated work", duplicated_work, total)
   printStatistics("Starving", starving, total)
+  return True
+
+
+def coverage(starts, ends, edges, origin):
+  # Time covered by the intervals up to each edge:
+  # sum(min(x, end) - start for start < x), computed from the sorted starts
+  # and ends and their prefix sums. Times are taken relative to origin to
+  # keep the sums precise
+  if np is not None:
+    s = np.sort(np.frombuffer(starts, dtype=np.int64) - origin).astype(np.float64)
+    e = np.sort(np.frombuffer(ends, dtype=np.int64) - origin).astype(np.float64)
+    x = np.asarray(edges, dtype=np.float64)
+    ps = np.concatenate(([0.0], np.cumsum(s)))
+    pe = np.concatenate(([0.0], np.cumsum(e)))
+    ns = np.searchsorted(s, x)
+    ne = np.searchsorted(e, x)
+    return (ns * x - ps[ns]) - (ne * x - pe[ne])
+  s = sorted(v - origin for v in starts)
+  e = sorted(v - origin for v in ends)
+  ps, pe = [0.0], [0.0]
+  for v in s:
+    ps.append(ps[-1] + v)
+  for v in e:
+    pe.append(pe[-1] + v)
+  result = []
+  for x in edges:
+    ns = bisect_left(s, x)
+    ne = bisect_left(e, x)
+    result.append((ns * x - ps[ns]) - (ne * x - pe[ne]))
+  return result
+
+
+def utilization(jobs, bins):
+  # Busy and alive threads of all task managers in each interval of time
+  t0 = min(j["Start Time"] for j in jobs)
+  t1 = max(j["Kill Time"] for j in jobs)
+  if t1 <= t0:
+    return
+  width = (t1 - t0) / bins
+  edges = [width * i for i in range(bins + 1)]
+  busyStarts, busyEnds = array('q'), array('q')
+  aliveStarts, aliveEnds = array('q'), array('q')
+  for j in jobs:
+    for th in j["Threads"].values():
+      busyStarts.extend(th["Starts"])
+      busyEnds.extend(th["Ends"])
+      aliveStarts.append(th["Start Time"])
+      aliveEnds.append(max(th["Start Time"], j["Kill Time"]))
+  busy = coverage(busyStarts, busyEnds, edges, t0)
+  alive = coverage(aliveStarts, aliveEnds, edges, t0)
+  print("Time (s), Busy threads, Alive threads, Utilization %")
+  for i in range(bins):
+    b = (busy[i + 1] - busy[i]) / width
+    a = (alive[i + 1] - alive[i]) / width
+    print("%.3f, %.2f, %.2f, %.2f" % (edges[i] / 1000.0, b, a, 100 * b / a if a > 0 else 0))
+
+
+def criticalPath(jobs):
+  # The job cannot finish before the slowest task manager initialization
+  # plus the longest task or the useful work spread over every thread
+  work = 0
+  longest = 0
+  threads = 0
+  lastEnd = None
+  for j in jobs:
+    threads += len(j["Threads"])
+    for th in j["Threads"].values():
+      for start, end, success in zip(th["Starts"], th["Ends"], th["Success"]):
+        if success:
+          work += end - start
+          longest = max(longest, end - start)
+          lastEnd = end if lastEnd is None else max(lastEnd, end)
+  if threads == 0 or lastEnd is None:
+    return
+  t0 = min(j["Start Time"] for j in jobs)
+  init = max(j["Stats"]["Time"]["Init. Overhead"] for j in jobs)
+  work /= 1000.0
+  longest /= 1000.0
+  makespan = (lastEnd - t0) / 1000.0
+  estimate = init + max(work / threads, longest)
+  print("Critical path, seconds")
+  print("Makespan, %.6f" % makespan)
+  print("Estimate, %.6f" % estimate)
+  print("Longest init, %.6f" % init)
+  print("Work per thread, %.6f" % (work / threads))
+  print("Longest task, %.6f" % longest)
+  print("Efficiency %%, %.2f" % (100 * estimate / makespan if makespan > 0 else 100))
+
+
+def percentile(v, q):
+  v = sorted(v)
+  return v[min(len(v) - 1, int(len(v) * q / 100.0))]
+
+
+def stragglers(jobs, top):
+  # Task managers ranked by how late they finished their last task, with
+  # their task times relative to the fleet
+  rows = []
+  for j in jobs:
+    durations = []
+    lastEnd = None
+    for th in j["Threads"].values():
+      for start, end, done in zip(th["Starts"], th["Ends"], th["Done"]):
+        if done:
+          durations.append((end - start) / 1000.0)
+          lastEnd = end if lastEnd is None else max(lastEnd, end)
+    if durations:
+      busy = sum(th["Stats"]["Time"]["Successful"] + th["Stats"]["Time"]["Repeated"] +
+                 th["Stats"]["Time"]["Unfinished"] for th in j["Threads"].values())
+      total = j["Stats"]["Time"]["Total"]
+      rows.append([j["Name"], len(durations), mean(durations), percentile(durations, 95),
+                   100 * busy / total if total > 0 else 0, lastEnd])
+  if not rows:
+    return
+  t0 = min(j["Start Time"] for j in jobs)
+  medianEnd = median(r[5] for r in rows)
+  medianTime = median(r[2] for r in rows)
+  rows.sort(key=lambda r: r[5], reverse=True)
+  print("Task manager, tasks, average, p95, busy %, last end, late, slowdown")
+  for name, n, avg, p95, busy, lastEnd in rows[:top]:
+    print("%s, %d, %.6f, %.6f, %.2f, %.3f, %.3f, %.2f" % (name, n, avg, p95, busy,
+          (lastEnd - t0) / 1000.0, (lastEnd - medianEnd) / 1000.0, avg / medianTime if medianTime > 0 else 1))
 
 
 description_msg="""    Perf-PITS: A PY-PITS performance diagnosys tool
@@ -235,6 +615,30 @@ Causes
  P5) The number of tasks that can be duplicated by the system is too high:
      The user may adjust this parameter passing an argument to the PY-PITS
      runtime tool.
+
+After the table above, the tool prints:
+
+ - The utilization over time: the average number of busy and alive
+   worker threads of all task managers in each interval (--bins). Dips
+   show when the job manager could not keep up (P3, P4) or when the task
+   managers were initializing (P1).
+ - A critical path estimate: the slowest task manager initialization plus
+   the longest task or the useful work spread over every thread, whichever
+   is longer. A makespan much longer than the estimate (low efficiency)
+   points to starvation or stragglers.
+ - The task managers that finished last (--top), with their average and
+   95th percentile task time, how busy they were, how late their last task
+   finished after the median task manager and their slowdown (average task
+   time over the median of the task managers).
+
+Log files are parsed in parallel (--jobs processes), large files are
+split in chunks (--chunk-size). NumPy is used for the timelines when it is
+installed.
+
+The binary event logs written by the task managers started with
+--event-log are accepted in place of their log files. They are smaller
+and much faster to parse, and record the worker threads even when the
+logging verbosity is low.
 """
   
 
@@ -243,10 +647,24 @@ if __name__ == "__main__":
                                    formatter_class=argparse.RawTextHelpFormatter)
 
   parser.add_argument('files', metavar='SPITS_LOG_FILE', type=str, nargs='+',
-                      help='log file to be processed.')
+                      help='log or event log (--event-log) file to be processed.')
+  parser.add_argument('-j', '--jobs', metavar='N', type=int, default=None,
+                      help='number of parsing processes (default: number of CPUs).')
+  parser.add_argument('--chunk-size', metavar='MB', type=int, default=64,
+                      help='size of the pieces large files are split in (default: 64).')
+  parser.add_argument('--bins', metavar='N', type=int, default=20,
+                      help='number of intervals of the utilization timeline (default: 20).')
+  parser.add_argument('--top', metavar='N', type=int, default=10,
+                      help='number of task managers ranked as stragglers (default: 10).')
 
   args = parser.parse_args()
 
-  jobs = loadFiles(args.files)
-  gStats = processTasks(jobs)
-  jobStatistics(jobs)
+  jobs = loadFiles(args.files, args.jobs, max(1, args.chunk_size) << 20)
+  processTasks(jobs)
+  if jobStatistics(jobs):
+    print()
+    utilization(jobs, max(1, args.bins))
+    print()
+    criticalPath(jobs)
+    print()
+    stragglers(jobs, max(1, args.top))